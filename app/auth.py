@@ -1,9 +1,16 @@
 from fastapi import Depends, HTTPException, status, Request
-from sqlalchemy.orm import Session
-from app.database import get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import get_async_db
 from app.models import User, UserRole
+from app.services.metrics import Stage
+from collections import OrderedDict
+import threading
+import time
 
 ADMIN_SECRET_KEY = "admin_secret_key"
+AUTH_CACHE_TTL = 60.0
+AUTH_CACHE_SIZE = 10000
 
 class AdminUser:
     id = "admin"
@@ -11,22 +18,83 @@ class AdminUser:
     role = UserRole.ADMIN
     api_key = ADMIN_SECRET_KEY
 
+class CachedUser:
+    __slots__ = ("id", "name", "role", "api_key")
 
-def get_current_user(request: Request, db: Session = Depends(get_db)):
-    auth_header = request.headers.get("authorization")
-    if not auth_header:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
-    try:
-        scheme, token = auth_header.split()
-    except ValueError:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid auth header")
-    if scheme.lower() not in ["bearer", "token"]:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid auth scheme")
-    if token == ADMIN_SECRET_KEY:
-        return AdminUser()
-    user = db.query(User).filter(User.api_key == token).first()
-    if not user:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
-    if request.url.path.startswith("/api/v1/admin") and user.role != UserRole.ADMIN:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
-    return user 
\ No newline at end of file
+    def __init__(self, id, name, role, api_key):
+        self.id = id
+        self.name = name
+        self.role = role
+        self.api_key = api_key
+
+class AuthCache:
+    # LRU-кеш token -> пользователь с ограниченным временем жизни записи
+    def __init__(self, ttl=AUTH_CACHE_TTL, maxsize=AUTH_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is not None:
+                user, expires = entry
+                if expires > now:
+                    self.entries.move_to_end(token)
+                    self.hits += 1
+                    return user
+                del self.entries[token]
+            self.misses += 1
+            return None
+
+    def put(self, token, user):
+        with self.lock:
+            self.entries[token] = (user, time.monotonic() + self.ttl)
+            self.entries.move_to_end(token)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, token):
+        with self.lock:
+            self.entries.pop(token, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+auth_cache = AuthCache()
+
+
+async def get_current_user(request: Request, db: AsyncSession = Depends(get_async_db)):
+    # Зависимость всех защищённых маршрутов: выполняется в event loop, в пул
+    # потоков не уходит; промах кеша — один async-запрос
+    with Stage("auth"):
+        auth_header = request.headers.get("authorization")
+        if not auth_header:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
+        try:
+            scheme, token = auth_header.split()
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid auth header")
+        if scheme.lower() not in ["bearer", "token"]:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid auth scheme")
+        if token == ADMIN_SECRET_KEY:
+            return AdminUser()
+        user = auth_cache.get(token)
+        if user is None:
+            row = (await db.execute(select(User.id, User.name, User.role, User.api_key).where(User.api_key == token))).first()
+            if not row:
+                raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+            user = CachedUser(id=row.id, name=row.name, role=row.role, api_key=row.api_key)
+            auth_cache.put(token, user)
+        if request.url.path.startswith("/api/v1/admin") and user.role != UserRole.ADMIN:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+        return user 
\ No newline at end of file
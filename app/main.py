@@ -1,11 +1,131 @@
-from fastapi import FastAPI
+import asyncio
+import functools
+import os
+from anyio import to_thread
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, WebSocket, status
+from fastapi.responses import PlainTextResponse
 from app.routes import public, order, admin_balance, balance, admin_instrument, admin_user
+from app.database import SessionLocal, engine, async_engine
+from app.migrations import migrate, check_query_plans
+from app.services.sequencer import sequencer
+from app.services.journal import journal
+from app.services.balances import ledger
+from app.services.market_data import hub, book_depth
+from app.services.candles import candles
+from app.services.archive import archive
+from app.services.metrics import metrics, MetricsMiddleware, ENGINE_METRICS
+from app.services.logs import logs
+from app.services.cluster import cluster
+from app.services.instruments import instruments
+from app.services.sequencer import run_in_session
+from app.services.snapshots import snapshots
 
-app = FastAPI(title="Toy Exchange", version="0.1.0")
+# Пул потоков anyio: синхронные маршруты и зависимости, команды cluster.call.
+# Маршруты чтения его не занимают — они ходят в SQL через async_engine
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "40"))
+
+def configure_threadpool():
+    # Вызывается из работающего event loop: у каждого loop свой ограничитель
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
+def open_engine():
+    # Состояние движка: в одном процессе — при старте приложения,
+    # в многопроцессном режиме — в процессе движка (app.serve)
+    migrate(engine)
+    # Соединения пула пережили создание таблиц и индексов: план проверяем
+    # и дальше работаем на новых
+    engine.dispose()
+    check_query_plans(engine)
+    # Сначала доигрываем журнал в SQL, затем поднимаем в память балансы из balances,
+    # книги заявок из снимка и хвоста журнала (без снимка — из limit_orders)
+    # и свечи из архива сделок и transactions
+    records = journal.open()
+    archive.open()
+    db = SessionLocal()
+    try:
+        instruments.load(db)
+        ledger.load(db)
+        snapshots.restore(db, records)
+        candles.load(db)
+    finally:
+        db.close()
+    archive.start()
+    snapshots.start()
+
+async def close_engine():
+    archive.stop()
+    snapshots.stop()
+    await sequencer.join()
+    journal.close()
+    # Последний снимок: журнал применён целиком и сжимается до пустого
+    snapshots.save()
+
+def engine_metrics(db):
+    return metrics.render(only=ENGINE_METRICS)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logs.start()
+    configure_threadpool()
+    if cluster.remote:
+        # HTTP-воркер: состояние в процессе движка, справочник инструментов —
+        # своя копия, изменения присылает движок
+        await cluster.connect()
+        run_in_session(instruments.load)
+        yield
+        await cluster.close()
+    else:
+        open_engine()
+        yield
+        await close_engine()
+    # Соединения async-пула привязаны к этому event loop
+    await async_engine.dispose()
+    logs.stop()
+
+app = FastAPI(title="Toy Exchange", version="0.1.0", lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(public.router, prefix="/api/v1/public")
 app.include_router(order.router, prefix="/api/v1/order")
 app.include_router(admin_balance.router, prefix="/api/v1/admin/balance")
 app.include_router(balance.router, prefix="/api/v1/balance")
 app.include_router(admin_instrument.router, prefix="/api/v1/admin/instrument")
-app.include_router(admin_user.router, prefix="/api/v1/admin/user")
\ No newline at end of file
+app.include_router(admin_user.router, prefix="/api/v1/admin/user")
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    # Текстовый формат Prometheus; метрики книг и журнала — от движка
+    text = metrics.render(exclude=ENGINE_METRICS if cluster.remote else ())
+    if cluster.remote:
+        text += await cluster.call(engine_metrics)
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
+
+@app.websocket("/api/v1/public/ws/{ticker}")
+async def market_data_feed(websocket: WebSocket, ticker: str):
+    # Снимок книги при подписке, далее пронумерованные L2-дельты и сделки.
+    # Подписка только на существующий инструмент: каждый тикер — подписчики
+    # в hub и серии метрик
+    if not instruments.exists(ticker):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    subscriber = hub.subscribe(ticker)
+    await cluster.watch(ticker)
+
+    async def receive():
+        # Входящие сообщения игнорируются: чтение нужно, чтобы заметить отключение
+        while True:
+            await websocket.receive_text()
+
+    snapshot = functools.partial(cluster.run, book_depth)
+    tasks = [asyncio.create_task(subscriber.run(websocket, snapshot)), asyncio.create_task(receive())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        hub.unsubscribe(subscriber)
+        if ticker not in hub.subscribers:
+            await cluster.unwatch(ticker)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
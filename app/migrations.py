@@ -0,0 +1,88 @@
+import logging
+from sqlalchemy import inspect, select, text
+from app.models import Base, LimitOrder, MarketOrder, Transaction, ACTIVE_ORDER_SQL
+
+logger = logging.getLogger(__name__)
+
+# Запросы горячих путей и индексы, которыми они должны обслуживаться.
+# Форма запросов повторяет маршруты и загрузку книг
+PLANNED_QUERIES = [
+    ("ix_limit_orders_active", select(LimitOrder).where(text(ACTIVE_ORDER_SQL)).order_by(
+        LimitOrder.ticker, LimitOrder.direction, LimitOrder.price, LimitOrder.timestamp)),
+    ("ix_limit_orders_user", select(LimitOrder).where(LimitOrder.user_id == "user").order_by(LimitOrder.timestamp)),
+    ("ix_market_orders_user", select(MarketOrder).where(MarketOrder.user_id == "user").order_by(MarketOrder.timestamp)),
+    ("ix_transactions_ticker_timestamp", select(
+        Transaction.ticker, Transaction.amount, Transaction.price, Transaction.timestamp
+    ).where(Transaction.ticker == "TICKER").order_by(Transaction.timestamp.desc()).limit(10)),
+]
+
+
+# Заполнение новых колонок существующих таблиц
+BACKFILLS = {
+    # Резервы под уже стоящие в книге лимитные заявки
+    ("balances", "reserved"): f"""
+        UPDATE balances SET reserved = COALESCE((
+            SELECT SUM((qty - filled) * price) FROM limit_orders
+            WHERE limit_orders.user_id = balances.user_id AND balances.ticker = 'RUB'
+              AND direction = 'BUY' AND {ACTIVE_ORDER_SQL}
+        ), 0) + COALESCE((
+            SELECT SUM(qty - filled) FROM limit_orders
+            WHERE limit_orders.user_id = balances.user_id AND limit_orders.ticker = balances.ticker
+              AND direction = 'SELL' AND {ACTIVE_ORDER_SQL}
+        ), 0)
+    """,
+}
+
+
+def add_missing_columns(engine):
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+                if column.default is not None and column.default.is_scalar:
+                    ddl += f" DEFAULT {column.default.arg!r}"
+                    if not column.nullable:
+                        ddl += " NOT NULL"
+                conn.execute(text(ddl))
+                backfill = BACKFILLS.get((table.name, column.name))
+                if backfill:
+                    conn.execute(text(backfill))
+                logger.info("added column %s.%s", table.name, column.name)
+
+
+def migrate(engine):
+    Base.metadata.create_all(bind=engine)
+    add_missing_columns(engine)
+    # create_all не трогает уже существующие таблицы: новые индексы досоздаём отдельно
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+
+def explain(conn, query):
+    sql = str(query.compile(conn.engine, compile_kwargs={"literal_binds": True}))
+    if conn.dialect.name == "sqlite":
+        return " ".join(row[-1] for row in conn.execute(text("EXPLAIN QUERY PLAN " + sql)))
+    # На маленьких таблицах PostgreSQL честно выбирает seq scan, поэтому
+    # проверяем, что индекс вообще применим к запросу
+    conn.execute(text("SET LOCAL enable_seqscan = off"))
+    return " ".join(row[0] for row in conn.execute(text("EXPLAIN " + sql)))
+
+
+def check_query_plans(engine):
+    # Проверка при старте, что планировщик действительно использует индексы
+    result = {}
+    with engine.connect() as conn:
+        for index_name, query in PLANNED_QUERIES:
+            plan = explain(conn, query)
+            result[index_name] = index_name in plan
+            if not result[index_name]:
+                logger.warning("query plan does not use %s: %s", index_name, plan)
+        conn.rollback()
+    return result
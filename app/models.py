@@ -1,10 +1,14 @@
-from sqlalchemy import Column, String, Integer, DateTime, Enum as SQLEnum, ForeignKey
+from sqlalchemy import Column, String, Integer, Boolean, DateTime, Enum as SQLEnum, ForeignKey, Index, text
 from sqlalchemy.orm import declarative_base, relationship
 from datetime import datetime, timezone
 import enum
 
 Base = declarative_base()
 
+# Условие "заявка в книге" литералом: частичный индекс применяется SQLite,
+# только если в запросе стоит то же выражение, а не связанные параметры
+ACTIVE_ORDER_SQL = "status IN ('NEW', 'PARTIALLY_EXECUTED')"
+
 class UserRole(str, enum.Enum):
     USER = "USER"
     ADMIN = "ADMIN"
@@ -27,6 +31,8 @@ class Balance(Base):
     user_id = Column(String, ForeignKey('users.id'), primary_key=True)
     ticker = Column(String, ForeignKey('instruments.ticker'), primary_key=True)
     amount = Column(Integer, default=0)
+    # Часть amount, заблокированная под активные лимитные заявки
+    reserved = Column(Integer, default=0, nullable=False)
     user = relationship("User", back_populates="balances")
     instrument = relationship("Instrument")
 
@@ -51,6 +57,19 @@ class LimitOrder(Base):
     qty = Column(Integer)
     price = Column(Integer)
     filled = Column(Integer, default=0)
+    # GTC, IOC или FOK; заявки IOC и FOK в книгу не встают и пишутся сразу
+    # в конечном статусе (EXECUTED или CANCELLED)
+    time_in_force = Column(String, default="GTC", nullable=False)
+    post_only = Column(Boolean, default=False, nullable=False)
+    __table_args__ = (
+        # Частичный индекс только по активным заявкам: книга тикера и её сторона
+        # в порядке цена-время, без исполненной и отменённой истории
+        Index(
+            'ix_limit_orders_active', 'ticker', 'direction', 'price', 'timestamp',
+            sqlite_where=text(ACTIVE_ORDER_SQL), postgresql_where=text(ACTIVE_ORDER_SQL)
+        ),
+        Index('ix_limit_orders_user', 'user_id', 'timestamp'),
+    )
 
 class MarketOrder(Base):
     __tablename__ = 'market_orders'
@@ -61,6 +80,9 @@ class MarketOrder(Base):
     direction = Column(SQLEnum(Direction))
     ticker = Column(String, ForeignKey('instruments.ticker'))
     qty = Column(Integer)
+    __table_args__ = (
+        Index('ix_market_orders_user', 'user_id', 'timestamp'),
+    )
 
 class Transaction(Base):
     __tablename__ = 'transactions'
@@ -70,4 +92,13 @@ class Transaction(Base):
     price = Column(Integer)
     timestamp = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     buyer_id = Column(String, ForeignKey('users.id'))
-    seller_id = Column(String, ForeignKey('users.id')) 
\ No newline at end of file
+    seller_id = Column(String, ForeignKey('users.id'))
+    __table_args__ = (
+        # Покрывающий индекс для ленты сделок тикера (новые первыми)
+        Index('ix_transactions_ticker_timestamp', 'ticker', 'timestamp', 'price', 'amount'),
+    )
+
+class JournalState(Base):
+    __tablename__ = 'journal_state'
+    id = Column(Integer, primary_key=True)
+    applied_seq = Column(Integer, default=0)
@@ -1,9 +1,11 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
 from app.schemas import Ok
-from app.models import Balance, User as UserModel, Instrument as InstrumentModel
+from app.models import User as UserModel
 from app.auth import get_current_user
-from app.database import get_db
+from app.services.balances import ledger
+from app.services.journal import journal, BalanceChanged, to_micros
+from app.services.cluster import cluster
+from datetime import datetime, timezone
 from pydantic import BaseModel, Field
 
 class DepositBody(BaseModel):
@@ -18,33 +20,46 @@ class WithdrawBody(BaseModel):
 
 router = APIRouter()
 
-@router.post("/deposit", response_model=Ok)
-def deposit(body: DepositBody, current_user=Depends(get_current_user), db: Session = Depends(get_db)):
+def record_change(body, amount):
+    # Баланс в памяти меняется и изменение уходит в журнал под ledger.lock:
+    # порядок событий в журнале совпадает с порядком проверок остатка.
+    # В balances изменение попадёт вместе с пачкой применителя журнала
+    journal.check()
+    with ledger.lock:
+        if amount > 0:
+            ledger.deposit(body.user_id, body.ticker, amount)
+        else:
+            ledger.withdraw(body.user_id, body.ticker, -amount)
+        future = journal.append([BalanceChanged(
+            user_id=body.user_id, ticker=body.ticker, amount=amount, timestamp=to_micros(datetime.now(timezone.utc))
+        )])
+    future.result()
+
+def apply_deposit(db, body):
+    # Выполняется в процессе движка, где живут балансы
     user = db.query(UserModel).get(body.user_id)
     if not user:
         raise HTTPException(404, "User not found")
     # instrument = db.query(InstrumentModel).get(body.ticker)
     # if not instrument:
     #     raise HTTPException(404, "Instrument not found")
-    balance = db.query(Balance).get((body.user_id, body.ticker))
-    if not balance:
-        balance = Balance(user_id=body.user_id, ticker=body.ticker, amount=0)
-        db.add(balance)
-    balance.amount += body.amount
-    db.commit()
-    return {"success": True}
+    record_change(body, body.amount)
 
-@router.post("/withdraw", response_model=Ok)
-def withdraw(body: WithdrawBody, current_user=Depends(get_current_user), db: Session = Depends(get_db)):
+def apply_withdraw(db, body):
     user = db.query(UserModel).get(body.user_id)
     if not user:
         raise HTTPException(404, "User not found")
     # instrument = db.query(InstrumentModel).get(body.ticker)
     # if not instrument:
     #     raise HTTPException(404, "Instrument not found")
-    balance = db.query(Balance).get((body.user_id, body.ticker))
-    if not balance or balance.amount < body.amount:
-        raise HTTPException(400, "Insufficient balance")
-    balance.amount -= body.amount
-    db.commit()
+    record_change(body, -body.amount)
+
+@router.post("/deposit", response_model=Ok)
+async def deposit(body: DepositBody, current_user=Depends(get_current_user)):
+    await cluster.call(apply_deposit, body)
+    return {"success": True}
+
+@router.post("/withdraw", response_model=Ok)
+async def withdraw(body: WithdrawBody, current_user=Depends(get_current_user)):
+    await cluster.call(apply_withdraw, body)
     return {"success": True} 
\ No newline at end of file
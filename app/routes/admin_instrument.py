@@ -1,29 +1,45 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
 from sqlalchemy.exc import IntegrityError
 from app.models import Instrument as InstrumentModel
 from app.schemas import Instrument, Ok
 from app.auth import get_current_user
-from app.database import get_db
+from app.services.cluster import cluster
+from app.services.instruments import instruments
+from app.services.order_services import close_book
 
 router = APIRouter()
 
-@router.post("", response_model=Ok)
-def add_instrument(instrument: Instrument, current_user=Depends(get_current_user), db: Session = Depends(get_db)):
-    inst = InstrumentModel(**instrument.dict())
-    db.add(inst)
+def create_instrument(db, ticker, name):
+    # Выполняется в процессе движка; возвращает новый справочник для воркеров
+    db.add(InstrumentModel(ticker=ticker, name=name))
     try:
         db.commit()
     except IntegrityError:
         db.rollback()
         raise HTTPException(400, "Instrument already exists")
-    return {"success": True}
+    instruments.add(ticker, name)
+    return instruments.items()
 
-@router.delete("/{ticker}", response_model=Ok)
-def delete_instrument(ticker: str, current_user=Depends(get_current_user), db: Session = Depends(get_db)):
-    inst = db.query(InstrumentModel).get(ticker)
-    if not inst:
+def remove_instrument(db, ticker):
+    # Команда исполнителя тикера: заявки, принятые до неё, уже исполнены,
+    # следующие отклоняются по справочнику. Строка instruments удаляется
+    # после того, как снятие стоящих заявок записано в журнал и применено к SQL
+    if not instruments.exists(ticker):
         raise HTTPException(404, "Instrument not found")
-    db.delete(inst)
+    instruments.remove(ticker)
+    future = close_book(db, ticker)
+    if future is not None:
+        future.result()
+    db.query(InstrumentModel).filter(InstrumentModel.ticker == ticker).delete()
     db.commit()
-    return {"success": True} 
\ No newline at end of file
+    return instruments.items()
+
+@router.post("", response_model=Ok)
+async def add_instrument(instrument: Instrument, current_user=Depends(get_current_user)):
+    await cluster.update_instruments(await cluster.call(create_instrument, instrument.ticker, instrument.name))
+    return {"success": True}
+
+@router.delete("/{ticker}", response_model=Ok)
+async def delete_instrument(ticker: str, current_user=Depends(get_current_user)):
+    await cluster.update_instruments(await cluster.submit(ticker, remove_instrument, ticker))
+    return {"success": True}
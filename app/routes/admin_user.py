@@ -1,18 +1,30 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi.concurrency import run_in_threadpool
 from app.models import User as UserModel
 from app.schemas import User
-from app.auth import get_current_user
-from app.database import get_db
+from app.auth import get_current_user, auth_cache
+from app.services.cluster import cluster
+from app.services.sequencer import run_in_session
 
 router = APIRouter()
 
-@router.delete("/{user_id}", response_model=User)
-def delete_user(user_id: str, current_user=Depends(get_current_user), db: Session = Depends(get_db)):
-    # Проверка роли ADMIN теперь реализована в get_current_user
+def remove_user(db, user_id):
     user = db.query(UserModel).get(user_id)
     if not user:
         raise HTTPException(404, "User not found")
+    removed = {"id": user.id, "name": user.name, "role": user.role, "api_key": user.api_key}
     db.delete(user)
     db.commit()
-    return user 
\ No newline at end of file
+    return removed
+
+@router.delete("/{user_id}", response_model=User)
+async def delete_user(user_id: str, current_user=Depends(get_current_user)):
+    # Проверка роли ADMIN теперь реализована в get_current_user
+    user = await run_in_threadpool(run_in_session, remove_user, user_id)
+    # Токен сбрасывается в кешах всех HTTP-воркеров
+    await cluster.invalidate(user["api_key"])
+    return user
+
+@router.get("/auth-cache")
+def get_auth_cache_stats(current_user=Depends(get_current_user)):
+    return auth_cache.stats() 
\ No newline at end of file
@@ -1,12 +1,14 @@
 from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
-from app.models import Balance
 from app.auth import get_current_user
-from app.database import get_db
+from app.services.balances import ledger
+from app.services.cluster import cluster
 
 router = APIRouter()
 
+async def user_balances(user_id):
+    # Балансы в памяти движка, без запроса к SQL
+    return ledger.user_balances(user_id)
+
 @router.get("")
-def get_balances(current_user=Depends(get_current_user), db: Session = Depends(get_db)):
-    balances = db.query(Balance).filter(Balance.user_id == current_user.id).all()
-    return {b.ticker: b.amount for b in balances} 
\ No newline at end of file
+async def get_balances(current_user=Depends(get_current_user)):
+    return await cluster.run(user_balances, current_user.id)
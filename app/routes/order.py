@@ -1,349 +1,235 @@
-from fastapi import APIRouter, Depends, HTTPException, Request
-from sqlalchemy.orm import Session
-from sqlalchemy import desc
-from app.schemas import LimitOrderBody, MarketOrderBody, CreateOrderResponse, LimitOrder, MarketOrder, Ok
-from app.models import LimitOrder as LimitOrderModel, MarketOrder as MarketOrderModel, OrderStatus, Balance, Instrument as InstrumentModel, Transaction as TransactionModel
+import asyncio
+import orjson
+from collections import defaultdict
+from datetime import datetime
+from fastapi import APIRouter, Depends, HTTPException, Request, Query, Response
+from fastapi.responses import StreamingResponse, ORJSONResponse
+from pydantic import ValidationError
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.schemas import LimitOrderBody, MarketOrderBody, CreateOrderResponse, LimitOrder, MarketOrder, Ok, BatchCancelBody, BatchResponse
+from app.schemas import order_body, order_view, order_list
 from app.auth import get_current_user
-from app.database import get_db
-import uuid
-from datetime import datetime, timezone
-from typing import List, Union
+from app.models import UserRole
+from app.database import get_async_db
+from app.services import order_services
+from app.services.order_services import place_order, place_orders, check_orders
+from app.services.order_book import books
+from app.services.sequencer import sequencer, run_in_session
+from app.services.cluster import cluster
+from app.services.order_lookup import live_order, stored_order, user_orders
+from app.services.history import order_rows, parse_statuses, stream_items, HISTORY_MEDIA_TYPES
+from app.services.metrics import Stage, orders_total, rejects_total, reject_reason
+from app.services import logs
+from typing import List, Optional, Union
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
 
-# Вспомогательная функция для проверки баланса
-def get_balance(db, user_id, ticker):
-    bal = db.query(Balance).get((user_id, ticker))
-    return bal.amount if bal else 0
+# Ограничение размера пачки: вся пачка тикера исполняется одной командой
+MAX_BATCH_SIZE = 100
 
-def update_balance(db, user_id, ticker, delta):
-    bal = db.query(Balance).get((user_id, ticker))
-    if not bal:
-        if delta < 0:
-            raise HTTPException(400, "Insufficient balance")
-        bal = Balance(user_id=user_id, ticker=ticker, amount=0)
-        db.add(bal)
-    # Проверяем, что после изменения баланс не станет отрицательным
-    if bal.amount + delta < 0:
-        raise HTTPException(400, "Insufficient balance")
-    bal.amount += delta
-    db.flush()  # Немедленно применяем изменения, чтобы избежать конфликтов
+def parse_order(body_json):
+    # Тип заявки определяет дискриминатор схемы OrderBody (наличие поля price)
+    body = order_body.validate_python(body_json)
+    return body, isinstance(body, LimitOrderBody)
 
-# Исполнение лимитных ордеров (упрощённо)
-def match_limit_order(db, order):
-    # BUY ищет SELL, SELL ищет BUY
-    if order.direction == "BUY":
-        counter_orders = db.query(LimitOrderModel).filter(
-            LimitOrderModel.ticker == order.ticker,
-            LimitOrderModel.direction == "SELL",
-            LimitOrderModel.status == OrderStatus.NEW,
-            LimitOrderModel.price <= order.price
-        ).order_by(LimitOrderModel.price, LimitOrderModel.timestamp).all()
-    else:
-        counter_orders = db.query(LimitOrderModel).filter(
-            LimitOrderModel.ticker == order.ticker,
-            LimitOrderModel.direction == "BUY",
-            LimitOrderModel.status == OrderStatus.NEW,
-            LimitOrderModel.price >= order.price
-        ).order_by(desc(LimitOrderModel.price), LimitOrderModel.timestamp).all()
-    qty_left = order.qty - order.filled
-    for counter in counter_orders:
-        counter_qty_left = counter.qty - counter.filled
-        trade_qty = min(qty_left, counter_qty_left)
-        if trade_qty <= 0:
-            continue
-        order.filled += trade_qty
-        counter.filled += trade_qty
-        # Обновить балансы (упрощённо)
-        if order.direction == "BUY":
-            update_balance(db, order.user_id, "RUB", -trade_qty * counter.price)
-            update_balance(db, order.user_id, order.ticker, trade_qty)
-            update_balance(db, counter.user_id, "RUB", trade_qty * counter.price)
-            update_balance(db, counter.user_id, order.ticker, -trade_qty)
-            # Создать сделку
-            db.add(TransactionModel(
-                id=str(uuid.uuid4()),
-                ticker=order.ticker,
-                amount=trade_qty,
-                price=counter.price,
-                timestamp=datetime.now(timezone.utc),
-                buyer_id=order.user_id,
-                seller_id=counter.user_id
-            ))
-        else:
-            update_balance(db, order.user_id, "RUB", trade_qty * order.price)
-            update_balance(db, order.user_id, order.ticker, -trade_qty)
-            update_balance(db, counter.user_id, "RUB", -trade_qty * order.price)
-            update_balance(db, counter.user_id, order.ticker, trade_qty)
-            # Создать сделку
-            db.add(TransactionModel(
-                id=str(uuid.uuid4()),
-                ticker=order.ticker,
-                amount=trade_qty,
-                price=order.price,
-                timestamp=datetime.now(timezone.utc),
-                buyer_id=counter.user_id,
-                seller_id=order.user_id
-            ))
-        db.flush()  # Немедленно применяем изменения после каждого trade
-        qty_left -= trade_qty
-        if counter.filled == counter.qty:
-            counter.status = OrderStatus.EXECUTED
-        if qty_left == 0:
-            break
-    if order.filled == order.qty:
-        order.status = OrderStatus.EXECUTED
-    elif order.filled > 0:
-        order.status = OrderStatus.PARTIALLY_EXECUTED
-    else:
-        order.status = OrderStatus.NEW
-    return order
+def parse_order_json(raw):
+    body = order_body.validate_json(raw)
+    return body, isinstance(body, LimitOrderBody)
+
+def json_response(adapter, value):
+    # Ответ, сериализованный заранее собранным сериализатором схемы: без
+    # повторной проверки по response_model
+    return Response(content=adapter.dump_json(value), media_type="application/json")
+
+def order_schema(row):
+    if row.kind == "LIMIT":
+        return LimitOrder(
+            id=row.id,
+            status=row.status,
+            user_id=row.user_id,
+            timestamp=row.timestamp,
+            filled=row.filled,
+            body=LimitOrderBody(
+                direction=row.direction,
+                ticker=row.ticker,
+                qty=row.qty,
+                price=row.price,
+                time_in_force=row.time_in_force,
+                post_only=row.post_only
+            )
+        )
+    return MarketOrder(
+        id=row.id,
+        status=row.status,
+        user_id=row.user_id,
+        timestamp=row.timestamp,
+        body=MarketOrderBody(
+            direction=row.direction,
+            ticker=row.ticker,
+            qty=row.qty
+        )
+    )
+
+def count_reject(detail):
+    reason = reject_reason(detail)
+    rejects_total.inc(reason)
+    logs.info("order_rejected", sampled=True, reason=reason, detail=detail)
+
+def batch_response(results):
+    # Все поля BatchItemResult, отсутствующие — null, как после response_model
+    return ORJSONResponse({"success": True, "results": [
+        {"success": result["success"], "order_id": result.get("order_id"), "error": result.get("error")}
+        for result in results
+    ]})
+
+def merge_results(groups):
+    # Результаты исполнителей тикеров в порядке заявок в пачке
+    return [result for _, result in sorted(result for group in groups for result in group)]
 
 @router.post("", response_model=CreateOrderResponse)
 async def create_order(
     request: Request,
-    current_user=Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user=Depends(get_current_user)
 ):
     try:
-        body_json = await request.json()
-        # Определяем тип ордера по наличию поля price
-        if "price" in body_json:
-            body = LimitOrderBody(**body_json)
-            is_limit = True
-        else:
-            body = MarketOrderBody(**body_json)
-            is_limit = False
-        order_id = str(uuid.uuid4())
-        # Проверка существования инструмента
-        instrument = db.query(InstrumentModel).get(body.ticker)
-        if not instrument:
-            raise HTTPException(400, "Instrument not found")
-        # Проверка на корректность qty и price
-        if (is_limit and (body.qty <= 0 or body.price <= 0)) or (not is_limit and body.qty <= 0):
-            raise HTTPException(400, "Invalid qty or price")
-        # Проверка баланса и встречных заявок ДО создания ордера и изменения баланса
-        if is_limit:
-            if body.direction == "BUY":
-                if get_balance(db, current_user.id, "RUB") < body.qty * body.price:
-                    raise HTTPException(400, "Insufficient balance for buy")
-            if body.direction == "SELL":
-                if get_balance(db, current_user.id, body.ticker) < body.qty:
-                    raise HTTPException(400, "Insufficient balance for sell")
-            order = LimitOrderModel(
-                id=order_id,
-                status=OrderStatus.NEW,
-                user_id=current_user.id,
-                timestamp=datetime.now(timezone.utc),
-                direction=body.direction,
-                ticker=body.ticker,
-                qty=body.qty,
-                price=body.price,
-                filled=0
-            )
-            db.add(order)
-            db.flush()
-            match_limit_order(db, order)
-            db.commit()
-            if order.filled == 0:
-                pass
-        else:
-            if body.direction == "BUY":
-                counter_orders = db.query(LimitOrderModel).filter(
-                    LimitOrderModel.ticker == body.ticker,
-                    LimitOrderModel.direction == "SELL",
-                    LimitOrderModel.status == OrderStatus.NEW
-                ).order_by(LimitOrderModel.price, LimitOrderModel.timestamp).all()
-                if not counter_orders:
-                    raise HTTPException(400, "No counter orders for market order")
-                qty_left = body.qty
-                total_rub_needed = 0
-                for counter in counter_orders:
-                    counter_qty_left = counter.qty - counter.filled
-                    trade_qty = min(qty_left, counter_qty_left)
-                    if trade_qty <= 0:
-                        continue
-                    total_rub_needed += trade_qty * counter.price
-                    qty_left -= trade_qty
-                    if qty_left == 0:
-                        break
-                if qty_left > 0:
-                    raise HTTPException(400, "Market order not fully executed")
-                # Явная проверка баланса перед созданием ордера
-                if get_balance(db, current_user.id, "RUB") < total_rub_needed:
-                    raise HTTPException(400, "Insufficient balance for buy")
-            else:
-                counter_orders = db.query(LimitOrderModel).filter(
-                    LimitOrderModel.ticker == body.ticker,
-                    LimitOrderModel.direction == "BUY",
-                    LimitOrderModel.status == OrderStatus.NEW
-                ).order_by(-LimitOrderModel.price, LimitOrderModel.timestamp).all()
-                if not counter_orders:
-                    raise HTTPException(400, "No counter orders for market order")
-                qty_left = body.qty
-                for counter in counter_orders:
-                    counter_qty_left = counter.qty - counter.filled
-                    trade_qty = min(qty_left, counter_qty_left)
-                    if trade_qty <= 0:
-                        continue
-                    qty_left -= trade_qty
-                    if qty_left == 0:
-                        break
-                if qty_left > 0:
-                    raise HTTPException(400, "Market order not fully executed")
-                # Явная проверка баланса перед созданием ордера
-                if get_balance(db, current_user.id, body.ticker) < body.qty:
-                    raise HTTPException(400, "Insufficient balance for sell")
-            order = MarketOrderModel(
-                id=order_id,
-                status=OrderStatus.NEW,
-                user_id=current_user.id,
-                timestamp=datetime.now(timezone.utc),
-                direction=body.direction,
-                ticker=body.ticker,
-                qty=body.qty
-            )
-            db.add(order)
-            db.flush()
-            qty_left = order.qty
-            for counter in counter_orders:
-                counter_qty_left = counter.qty - counter.filled
-                trade_qty = min(qty_left, counter_qty_left)
-                if trade_qty <= 0:
-                    continue
-                if body.direction == "BUY":
-                    update_balance(db, current_user.id, "RUB", -trade_qty * counter.price)
-                    update_balance(db, current_user.id, body.ticker, trade_qty)
-                    update_balance(db, counter.user_id, "RUB", trade_qty * counter.price)
-                    update_balance(db, counter.user_id, body.ticker, -trade_qty)
-                    db.add(TransactionModel(
-                        id=str(uuid.uuid4()),
-                        ticker=body.ticker,
-                        amount=trade_qty,
-                        price=counter.price,
-                        timestamp=datetime.now(timezone.utc),
-                        buyer_id=current_user.id,
-                        seller_id=counter.user_id
-                    ))
-                else:
-                    update_balance(db, current_user.id, body.ticker, -trade_qty)
-                    update_balance(db, current_user.id, "RUB", trade_qty * counter.price)
-                    update_balance(db, counter.user_id, body.ticker, trade_qty)
-                    update_balance(db, counter.user_id, "RUB", -trade_qty * counter.price)
-                    db.add(TransactionModel(
-                        id=str(uuid.uuid4()),
-                        ticker=body.ticker,
-                        amount=trade_qty,
-                        price=counter.price,
-                        timestamp=datetime.now(timezone.utc),
-                        buyer_id=counter.user_id,
-                        seller_id=current_user.id
-                    ))
-                qty_left -= trade_qty
-                counter.filled += trade_qty
-                if counter.filled == counter.qty:
-                    counter.status = OrderStatus.EXECUTED
-                else:
-                    counter.status = OrderStatus.PARTIALLY_EXECUTED
-                if qty_left == 0:
-                    break
-            if qty_left > 0:
-                raise HTTPException(400, "Market order not fully executed")
-            order.status = OrderStatus.EXECUTED
-            db.commit()
-            print(f"[ORDER DEBUG] user_id={current_user.id} RUB_balance={get_balance(db, current_user.id, 'RUB')}")
-            return {"success": True, "order_id": order_id}
-        db.commit()
-        return {"success": True, "order_id": order_id}
+        with Stage("validation"):
+            body, is_limit = parse_order_json(await request.body())
+    except ValidationError as e:
+        count_reject("Invalid order")
+        logs.info("order_invalid", sampled=True, error=str(e))
+        raise HTTPException(400, f"Invalid order: {e}")
+    try:
+        # Исполнение сериализуется в исполнителе тикера
+        order_id = await cluster.submit(body.ticker, place_order, current_user.id, body, is_limit)
     except HTTPException as e:
-        if e.status_code == 400:
-            print(f"[ORDER 400] {e.detail}")
+        count_reject(e.detail)
         raise e
-    except Exception as e:
-        import traceback
-        print(traceback.format_exc())
-        raise HTTPException(400, f"Invalid order: {e}")
+    orders_total.inc("LIMIT" if is_limit else "MARKET")
+    return ORJSONResponse({"success": True, "order_id": order_id})
+
+@router.post("/batch", response_model=BatchResponse)
+async def create_orders(
+    request: Request,
+    current_user=Depends(get_current_user)
+):
+    try:
+        with Stage("validation"):
+            try:
+                body_json = orjson.loads(await request.body())
+            except orjson.JSONDecodeError:
+                raise HTTPException(400, "Invalid batch: malformed JSON")
+            if not isinstance(body_json, dict) or not isinstance(body_json.get("orders"), list):
+                raise HTTPException(400, "Invalid batch: expected {\"orders\": [...]}")
+            orders = body_json["orders"]
+            atomic = bool(body_json.get("atomic", False))
+            if not orders or len(orders) > MAX_BATCH_SIZE:
+                raise HTTPException(400, f"Batch must contain 1..{MAX_BATCH_SIZE} orders")
+            # Пачка проверяется целиком до исполнения: любая ошибка отклоняет её всю
+            bodies = []
+            for i, item in enumerate(orders):
+                try:
+                    bodies.append(parse_order(item))
+                except ValidationError as e:
+                    raise HTTPException(400, f"Invalid order {i}: {e}")
+            check_orders(bodies)
+        by_ticker = defaultdict(list)
+        for i, (body, is_limit) in enumerate(bodies):
+            by_ticker[body.ticker].append((i, body, is_limit))
+        if atomic and len(by_ticker) > 1:
+            raise HTTPException(400, "Atomic batch must target a single instrument")
+        # Заявки каждого тикера — одна команда его исполнителя, тикеры исполняются параллельно
+        groups = await asyncio.gather(*(
+            cluster.submit(ticker, place_orders, current_user.id, ticker, items, atomic)
+            for ticker, items in by_ticker.items()
+        ))
+    except HTTPException as e:
+        count_reject(e.detail)
+        raise e
+    results = merge_results(groups)
+    for (_, is_limit), result in zip(bodies, results):
+        if result["success"]:
+            orders_total.inc("LIMIT" if is_limit else "MARKET")
+        else:
+            count_reject(result["error"])
+    return batch_response(results)
+
+def owner_id(current_user):
+    # Пользователь отменяет только свои заявки, администратор — любые
+    return None if current_user.role == UserRole.ADMIN else current_user.id
+
+async def cancel_batch(order_ids, atomic, user_id):
+    # Выполняется там, где живут книги (см. app.services.cluster)
+    by_ticker = defaultdict(list)
+    for i, order_id in enumerate(order_ids):
+        book, _ = books.find(order_id)
+        by_ticker[book.ticker if book is not None else None].append((i, order_id))
+    if atomic and len([ticker for ticker in by_ticker if ticker is not None]) > 1:
+        raise HTTPException(400, "Atomic batch must target a single instrument")
+    if atomic and len(by_ticker) > 1:
+        # Уже отменённые/исполненные заявки проверяются вместе с живыми
+        ticker = next(ticker for ticker in by_ticker if ticker is not None)
+        by_ticker = {ticker: sorted(by_ticker.pop(ticker) + by_ticker.pop(None))}
+    groups = await asyncio.gather(*(
+        sequencer.submit(ticker, order_services.cancel_orders, ticker, items, atomic, user_id)
+        if ticker is not None else
+        run_in_threadpool(run_in_session, order_services.cancel_orders, None, items, atomic, user_id)
+        for ticker, items in by_ticker.items()
+    ))
+    return merge_results(groups)
+
+async def cancel_one(order_id, user_id):
+    # Живая заявка отменяется через исполнитель своего тикера
+    book, _ = books.find(order_id)
+    if book is not None:
+        await sequencer.submit(book.ticker, order_services.cancel_order, order_id, user_id)
+    else:
+        await run_in_threadpool(run_in_session, order_services.cancel_order, order_id, user_id)
+
+@router.delete("/batch", response_model=BatchResponse)
+async def cancel_orders(body: BatchCancelBody, current_user=Depends(get_current_user)):
+    if len(body.order_ids) > MAX_BATCH_SIZE:
+        raise HTTPException(400, f"Batch must contain 1..{MAX_BATCH_SIZE} orders")
+    if len(set(body.order_ids)) != len(body.order_ids):
+        raise HTTPException(400, "Duplicate order ids in batch")
+    return batch_response(await cluster.run(cancel_batch, body.order_ids, body.atomic, owner_id(current_user)))
+
+async def live_lookup(order_id):
+    # Заявка из книги движка (см. app.services.cluster) или None
+    return live_order(order_id)
+
+@router.get("/history")
+async def order_history(
+    after: Optional[str] = None,
+    limit: int = 100,
+    status: Optional[str] = None,
+    ticker: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    format: str = Query("ndjson", pattern="^(ndjson|json)$"),
+    current_user=Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    # Постраничная история заявок: after — id последней полученной заявки,
+    # status — через запятую (NEW,PARTIALLY_EXECUTED), [since, until) — по времени
+    items = await order_rows(db, current_user.id, after, limit, parse_statuses(status), ticker, since, until)
+    return StreamingResponse(stream_items(items, format), media_type=HISTORY_MEDIA_TYPES[format])
 
 @router.get("/{order_id}", response_model=Union[LimitOrder, MarketOrder])
-def get_order(order_id: str, current_user=Depends(get_current_user), db: Session = Depends(get_db)):
-    lo = db.query(LimitOrderModel).get(order_id)
-    mo = db.query(MarketOrderModel).get(order_id)
-    if not lo and not mo:
+async def get_order(order_id: str, current_user=Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    # Живая заявка читается из книги движка, остальные — async-запросом к SQL
+    row = await cluster.run(live_lookup, order_id)
+    if row is None:
+        row = await stored_order(db, order_id)
+    if row is None:
         raise HTTPException(404, "Order not found")
-    if lo:
-        return LimitOrder(
-            id=lo.id,
-            status=lo.status,
-            user_id=lo.user_id,
-            timestamp=lo.timestamp,
-            filled=lo.filled,
-            body=LimitOrderBody(
-                direction=lo.direction,
-                ticker=lo.ticker,
-                qty=lo.qty,
-                price=lo.price
-            )
-        )
-    if mo:
-        return MarketOrder(
-            id=mo.id,
-            status=mo.status,
-            user_id=mo.user_id,
-            timestamp=mo.timestamp,
-            body=MarketOrderBody(
-                direction=mo.direction,
-                ticker=mo.ticker,
-                qty=mo.qty
-            )
-        )
+    return json_response(order_view, order_schema(row))
 
 @router.delete("/{order_id}", response_model=Ok)
-def cancel_order(order_id: str, current_user=Depends(get_current_user), db: Session = Depends(get_db)):
-    lo = db.query(LimitOrderModel).get(order_id)
-    mo = db.query(MarketOrderModel).get(order_id)
-    if not lo and not mo:
-        raise HTTPException(404, "Order not found")
-    # Нельзя отменить исполненный ордер
-    if lo and lo.status in [OrderStatus.EXECUTED, OrderStatus.PARTIALLY_EXECUTED]:
-        raise HTTPException(400, "Order already executed or cancelled")
-    if mo and mo.status in [OrderStatus.EXECUTED, OrderStatus.PARTIALLY_EXECUTED]:
-        raise HTTPException(400, "Order already executed or cancelled")
-    if lo:
-        lo.status = OrderStatus.CANCELLED
-    if mo:
-        mo.status = OrderStatus.CANCELLED
-    db.commit()
-    return {"success": True}
+async def cancel_order(order_id: str, current_user=Depends(get_current_user)):
+    await cluster.run(cancel_one, order_id, owner_id(current_user))
+    return ORJSONResponse({"success": True})
 
 @router.get("", response_model=List[Union[LimitOrder, MarketOrder]])
-def list_orders(current_user=Depends(get_current_user), db: Session = Depends(get_db)):
-    los = db.query(LimitOrderModel).filter(LimitOrderModel.user_id == current_user.id).all()
-    mos = db.query(MarketOrderModel).filter(MarketOrderModel.user_id == current_user.id).all()
-    result = []
-    for lo in los:
-        result.append(LimitOrder(
-            id=lo.id,
-            status=lo.status,
-            user_id=lo.user_id,
-            timestamp=lo.timestamp,
-            filled=lo.filled,
-            body=LimitOrderBody(
-                direction=lo.direction,
-                ticker=lo.ticker,
-                qty=lo.qty,
-                price=lo.price
-            )
-        ))
-    for mo in mos:
-        result.append(MarketOrder(
-            id=mo.id,
-            status=mo.status,
-            user_id=mo.user_id,
-            timestamp=mo.timestamp,
-            body=MarketOrderBody(
-                direction=mo.direction,
-                ticker=mo.ticker,
-                qty=mo.qty
-            )
-        ))
-    return result 
\ No newline at end of file
+async def list_orders(current_user=Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    return json_response(order_list, [order_schema(row) for row in await user_orders(db, current_user.id)])
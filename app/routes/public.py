@@ -1,60 +1,219 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from app.schemas import NewUser, User, Instrument, L2OrderBook, Level, Transaction
-from app.models import User as UserModel, Instrument as InstrumentModel, LimitOrder, Transaction as TransactionModel, OrderStatus, MarketOrder
-from app.database import get_db
+from datetime import datetime
+from fastapi import APIRouter, Depends, HTTPException, Response, Query
+from fastapi.responses import StreamingResponse, ORJSONResponse
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.schemas import NewUser, User, Instrument, L2OrderBook, Transaction, Candle, TradeStats
+from app.models import User as UserModel, LimitOrder, Transaction as TransactionModel, MarketOrder, Balance
+from app.database import get_async_db
+from app.services.order_book import books
+from app.services.balances import ledger
+from app.services.candles import candles, RESOLUTIONS, to_seconds, from_seconds
+from app.services.archive import archive
+from app.services.journal import journal, to_micros, from_micros, as_stored
+from sqlalchemy import func, select
+from app.services.history import trade_rows, stream_items, HISTORY_MEDIA_TYPES
+from app.services.cluster import cluster
+from app.services.instruments import instruments
+from app.services.snapshots import snapshots
 import uuid
-from collections import defaultdict
-from typing import List
+from contextlib import ExitStack
+from typing import List, Optional
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
 
-@router.post("/register", response_model=User)
-def register(user_in: NewUser, db: Session = Depends(get_db)):
+def create_user(db, name):
+    # Выполняется в процессе движка: вместе с заявками очищается его состояние.
+    # Под блокировками всех книг команды не исполняются, а журнал дожидается
+    # применения к SQL: иначе его пачки вернули бы удалённые заявки и резервы
+    journal.check()
     api_key = f"key-{uuid.uuid4()}"
-    user = UserModel(id=str(uuid.uuid4()), name=user_in.name, api_key=api_key, role="USER")
+    user = UserModel(id=str(uuid.uuid4()), name=name, api_key=api_key, role="USER")
     db.add(user)
-    # Очищаем все ордера при создании пользователя
-    db.query(LimitOrder).delete()
-    db.query(MarketOrder).delete()
-    db.query(TransactionModel).delete()
-    db.commit()
+    with snapshots.lock, books.lock, ExitStack() as stack:
+        for _, book in sorted(books.books.items()):
+            stack.enter_context(book.lock)
+        # Пополнения пишут в журнал под ledger.lock, а применитель его берёт,
+        # поэтому ждём без ledger.lock и проверяем, что новых событий не было
+        while True:
+            journal.drain()
+            ledger.lock.acquire()
+            if journal.idle():
+                break
+            ledger.lock.release()
+        stack.callback(ledger.lock.release)
+        # Очищаем все ордера при создании пользователя
+        db.query(LimitOrder).delete()
+        db.query(MarketOrder).delete()
+        db.query(TransactionModel).delete()
+        # Резервы были под удалённые заявки
+        db.query(Balance).update({Balance.reserved: 0}, synchronize_session=False)
+        db.commit()
+        ledger.load(db)
+        books.reset()
+        candles.clear()
+        archive.clear()
+        snapshots.remove()
     db.refresh(user)
-    return user
+    return {"id": user.id, "name": user.name, "role": user.role, "api_key": user.api_key}
+
+async def orderbook_snapshot(ticker, limit):
+    # Выполняется в цикле событий движка: готовый снимок отдаётся из кеша, а
+    # сборка ждёт book.lock исполнителя тикера и потому идёт в пуле потоков
+    snapshot = books.cached(ticker, limit)
+    if snapshot is None:
+        snapshot = await run_in_threadpool(books.snapshot, ticker, limit)
+    return snapshot
+
+def candle_bars(db, ticker, resolution, since, until, limit):
+    return candles.bars(ticker, resolution, since, until, limit)
+
+def archived_trades(db, ticker, since, until, limit):
+    return archive.trades(ticker, since, until, limit)
+
+def archive_cutover(db, ticker):
+    return archive.cutover(ticker)
+
+def archived_stats(db, ticker, since, until):
+    return archive.stats(ticker, since, until)
+
+@router.post("/register", response_model=User)
+async def register(user_in: NewUser):
+    return await cluster.call(create_user, user_in.name)
 
 @router.get("/instrument", response_model=List[Instrument])
-def list_instruments(db: Session = Depends(get_db)):
-    return db.query(InstrumentModel).all()
+async def list_instruments():
+    # Готовый JSON справочника в памяти
+    return Response(content=instruments.listing, media_type="application/json")
 
 @router.get("/orderbook/{ticker}", response_model=L2OrderBook)
-def get_orderbook(ticker: str, limit: int = 10, db: Session = Depends(get_db)):
+async def get_orderbook(ticker: str, limit: int = 10):
     if limit > 25:
         limit = 25
-    active_orders = db.query(LimitOrder).filter(
-        LimitOrder.ticker == ticker,
-        LimitOrder.status.in_([OrderStatus.NEW, OrderStatus.PARTIALLY_EXECUTED])
-    ).all()
-    bids = defaultdict(int)
-    asks = defaultdict(int)
-    for order in active_orders:
-        remaining_qty = order.qty - order.filled
-        if remaining_qty <= 0:
-            continue
-        if order.direction == "BUY":
-            bids[order.price] += remaining_qty
-        else:
-            asks[order.price] += remaining_qty
-    bid_levels = [Level(price=price, qty=qty) for price, qty in sorted(bids.items(), reverse=True)[:limit]]
-    ask_levels = [Level(price=price, qty=qty) for price, qty in sorted(asks.items())[:limit]]
-    return L2OrderBook(bid_levels=bid_levels, ask_levels=ask_levels)
+    # Снимок собирается из агрегатов книги в памяти и кешируется до её изменения
+    return Response(content=await cluster.run(orderbook_snapshot, ticker, limit), media_type="application/json")
 
 @router.get("/transactions/{ticker}", response_model=List[Transaction])
-def get_transaction_history(ticker: str, limit: int = 10, db: Session = Depends(get_db)):
+async def get_transaction_history(ticker: str, limit: int = 10, db: AsyncSession = Depends(get_async_db)):
     if limit > 100:
         limit = 100
     # Проверяем существование инструмента
-    instrument = db.query(InstrumentModel).get(ticker)
-    if not instrument:
+    if not instruments.exists(ticker):
         return []  # Возвращаем пустой список вместо ошибки
-    transactions = db.query(TransactionModel).filter(TransactionModel.ticker == ticker).order_by(TransactionModel.timestamp.desc()).limit(limit).all()
-    return transactions 
\ No newline at end of file
+    # Только нужные колонки: запрос целиком обслуживается покрывающим индексом
+    transactions = (await db.execute(select(
+        TransactionModel.ticker, TransactionModel.amount, TransactionModel.price, TransactionModel.timestamp
+    ).where(TransactionModel.ticker == ticker).order_by(TransactionModel.timestamp.desc()).limit(limit))).all()
+    if len(transactions) < limit:
+        # Горячая таблица исчерпана: более старые сделки — из архива (в процессе
+        # движка). Архив строго старше строк transactions, кроме не удалённых
+        # после сбоя архиватора: они отсекаются по времени последней строки
+        archived = await cluster.call(
+            archived_trades, ticker, None,
+            to_micros(transactions[-1].timestamp) if transactions else None,
+            limit - len(transactions)
+        )
+        transactions += [
+            {"ticker": ticker, "amount": amount, "price": price, "timestamp": as_stored(from_micros(ts))}
+            for ts, price, amount in archived
+        ]
+    return transactions
+
+@router.get("/transactions/{ticker}/history")
+async def get_transaction_history_page(
+    ticker: str,
+    after: Optional[str] = None,
+    limit: int = 100,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    format: str = Query("ndjson", pattern="^(ndjson|json)$"),
+    db: AsyncSession = Depends(get_async_db)
+):
+    # Постраничная лента сделок: after — id последней полученной сделки
+    items = await trade_rows(db, ticker, after, limit, since, until, cutover=lambda ticker: cluster.call(archive_cutover, ticker))
+    return StreamingResponse(stream_items(items, format), media_type=HISTORY_MEDIA_TYPES[format])
+
+@router.get("/candles/{ticker}", response_model=List[Candle])
+async def get_candles(
+    ticker: str,
+    resolution: str = Query("1m", pattern="^(" + "|".join(RESOLUTIONS) + ")$"),
+    limit: int = 100,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+):
+    if limit > 1000:
+        limit = 1000
+    # Свечи в памяти, старые первыми; интервалы без сделок пропускаются
+    bars = await cluster.call(
+        candle_bars, ticker, resolution,
+        to_seconds(since) if since is not None else None,
+        to_seconds(until) if until is not None else None,
+        limit
+    )
+    return [
+        {"timestamp": from_seconds(start), "open": o, "high": h, "low": l, "close": c, "volume": v}
+        for start, o, h, l, c, v in bars
+    ]
+
+@router.get("/transactions/{ticker}/archive", response_model=List[Transaction])
+async def get_archived_transactions(
+    ticker: str,
+    limit: int = 100,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+):
+    if limit > 1000:
+        limit = 1000
+    # Сделки, перенесённые из transactions в колоночный архив, новые первыми
+    trades = await cluster.call(
+        archived_trades, ticker,
+        to_micros(since) if since is not None else None,
+        to_micros(until) if until is not None else None,
+        limit
+    )
+    return [
+        {"ticker": ticker, "amount": amount, "price": price, "timestamp": from_micros(ts)}
+        for ts, price, amount in trades
+    ]
+
+async def trade_stats(db, ticker, since, until, archived):
+    count, volume, turnover, high, low = archived
+    query = select(
+        func.count(), func.sum(TransactionModel.amount), func.sum(TransactionModel.amount * TransactionModel.price),
+        func.max(TransactionModel.price), func.min(TransactionModel.price)
+    ).where(TransactionModel.ticker == ticker)
+    if since is not None:
+        query = query.where(TransactionModel.timestamp >= as_stored(since))
+    if until is not None:
+        query = query.where(TransactionModel.timestamp < as_stored(until))
+    hot_count, hot_volume, hot_turnover, hot_high, hot_low = (await db.execute(query)).one()
+    count += hot_count
+    volume += hot_volume or 0
+    turnover += hot_turnover or 0
+    high = max(price for price in (high, hot_high) if price is not None) if count else None
+    low = min(price for price in (low, hot_low) if price is not None) if count else None
+    return {
+        "ticker": ticker,
+        "count": count,
+        "volume": volume,
+        "turnover": turnover,
+        "vwap": turnover / volume if volume else None,
+        "high": high,
+        "low": low,
+    }
+
+@router.get("/stats/{ticker}", response_model=TradeStats)
+async def get_trade_stats(
+    ticker: str,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    db: AsyncSession = Depends(get_async_db)
+):
+    # Агрегаты за [since, until): архив считается векторно по mmap-колонкам
+    # (в процессе движка), свежие сделки — одним агрегирующим запросом к transactions
+    archived = await cluster.call(
+        archived_stats, ticker,
+        to_micros(since) if since is not None else None,
+        to_micros(until) if until is not None else None
+    )
+    return await trade_stats(db, ticker, since, until, archived)
@@ -1,13 +1,14 @@
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from pydantic import BaseModel, Field, PlainSerializer, TypeAdapter
+from pydantic_core import core_schema
+from typing import Annotated, List, Optional, Union
 from enum import Enum
 from datetime import datetime, timezone
 
-class MyBaseModel(BaseModel):
-    class Config:
-        json_encoders = {
-            datetime: lambda v: v.astimezone(timezone.utc).isoformat()
-        }
+# Время в JSON-ответах — ISO 8601 в UTC
+UtcDatetime = Annotated[
+    datetime,
+    PlainSerializer(lambda v: v.astimezone(timezone.utc).isoformat(), return_type=str, when_used="json")
+]
 
 class UserRole(str, Enum):
     USER = "USER"
@@ -23,70 +24,133 @@ class Direction(str, Enum):
     BUY = "BUY"
     SELL = "SELL"
 
-class NewUser(MyBaseModel):
+class TimeInForce(str, Enum):
+    # GTC — остаток встаёт в книгу; IOC — исполняется что возможно, остаток
+    # снимается; FOK — только полное немедленное исполнение
+    GTC = "GTC"
+    IOC = "IOC"
+    FOK = "FOK"
+
+class NewUser(BaseModel):
     name: str = Field(..., min_length=3)
 
-class User(MyBaseModel):
+class User(BaseModel):
     id: str
     name: str
     role: UserRole
     api_key: str
 
-class Instrument(MyBaseModel):
+class Instrument(BaseModel):
     name: str
     ticker: str = Field(..., pattern=r"^[A-Z]{2,10}$")
 
-class Level(MyBaseModel):
+class Level(BaseModel):
     price: int
     qty: int
 
-class L2OrderBook(MyBaseModel):
+class L2OrderBook(BaseModel):
     bid_levels: List[Level]
     ask_levels: List[Level]
 
-class LimitOrderBody(MyBaseModel):
+class LimitOrderBody(BaseModel):
     direction: Direction
     ticker: str
     qty: int = Field(..., ge=1)
     price: int = Field(..., gt=0)
+    time_in_force: TimeInForce = TimeInForce.GTC
+    # Только встать в книгу: заявка, которая исполнилась бы сразу, отклоняется
+    post_only: bool = False
 
-class MarketOrderBody(MyBaseModel):
+class MarketOrderBody(BaseModel):
     direction: Direction
     ticker: str
     qty: int = Field(..., ge=1)
 
-class LimitOrder(MyBaseModel):
+def order_kind(value):
+    # Лимитная заявка — тело с полем price, иначе рыночная
+    if not isinstance(value, dict):
+        return None
+    return "LIMIT" if "price" in value else "MARKET"
+
+class OrderBody:
+    # Тело POST /order: объединение с дискриминатором order_kind, разбирается
+    # из сырого JSON за один проход (order_body.validate_json)
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source, handler):
+        return core_schema.tagged_union_schema(
+            {"LIMIT": handler(LimitOrderBody), "MARKET": handler(MarketOrderBody)},
+            discriminator=order_kind,
+            custom_error_type="invalid_order",
+            custom_error_message="Order body must be a JSON object",
+        )
+
+class LimitOrder(BaseModel):
     id: str
     status: OrderStatus
     user_id: str
-    timestamp: datetime
+    timestamp: UtcDatetime
     body: LimitOrderBody
     filled: int = 0
 
-class MarketOrder(MyBaseModel):
+class MarketOrder(BaseModel):
     id: str
     status: OrderStatus
     user_id: str
-    timestamp: datetime
+    timestamp: UtcDatetime
     body: MarketOrderBody
 
-class CreateOrderResponse(MyBaseModel):
+class CreateOrderResponse(BaseModel):
     success: bool = True
     order_id: str
 
-class Ok(MyBaseModel):
+class Ok(BaseModel):
     success: bool = True
 
-class Transaction(MyBaseModel):
+class BatchCancelBody(BaseModel):
+    order_ids: List[str] = Field(..., min_length=1)
+    atomic: bool = False
+
+class BatchItemResult(BaseModel):
+    success: bool = True
+    order_id: Optional[str] = None
+    error: Optional[str] = None
+
+class BatchResponse(BaseModel):
+    success: bool = True
+    results: List[BatchItemResult]
+
+class Transaction(BaseModel):
     ticker: str
     amount: int
     price: int
-    timestamp: datetime
+    timestamp: UtcDatetime
+
+class Candle(BaseModel):
+    timestamp: UtcDatetime
+    open: int
+    high: int
+    low: int
+    close: int
+    volume: int
 
-class ValidationError(MyBaseModel):
+class TradeStats(BaseModel):
+    ticker: str
+    count: int
+    volume: int
+    turnover: int
+    vwap: Optional[float] = None
+    high: Optional[int] = None
+    low: Optional[int] = None
+
+class ValidationError(BaseModel):
     loc: list
     msg: str
     type: str
 
-class HTTPValidationError(MyBaseModel):
-    detail: List[ValidationError] 
\ No newline at end of file
+class HTTPValidationError(BaseModel):
+    detail: List[ValidationError] 
+
+# Валидаторы и сериализаторы собираются один раз при импорте
+order_body = TypeAdapter(OrderBody)
+order_view = TypeAdapter(Union[LimitOrder, MarketOrder])
+order_list = TypeAdapter(List[Union[LimitOrder, MarketOrder]])
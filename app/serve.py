@@ -0,0 +1,88 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+# Многопроцессный запуск: процесс движка (книги, балансы, журнал — см.
+# app.services.cluster) и uvicorn с --workers HTTP-воркерами, которые
+# передают ему команды по Unix-сокету.
+#
+#   python -m app.serve --host 0.0.0.0 --port 80 --workers 4
+#
+# Модули app импортируются только внутри функций: процесс движка запускается
+# через spawn и не должен видеть EXCHANGE_ENGINE_SOCKET воркеров
+
+ENGINE_START_TIMEOUT = 120
+
+
+def run_engine(path):
+    os.environ.pop("EXCHANGE_ENGINE_SOCKET", None)
+    asyncio.run(serve_engine(path))
+
+
+async def serve_engine(path):
+    from app.main import open_engine, close_engine, configure_threadpool
+    from app.services.cluster import EngineServer
+    from app.services.logs import logs
+    logs.start()
+    configure_threadpool()
+    open_engine()
+    server = EngineServer(path)
+    await server.start()
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopped.set)
+    try:
+        await stopped.wait()
+    finally:
+        # Сначала перестаём принимать команды, затем дописываем журнал
+        await server.stop()
+        await close_engine()
+        logs.stop()
+
+
+def wait_for_socket(path, process):
+    deadline = time.monotonic() + ENGINE_START_TIMEOUT
+    while True:
+        if not process.is_alive():
+            raise SystemExit("matching engine exited during startup")
+        try:
+            with socket.socket(socket.AF_UNIX) as s:
+                s.connect(path)
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise SystemExit("matching engine did not start")
+            time.sleep(0.1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.serve", description="Run HTTP workers and the matching engine")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WORKERS", "0")) or os.cpu_count(),
+                        help="число HTTP-воркеров (по умолчанию WORKERS или число ядер)")
+    parser.add_argument("--socket", default=os.getenv("ENGINE_SOCKET_PATH", "./engine.sock"),
+                        help="Unix-сокет движка")
+    args = parser.parse_args(argv)
+    path = os.path.abspath(args.socket)
+
+    engine = multiprocessing.get_context("spawn").Process(target=run_engine, args=(path,), name="matching-engine")
+    engine.start()
+    try:
+        wait_for_socket(path, engine)
+        import uvicorn
+        os.environ["EXCHANGE_ENGINE_SOCKET"] = path
+        uvicorn.run("app.main:app", host=args.host, port=args.port, workers=args.workers)
+    finally:
+        # Воркеры уже остановлены: движок дописывает журнал и выходит
+        engine.terminate()
+        engine.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+import json
+import os
+import shutil
+import threading
+from datetime import datetime, timezone, timedelta
+import numpy as np
+from sqlalchemy import select, delete, distinct
+from app.database import SessionLocal
+from app.models import Transaction as TransactionModel
+from app.services import logs
+from app.services.journal import as_stored, to_micros, from_micros
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "./archive")
+# Сделки старше этого срока переносятся из transactions в архив
+HOT_TRADES_SECONDS = int(os.getenv("HOT_TRADES_SECONDS", str(7 * 86400)))
+ARCHIVE_INTERVAL_SECONDS = int(os.getenv("ARCHIVE_INTERVAL_SECONDS", "3600"))
+
+# Колонки архива тикера: по файлу фиксированной ширины на колонку.
+# Время — микросекунды от эпохи (UTC), buyer/seller — номера в users.txt
+COLUMNS = {
+    "timestamp": np.dtype("<i8"),
+    "price": np.dtype("<i8"),
+    "amount": np.dtype("<i8"),
+    "buyer": np.dtype("<i4"),
+    "seller": np.dtype("<i4"),
+}
+
+def fsync_write(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class TickerArchive:
+    # Архив одного тикера. Число строк — в meta.json: файлы колонок дописываются
+    # до записи meta, поэтому хвост после падения посреди дописывания не виден
+    # и отрезается при следующем дописывании
+    def __init__(self, path):
+        self.path = path
+        self.rows = 0
+        # Граница времени, до которой сделки тикера уже в архиве
+        self.archived_until = 0
+        self.view = None
+        meta = os.path.join(path, "meta.json")
+        if os.path.exists(meta):
+            with open(meta) as f:
+                data = json.load(f)
+            self.rows = data["rows"]
+            self.archived_until = data["archived_until"]
+
+    def append(self, columns, archived_until):
+        os.makedirs(self.path, exist_ok=True)
+        count = len(columns["timestamp"])
+        for name, dtype in COLUMNS.items():
+            path = os.path.join(self.path, name)
+            with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+                f.truncate(self.rows * dtype.itemsize)
+                f.seek(0, os.SEEK_END)
+                f.write(np.asarray(columns[name], dtype=dtype).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        fsync_write(os.path.join(self.path, "meta.json"), json.dumps({"rows": self.rows + count, "archived_until": archived_until}))
+        self.rows += count
+        self.archived_until = archived_until
+        self.view = None
+
+    def columns(self):
+        # Колонки через mmap; пересоздаются только после дописывания
+        view = self.view
+        if view is None:
+            if self.rows:
+                view = {
+                    name: np.memmap(os.path.join(self.path, name), dtype=dtype, mode="r", shape=(self.rows,))
+                    for name, dtype in COLUMNS.items()
+                }
+            else:
+                view = {name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+            self.view = view
+        return view
+
+    def span(self, since=None, until=None):
+        # Сделки упорядочены по времени: границы диапазона — двоичным поиском
+        timestamps = self.columns()["timestamp"]
+        lo = 0 if since is None else int(np.searchsorted(timestamps, since, side="left"))
+        hi = len(timestamps) if until is None else int(np.searchsorted(timestamps, until, side="left"))
+        return lo, max(lo, hi)
+
+
+class TradeArchive:
+    # Колоночный архив рассчитанных сделок: transactions держит только свежие
+    # сделки, старые переносятся сюда пачкой на тикер
+    def __init__(self, path=ARCHIVE_DIR, session_factory=SessionLocal):
+        self.path = path
+        self.session_factory = session_factory
+        self.lock = threading.RLock()
+        self.tickers = {}
+        self.users = []
+        self.user_index = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def open(self):
+        with self.lock:
+            self.tickers = {}
+            self.users = []
+            self.user_index = {}
+            users = os.path.join(self.path, "users.txt")
+            if os.path.exists(users):
+                with open(users) as f:
+                    for line in f:
+                        if line.endswith("\n"):
+                            self._remember_user(line[:-1])
+            if os.path.isdir(self.path):
+                for ticker in os.listdir(self.path):
+                    if os.path.isdir(os.path.join(self.path, ticker)):
+                        self.tickers[ticker] = TickerArchive(os.path.join(self.path, ticker))
+
+    def _remember_user(self, user_id):
+        self.user_index[user_id] = len(self.users)
+        self.users.append(user_id)
+
+    def _user_numbers(self, user_ids):
+        # Новые пользователи дописываются в users.txt до колонок, которые на них ссылаются
+        new = []
+        for user_id in user_ids:
+            if user_id not in self.user_index:
+                self._remember_user(user_id)
+                new.append(user_id)
+        if new:
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, "users.txt"), "a") as f:
+                f.write("".join(user_id + "\n" for user_id in new))
+                f.flush()
+                os.fsync(f.fileno())
+        return [self.user_index[user_id] for user_id in user_ids]
+
+    def ticker(self, ticker):
+        archive = self.tickers.get(ticker)
+        if archive is None:
+            archive = self.tickers[ticker] = TickerArchive(os.path.join(self.path, ticker))
+        return archive
+
+    def run(self, db, cutoff):
+        # Перенос сделок старше cutoff (datetime UTC) из transactions в архив.
+        # Порядок: колонки, meta, удаление из SQL — после падения между ними
+        # уже заархивированные строки только удаляются, повторно не пишутся
+        cutoff = as_stored(cutoff)
+        cutoff_micros = to_micros(cutoff)
+        moved = {}
+        with self.lock:
+            tickers = [ticker for (ticker,) in db.execute(
+                select(distinct(TransactionModel.ticker)).where(TransactionModel.timestamp < cutoff)
+            )]
+            for ticker in tickers:
+                archive = self.ticker(ticker)
+                done = as_stored(from_micros(archive.archived_until))
+                db.execute(delete(TransactionModel).where(
+                    TransactionModel.ticker == ticker, TransactionModel.timestamp < done
+                ).execution_options(synchronize_session=False))
+                rows = db.execute(select(
+                    TransactionModel.timestamp, TransactionModel.price, TransactionModel.amount,
+                    TransactionModel.buyer_id, TransactionModel.seller_id
+                ).where(
+                    TransactionModel.ticker == ticker, TransactionModel.timestamp < cutoff
+                ).order_by(TransactionModel.timestamp, TransactionModel.id)).all()
+                if rows:
+                    archive.append({
+                        "timestamp": [to_micros(row.timestamp) for row in rows],
+                        "price": [row.price for row in rows],
+                        "amount": [row.amount for row in rows],
+                        "buyer": self._user_numbers([row.buyer_id for row in rows]),
+                        "seller": self._user_numbers([row.seller_id for row in rows]),
+                    }, max(cutoff_micros, archive.archived_until))
+                db.execute(delete(TransactionModel).where(
+                    TransactionModel.ticker == ticker, TransactionModel.timestamp < cutoff
+                ).execution_options(synchronize_session=False))
+                db.commit()
+                moved[ticker] = len(rows)
+        return moved
+
+    def trades(self, ticker, since=None, until=None, limit=100):
+        # Последние limit сделок диапазона [since, until) в микросекундах, новые первыми
+        with self.lock:
+            archive = self.tickers.get(ticker)
+            if archive is None:
+                return []
+            lo, hi = archive.span(since, until)
+            lo = max(lo, hi - limit)
+            columns = archive.columns()
+            timestamps = columns["timestamp"][lo:hi][::-1].tolist()
+            prices = columns["price"][lo:hi][::-1].tolist()
+            amounts = columns["amount"][lo:hi][::-1].tolist()
+        return list(zip(timestamps, prices, amounts))
+
+    def stats(self, ticker, since=None, until=None):
+        # Агрегаты по архиву: число сделок, объём, оборот, максимум и минимум цены
+        with self.lock:
+            archive = self.tickers.get(ticker)
+            if archive is None:
+                return 0, 0, 0, None, None
+            lo, hi = archive.span(since, until)
+            if lo == hi:
+                return 0, 0, 0, None, None
+            columns = archive.columns()
+            prices = columns["price"][lo:hi]
+            amounts = columns["amount"][lo:hi]
+            return (
+                hi - lo,
+                int(amounts.sum()),
+                int(np.dot(prices, amounts)),
+                int(prices.max()),
+                int(prices.min()),
+            )
+
+    def rollup(self, ticker, resolution, capacity):
+        # Свечи последних capacity интервалов архива: начало, open, high, low, close, volume
+        with self.lock:
+            archive = self.tickers.get(ticker)
+            if archive is None or not archive.rows:
+                return None
+            columns = archive.columns()
+            seconds = columns["timestamp"] // 1_000_000
+            buckets = seconds - seconds % resolution
+            lo = int(np.searchsorted(buckets, buckets[-1] - (capacity - 1) * resolution, side="left"))
+            buckets = buckets[lo:]
+            prices = np.asarray(columns["price"][lo:])
+            amounts = np.asarray(columns["amount"][lo:])
+            starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+            ends = np.r_[starts[1:], len(buckets)] - 1
+            return (
+                buckets[starts],
+                prices[starts],
+                np.maximum.reduceat(prices, starts),
+                np.minimum.reduceat(prices, starts),
+                prices[ends],
+                np.add.reduceat(amounts, starts),
+            )
+
+    def cutover(self, ticker):
+        # Граница архива тикера в микросекундах: сделки раньше неё уже не в
+        # transactions; 0 — архива нет
+        with self.lock:
+            archive = self.tickers.get(ticker)
+            return archive.archived_until if archive is not None else 0
+
+    def archived_tickers(self):
+        with self.lock:
+            return [ticker for ticker, archive in self.tickers.items() if archive.rows]
+
+    def clear(self):
+        with self.lock:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.tickers = {}
+            self.users = []
+            self.user_index = {}
+
+    def start(self, interval=ARCHIVE_INTERVAL_SECONDS, retention=HOT_TRADES_SECONDS):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._loop, args=(interval, retention), name="trade-archiver", daemon=True)
+        self.thread.start()
+
+    def _loop(self, interval, retention):
+        while not self.stop_event.wait(interval):
+            db = self.session_factory()
+            try:
+                self.run(db, datetime.now(timezone.utc) - timedelta(seconds=retention))
+            except Exception:
+                db.rollback()
+                logs.error("archive_failed")
+            finally:
+                db.close()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+archive = TradeArchive()
@@ -0,0 +1,219 @@
+import threading
+from collections import defaultdict
+from fastapi import HTTPException
+from sqlalchemy import update, insert, select, bindparam, tuple_
+from app.models import Balance
+
+
+def trade_deltas(ticker, buyer_id, seller_id, qty, price):
+    return [
+        ((buyer_id, "RUB"), -qty * price),
+        ((buyer_id, ticker), qty),
+        ((seller_id, "RUB"), qty * price),
+        ((seller_id, ticker), -qty),
+    ]
+
+
+def hold_delta(user_id, ticker, direction, price, qty):
+    # Резерв лимитной заявки на qty лотов: BUY держит рубли по цене заявки, SELL — сами лоты
+    if direction == "BUY":
+        return (user_id, "RUB"), qty * price
+    return (user_id, ticker), qty
+
+
+def net_deltas(deltas):
+    netted = defaultdict(int)
+    for key, delta in deltas:
+        netted[key] += delta
+    return netted
+
+
+def write_balance_deltas(db, netted, netted_holds):
+    # Неттированные изменения всех затронутых балансов: выборка существующих
+    # строк, затем один INSERT и один UPDATE (executemany) на всю пачку
+    keys = [key for key in set(netted) | set(netted_holds) if netted.get(key) or netted_holds.get(key)]
+    if not keys:
+        return
+    table = Balance.__table__
+    conn = db.connection()
+    existing = set(conn.execute(
+        select(table.c.user_id, table.c.ticker).where(tuple_(table.c.user_id, table.c.ticker).in_(keys))
+    ).all())
+    rows = [{
+        "b_user": user_id,
+        "b_ticker": ticker,
+        "b_amount": netted.get((user_id, ticker), 0),
+        "b_reserved": netted_holds.get((user_id, ticker), 0),
+    } for user_id, ticker in keys]
+    updates = [row for row in rows if (row["b_user"], row["b_ticker"]) in existing]
+    inserts = [{
+        "user_id": row["b_user"], "ticker": row["b_ticker"], "amount": row["b_amount"], "reserved": row["b_reserved"]
+    } for row in rows if (row["b_user"], row["b_ticker"]) not in existing]
+    if updates:
+        conn.execute(
+            update(table)
+            .where(table.c.user_id == bindparam("b_user"), table.c.ticker == bindparam("b_ticker"))
+            .values(amount=table.c.amount + bindparam("b_amount"), reserved=table.c.reserved + bindparam("b_reserved")),
+            updates
+        )
+    if inserts:
+        conn.execute(insert(table), inserts)
+
+
+class BalanceLedger:
+    # Балансы в памяти движка — источник истины, пока процесс работает: проверки
+    # приёма и расчёты по сделкам — операции со словарями. stored — то, что уже
+    # закоммичено в balances ({user_id: {ticker: (amount, reserved)}}), pending —
+    # изменения, принятые в журнал, но ещё не применённые к SQL. Применитель
+    # журнала пишет их в balances пачками (неттированно, см. write_balance_deltas)
+    # и сразу после коммита переносит из pending в stored.
+    # Доступно = amount - reserved; резерв ставится при приёме лимитной заявки
+    # и снимается при её исполнении или отмене. pending_tickers — тикеры
+    # пользователя, по которым могут быть записи в pending (с запасом)
+    def __init__(self):
+        self.stored = {}
+        self.pending = defaultdict(int)
+        self.pending_reserved = defaultdict(int)
+        self.pending_tickers = defaultdict(set)
+        self.lock = threading.RLock()
+
+    def load(self, db):
+        # При старте, после доигрывания журнала: SQL совпадает с журналом
+        stored = defaultdict(dict)
+        for row in db.execute(select(Balance.user_id, Balance.ticker, Balance.amount, Balance.reserved)):
+            stored[row.user_id][row.ticker] = (row.amount or 0, row.reserved or 0)
+        with self.lock:
+            self.stored = dict(stored)
+            self.pending.clear()
+            self.pending_reserved.clear()
+            self.pending_tickers.clear()
+
+    def _stored(self, user_id, ticker):
+        return self.stored.get(user_id, {}).get(ticker, (0, 0))
+
+    def get(self, user_id, ticker):
+        with self.lock:
+            amount, _ = self._stored(user_id, ticker)
+            return amount + self.pending.get((user_id, ticker), 0)
+
+    def available(self, user_id, ticker):
+        key = (user_id, ticker)
+        with self.lock:
+            amount, reserved = self._stored(user_id, ticker)
+            return amount + self.pending.get(key, 0) - reserved - self.pending_reserved.get(key, 0)
+
+    def user_balances(self, user_id):
+        # {ticker: amount} по всем счетам пользователя, как строки balances после применения журнала
+        with self.lock:
+            result = {ticker: amount for ticker, (amount, _) in self.stored.get(user_id, {}).items()}
+            for ticker in self.pending_tickers.get(user_id, ()):
+                key = (user_id, ticker)
+                delta = self.pending.get(key, 0)
+                if delta:
+                    result[ticker] = result.get(ticker, 0) + delta
+                elif self.pending_reserved.get(key):
+                    # Счёт, на котором пока есть только резерв, после применения — строка с нулём
+                    result.setdefault(ticker, 0)
+            return result
+
+    def apply(self, deltas, holds=()):
+        # Проверяем и проводим все изменения разом: доступный остаток не уходит в минус.
+        # Сделка по зарезервированной заявке снимает резерв, поэтому всегда проходит
+        netted = net_deltas(deltas)
+        netted_holds = net_deltas(holds)
+        with self.lock:
+            for key in set(netted) | set(netted_holds):
+                change = netted.get(key, 0) - netted_holds.get(key, 0)
+                if change < 0 and self.available(*key) + change < 0:
+                    raise HTTPException(400, "Insufficient balance")
+            for key, delta in netted.items():
+                self.pending[key] += delta
+                self.pending_tickers[key[0]].add(key[1])
+            for key, delta in netted_holds.items():
+                self.pending_reserved[key] += delta
+                self.pending_tickers[key[0]].add(key[1])
+
+    def checkpoint(self):
+        # Состояние pending для отката пачки; вызывающий держит self.lock до rollback
+        return dict(self.pending), dict(self.pending_reserved)
+
+    def rollback(self, checkpoint):
+        pending, pending_reserved = checkpoint
+        self.pending = defaultdict(int, pending)
+        self.pending_reserved = defaultdict(int, pending_reserved)
+
+    def release(self, netted, netted_holds):
+        # Вызывается применителем журнала сразу после коммита в balances
+        with self.lock:
+            for key in set(netted) | set(netted_holds):
+                if not (netted.get(key) or netted_holds.get(key)):
+                    continue
+                user_id, ticker = key
+                amount, reserved = self._stored(user_id, ticker)
+                self.stored.setdefault(user_id, {})[ticker] = (amount + netted.get(key, 0), reserved + netted_holds.get(key, 0))
+            for pending, changes in ((self.pending, netted), (self.pending_reserved, netted_holds)):
+                for key, delta in changes.items():
+                    left = pending.get(key, 0) - delta
+                    if left:
+                        pending[key] = left
+                    else:
+                        pending.pop(key, None)
+            for key in set(netted) | set(netted_holds):
+                if key not in self.pending and key not in self.pending_reserved:
+                    tickers = self.pending_tickers.get(key[0])
+                    if tickers is not None:
+                        tickers.discard(key[1])
+                        if not tickers:
+                            del self.pending_tickers[key[0]]
+
+    def withdraw(self, user_id, ticker, amount):
+        # Вызывающий держит self.lock и сразу пишет списание в журнал. Зачисления
+        # и снятия резерва, ещё не применённые к SQL, не учитываем: их события
+        # могут оказаться в журнале позже списания и не пережить падение
+        key = (user_id, ticker)
+        with self.lock:
+            stored, reserved = self._stored(user_id, ticker)
+            available = stored + min(self.pending.get(key, 0), 0) - reserved - max(self.pending_reserved.get(key, 0), 0)
+            if available < amount:
+                raise HTTPException(400, "Insufficient balance")
+            self.pending[key] -= amount
+            self.pending_tickers[user_id].add(ticker)
+
+    def deposit(self, user_id, ticker, amount):
+        # Вызывающий держит self.lock и сразу пишет зачисление в журнал: команды,
+        # которые им воспользуются, попадут в журнал после него
+        with self.lock:
+            self.pending[(user_id, ticker)] += amount
+            self.pending_tickers[user_id].add(ticker)
+
+    def clear(self):
+        with self.lock:
+            self.pending.clear()
+            self.pending_reserved.clear()
+            self.pending_tickers.clear()
+
+
+class MemoryLedger(BalanceLedger):
+    # Балансы без SQL для офлайн-прогона (bench.replay): stored — начальные
+    # остатки {(user_id, ticker): amount}, всё принятое копится в pending
+    def __init__(self, balances=None):
+        super().__init__()
+        for (user_id, ticker), amount in (balances or {}).items():
+            self.stored.setdefault(user_id, {})[ticker] = (amount, 0)
+
+    def balances(self):
+        # {(user_id, ticker): (amount, reserved)} по всем ненулевым остаткам
+        with self.lock:
+            keys = {(user_id, ticker) for user_id, tickers in self.stored.items() for ticker in tickers}
+            keys |= set(self.pending) | set(self.pending_reserved)
+            result = {}
+            for key in keys:
+                amount, reserved = self._stored(*key)
+                amount += self.pending.get(key, 0)
+                reserved += self.pending_reserved.get(key, 0)
+                if amount or reserved:
+                    result[key] = (amount, reserved)
+            return result
+
+
+ledger = BalanceLedger()
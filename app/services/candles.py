@@ -0,0 +1,146 @@
+import threading
+from array import array
+from datetime import datetime, timezone
+from sqlalchemy import select
+from app.models import Transaction as TransactionModel
+from app.services.archive import archive
+from app.services.journal import to_micros
+
+# Разрешение -> (длина свечи в секундах, сколько последних свечей хранится)
+RESOLUTIONS = {
+    "1s": (1, 3600),
+    "1m": (60, 1440),
+    "1h": (3600, 24 * 90),
+    "1d": (86400, 3650),
+}
+EMPTY = -1
+
+
+class CandleSeries:
+    # Кольцевой буфер свечей одного разрешения в массивах int64: свеча с началом
+    # bucket лежит в ячейке (bucket / resolution) % capacity. Пустые интервалы
+    # не хранятся: ячейка с чужим началом считается пустой
+    __slots__ = ("resolution", "capacity", "start", "open", "high", "low", "close", "volume", "last")
+
+    def __init__(self, resolution, capacity):
+        self.resolution = resolution
+        self.capacity = capacity
+        self.start = array("q", [EMPTY]) * capacity
+        self.open = array("q", [0]) * capacity
+        self.high = array("q", [0]) * capacity
+        self.low = array("q", [0]) * capacity
+        self.close = array("q", [0]) * capacity
+        self.volume = array("q", [0]) * capacity
+        self.last = EMPTY
+
+    def add(self, ts, price, qty):
+        # ts — секунды от эпохи; сделки приходят в порядке времени
+        bucket = ts - ts % self.resolution
+        i = (bucket // self.resolution) % self.capacity
+        current = self.start[i]
+        if current == bucket:
+            if price > self.high[i]:
+                self.high[i] = price
+            if price < self.low[i]:
+                self.low[i] = price
+            self.close[i] = price
+            self.volume[i] += qty
+        elif current < bucket:
+            self.start[i] = bucket
+            self.open[i] = self.high[i] = self.low[i] = self.close[i] = price
+            self.volume[i] = qty
+            if bucket > self.last:
+                self.last = bucket
+        # Иначе ячейку уже заняла более новая свеча: сделка старше окна буфера
+
+    def load_bars(self, starts, opens, highs, lows, closes, volumes):
+        # Готовые свечи (из архива), в порядке времени
+        for bucket, o, h, l, c, v in zip(starts.tolist(), opens.tolist(), highs.tolist(), lows.tolist(), closes.tolist(), volumes.tolist()):
+            i = (bucket // self.resolution) % self.capacity
+            self.start[i] = bucket
+            self.open[i], self.high[i], self.low[i], self.close[i], self.volume[i] = o, h, l, c, v
+            if bucket > self.last:
+                self.last = bucket
+
+    def bars(self, since=None, until=None, limit=100):
+        # Последние limit свечей в [since, until), старые первыми
+        if self.last == EMPTY:
+            return []
+        bucket = self.last
+        if until is not None and until <= bucket:
+            bucket = until - 1 - (until - 1) % self.resolution
+        oldest = self.last - (self.capacity - 1) * self.resolution
+        if since is not None:
+            oldest = max(oldest, -(-since // self.resolution) * self.resolution)
+        result = []
+        while bucket >= oldest and len(result) < limit:
+            i = (bucket // self.resolution) % self.capacity
+            if self.start[i] == bucket:
+                result.append((bucket, self.open[i], self.high[i], self.low[i], self.close[i], self.volume[i]))
+            bucket -= self.resolution
+        result.reverse()
+        return result
+
+
+class CandleStore:
+    # Свечи всех тикеров; пополняются применителем журнала сделками, уже
+    # записанными в transactions, при старте строятся из этой таблицы
+    def __init__(self):
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def _ticker_series(self, ticker):
+        series = self.series.get(ticker)
+        if series is None:
+            series = self.series[ticker] = {
+                name: CandleSeries(resolution, capacity) for name, (resolution, capacity) in RESOLUTIONS.items()
+            }
+        return series
+
+    def add(self, ticker, ts, price, qty):
+        with self.lock:
+            for series in self._ticker_series(ticker).values():
+                series.add(ts, price, qty)
+
+    def add_fills(self, fills):
+        with self.lock:
+            for fill in fills:
+                ts = fill.timestamp // 1_000_000
+                for series in self._ticker_series(fill.ticker).values():
+                    series.add(ts, fill.price, fill.qty)
+
+    def bars(self, ticker, resolution, since=None, until=None, limit=100):
+        with self.lock:
+            series = self.series.get(ticker)
+            if series is None:
+                return []
+            return series[resolution].bars(since, until, limit)
+
+    def clear(self):
+        with self.lock:
+            self.series = {}
+
+    def load(self, db):
+        # Сначала свёртка колоночного архива, затем свежие сделки из transactions
+        # обходом покрывающего индекса (ticker, timestamp, price, amount) без чтения таблицы
+        self.clear()
+        for ticker in archive.archived_tickers():
+            with self.lock:
+                for name, (resolution, capacity) in RESOLUTIONS.items():
+                    self._ticker_series(ticker)[name].load_bars(*archive.rollup(ticker, resolution, capacity))
+        query = select(
+            TransactionModel.ticker, TransactionModel.timestamp, TransactionModel.price, TransactionModel.amount
+        ).order_by(TransactionModel.ticker, TransactionModel.timestamp)
+        for row in db.execute(query.execution_options(yield_per=1000)):
+            self.add(row.ticker, to_seconds(row.timestamp), row.price, row.amount)
+
+
+def to_seconds(ts):
+    return to_micros(ts) // 1000000
+
+
+def from_seconds(value):
+    return datetime.fromtimestamp(value, timezone.utc)
+
+
+candles = CandleStore()
@@ -0,0 +1,271 @@
+import asyncio
+import itertools
+import os
+import pickle
+import struct
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from app.auth import auth_cache
+from app.services.sequencer import sequencer, run_in_session
+from app.services.market_data import hub
+from app.services.instruments import instruments
+from app.services.metrics import stage_timings
+from app.services import logs
+
+# Многопроцессный режим (python -m app.serve): HTTP-воркеры uvicorn и один
+# процесс движка. Движок владеет всем состоянием в памяти — книгами, балансами,
+# журналом, свечами, архивом и рассылкой рыночных данных; воркеры
+# разбирают и проверяют запросы, читают SQL и передают движку команды по
+# Unix-сокету. Без EXCHANGE_ENGINE_SOCKET приложение работает одним процессом,
+# и те же вызовы выполняются на месте.
+#
+# Кадр протокола — 4 байта длины и pickle кортежа. Воркер -> движок:
+#   ("run", id, fn, args)    — await fn(*args) в event loop движка
+#   ("call", id, fn, args)   — fn(db, *args) в пуле потоков движка
+#   ("watch", ticker) / ("unwatch", ticker) — подписка на рыночные данные
+#   ("invalidate", token)    — сброс токена в кешах авторизации всех воркеров
+#   ("instruments", items)   — новый справочник инструментов для всех воркеров
+# Движок -> воркер:
+#   ("result", id, ok, value, timings) — value или (status, detail) отказа
+#   ("feed", ticker, seq, bids, asks, trades), ("invalidate", token),
+#   ("instruments", items)
+# Функции передаются по имени модуля, поэтому годятся только объявленные
+# на уровне модуля
+
+ENGINE_SOCKET = os.getenv("EXCHANGE_ENGINE_SOCKET")
+FRAME = struct.Struct("<I")
+
+
+async def read_frame(reader):
+    header = await reader.readexactly(FRAME.size)
+    (size,) = FRAME.unpack(header)
+    return pickle.loads(await reader.readexactly(size))
+
+
+def frame(message):
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    return FRAME.pack(len(data)) + data
+
+
+async def submit_command(ticker, fn, *args):
+    return await sequencer.submit(ticker, fn, *args)
+
+
+def apply_broadcast(message):
+    if message[0] == "invalidate":
+        auth_cache.invalidate(message[1])
+    else:
+        instruments.replace(message[1])
+
+
+class RemoteFeed:
+    # Подписчик hub в движке, пересылающий обновления тикера воркеру
+    def __init__(self, ticker, writer):
+        self.ticker = ticker
+        self.writer = writer
+
+    def push(self, seq, bids, asks, trades):
+        if not self.writer.is_closing():
+            self.writer.write(frame(("feed", self.ticker, seq, bids, asks, trades)))
+
+
+class EngineServer:
+    def __init__(self, path):
+        self.path = path
+        self.server = None
+        self.writers = set()
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self._serve, path=self.path)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            for writer in list(self.writers):
+                writer.close()
+            await self.server.wait_closed()
+            self.server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def _serve(self, reader, writer):
+        self.writers.add(writer)
+        feeds = {}
+        tasks = set()
+        try:
+            while True:
+                message = await read_frame(reader)
+                kind = message[0]
+                if kind in ("run", "call"):
+                    task = asyncio.create_task(self._handle(writer, *message))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                elif kind == "watch":
+                    ticker = message[1]
+                    if ticker not in feeds:
+                        feeds[ticker] = hub.add(RemoteFeed(ticker, writer))
+                elif kind == "unwatch":
+                    feed = feeds.pop(message[1], None)
+                    if feed is not None:
+                        hub.unsubscribe(feed)
+                elif kind in ("invalidate", "instruments"):
+                    apply_broadcast(message)
+                    for other in self.writers:
+                        if not other.is_closing():
+                            other.write(frame(message))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for feed in feeds.values():
+                hub.unsubscribe(feed)
+            self.writers.discard(writer)
+            writer.close()
+
+    async def _handle(self, writer, kind, call_id, fn, args):
+        # Этапы команды возвращаются воркеру и попадают в метрики его запроса
+        timings = []
+        stage_timings.set(timings)
+        try:
+            if kind == "run":
+                value = await fn(*args)
+            else:
+                value = await run_in_threadpool(run_in_session, fn, *args)
+            reply = ("result", call_id, True, value, timings)
+        except HTTPException as e:
+            reply = ("result", call_id, False, (e.status_code, e.detail), timings)
+        except Exception as e:
+            logs.error("engine_command_failed", command=getattr(fn, "__qualname__", repr(fn)))
+            reply = ("result", call_id, False, (500, f"Engine error: {e}"), timings)
+        try:
+            data = frame(reply)
+        except Exception as e:
+            data = frame(("result", call_id, False, (500, f"Engine error: {e}"), timings))
+        if not writer.is_closing():
+            writer.write(data)
+            await writer.drain()
+
+
+class Cluster:
+    # Точка входа маршрутов к состоянию движка: на месте или через сокет
+    def __init__(self, path=None):
+        self.path = path
+        self.reader = None
+        self.writer = None
+        self.pending = {}
+        self.ids = itertools.count()
+        self.watched = set()
+        self.listener = None
+        self.lock = None
+
+    @property
+    def remote(self):
+        return self.path is not None
+
+    async def run(self, fn, *args):
+        if not self.remote:
+            return await fn(*args)
+        return await self._request("run", fn, args)
+
+    async def call(self, fn, *args):
+        if not self.remote:
+            return await run_in_threadpool(run_in_session, fn, *args)
+        return await self._request("call", fn, args)
+
+    async def submit(self, ticker, fn, *args):
+        # Команда исполнителю тикера (см. app.services.sequencer)
+        if not self.remote:
+            return await sequencer.submit(ticker, fn, *args)
+        return await self._request("run", submit_command, (ticker, fn) + args)
+
+    async def invalidate(self, token):
+        auth_cache.invalidate(token)
+        if self.remote:
+            await self._send(("invalidate", token))
+
+    async def update_instruments(self, items):
+        # Справочник уже изменён в движке; рассылка остальным воркерам
+        instruments.replace(items)
+        if self.remote:
+            await self._send(("instruments", items))
+
+    async def watch(self, ticker):
+        if self.remote and ticker not in self.watched:
+            self.watched.add(ticker)
+            await self._send(("watch", ticker))
+
+    async def unwatch(self, ticker):
+        if self.remote and ticker in self.watched:
+            self.watched.discard(ticker)
+            await self._send(("unwatch", ticker))
+
+    async def connect(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.writer is not None and not self.writer.is_closing():
+                return
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+            except OSError:
+                raise HTTPException(503, "Matching engine unavailable")
+            self.listener = asyncio.create_task(self._listen(self.reader, self.writer))
+            # Подписки восстанавливаются после переподключения
+            for ticker in self.watched:
+                self.writer.write(frame(("watch", ticker)))
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.listener is not None:
+            self.listener.cancel()
+            await asyncio.gather(self.listener, return_exceptions=True)
+            self.listener = None
+
+    async def _send(self, message):
+        await self.connect()
+        self.writer.write(frame(message))
+        await self.writer.drain()
+
+    async def _request(self, kind, fn, args):
+        call_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[call_id] = future
+        try:
+            await self._send((kind, call_id, fn, args))
+            ok, value, timings = await future
+        finally:
+            self.pending.pop(call_id, None)
+        current = stage_timings.get()
+        if current is not None:
+            current.extend(timings)
+        if not ok:
+            raise HTTPException(*value)
+        return value
+
+    async def _listen(self, reader, writer):
+        try:
+            while True:
+                message = await read_frame(reader)
+                kind = message[0]
+                if kind == "result":
+                    future = self.pending.get(message[1])
+                    if future is not None and not future.done():
+                        future.set_result(message[2:])
+                elif kind == "feed":
+                    hub._fanout(*message[1:])
+                elif kind in ("invalidate", "instruments"):
+                    apply_broadcast(message)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            # Ответы по этому соединению уже не придут
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(HTTPException(503, "Matching engine unavailable"))
+            writer.close()
+
+
+cluster = Cluster(ENGINE_SOCKET)
@@ -0,0 +1,149 @@
+import orjson
+from datetime import timezone
+from fastapi import HTTPException
+from sqlalchemy import select, and_, or_, literal_column
+from app.models import OrderStatus, Transaction as TransactionModel
+from app.services.order_lookup import stored_order, order_union
+from app.services.journal import as_stored, to_micros
+
+# Постраничная выдача истории по ключу (timestamp, id): курсор after — id
+# последней полученной записи, следующая страница начинается сразу за ней.
+# Страница короче limit — история закончилась. Строки читаются из курсора БД
+# (AsyncSession.stream) и сериализуются порциями, поэтому память на запрос не
+# зависит от объёма истории, а чтение не занимает поток пула
+HISTORY_PAGE_LIMIT = 1000
+HISTORY_CHUNK = 200
+# Строки, которые драйвер держит в памяти при чтении курсора (stream_results)
+HISTORY_FETCH = 500
+HISTORY_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "json": "application/json"}
+ARCHIVED = "Trades before the cursor are archived, see /public/transactions/{ticker}/archive"
+
+
+def parse_statuses(status):
+    if not status:
+        return None
+    try:
+        return [OrderStatus(value.strip()) for value in status.split(",") if value.strip()]
+    except ValueError:
+        raise HTTPException(400, "Invalid status")
+
+
+def page_limit(limit):
+    if limit < 1:
+        raise HTTPException(400, "Invalid limit")
+    return min(limit, HISTORY_PAGE_LIMIT)
+
+
+def format_ts(ts):
+    return ts.astimezone(timezone.utc).isoformat()
+
+
+def keyset(model, cursor, descending=False):
+    # Строго после (timestamp, id) курсора в порядке выдачи
+    ts, row_id = cursor
+    if descending:
+        return or_(model.timestamp < ts, and_(model.timestamp == ts, model.id < row_id))
+    return or_(model.timestamp > ts, and_(model.timestamp == ts, model.id > row_id))
+
+
+def time_range(conditions, model, since, until):
+    if since is not None:
+        conditions.append(model.timestamp >= as_stored(since))
+    if until is not None:
+        conditions.append(model.timestamp < as_stored(until))
+    return conditions
+
+
+async def order_rows(db, user_id, after=None, limit=100, statuses=None, ticker=None, since=None, until=None):
+    # Заявки пользователя обеих таблиц, старые первыми — как в GET /order
+    limit = page_limit(limit)
+    cursor = None
+    if after:
+        row = await stored_order(db, after)
+        if row is None or row.user_id != user_id:
+            raise HTTPException(400, "Unknown cursor")
+        cursor = (as_stored(row.timestamp), row.id)
+
+    def where(model):
+        conditions = time_range([model.user_id == user_id], model, since, until)
+        if statuses:
+            conditions.append(model.status.in_(statuses))
+        if ticker:
+            conditions.append(model.ticker == ticker)
+        if cursor is not None:
+            conditions.append(keyset(model, cursor))
+        return conditions
+
+    query = order_union(where).order_by(literal_column("timestamp"), literal_column("id")).limit(limit)
+    rows = await db.stream(query.execution_options(yield_per=HISTORY_FETCH))
+    return (order_item(row) async for row in rows)
+
+
+def order_item(row):
+    item = {
+        "id": row.id,
+        "status": row.status.value,
+        "user_id": row.user_id,
+        "timestamp": format_ts(row.timestamp),
+        "body": {"direction": row.direction.value, "ticker": row.ticker, "qty": row.qty},
+    }
+    if row.kind == "LIMIT":
+        item["body"].update(price=row.price, time_in_force=row.time_in_force, post_only=row.post_only)
+        item["filled"] = row.filled
+    return item
+
+
+async def trade_rows(db, ticker, after=None, limit=100, since=None, until=None, cutover=None):
+    # Сделки тикера, новые первыми — как в GET /public/transactions/{ticker}.
+    # Лента покрывает только transactions: сделки старше границы архива
+    # (cutover(ticker), микросекунды) перенесены туда без id и отдаются
+    # GET /public/transactions/{ticker}/archive. Курсор на такую сделку и
+    # диапазон целиком до границы — 410, диапазон через границу — только свежая часть
+    limit = page_limit(limit)
+    conditions = time_range([TransactionModel.ticker == ticker], TransactionModel, since, until)
+    if until is not None and cutover is not None and to_micros(until) <= await cutover(ticker):
+        raise HTTPException(410, ARCHIVED)
+    if after:
+        row = (await db.execute(select(TransactionModel.timestamp).where(TransactionModel.id == after, TransactionModel.ticker == ticker))).first()
+        if row is None:
+            if cutover is not None and await cutover(ticker):
+                raise HTTPException(410, ARCHIVED)
+            raise HTTPException(400, "Unknown cursor")
+        conditions.append(keyset(TransactionModel, (row.timestamp, after), descending=True))
+    query = select(
+        TransactionModel.id, TransactionModel.ticker, TransactionModel.amount, TransactionModel.price, TransactionModel.timestamp
+    ).where(*conditions).order_by(TransactionModel.timestamp.desc(), TransactionModel.id.desc()).limit(limit)
+    rows = await db.stream(query.execution_options(yield_per=HISTORY_FETCH))
+    return ({
+        "id": row.id,
+        "ticker": row.ticker,
+        "amount": row.amount,
+        "price": row.price,
+        "timestamp": format_ts(row.timestamp),
+    } async for row in rows)
+
+
+async def chunks(items, size=HISTORY_CHUNK):
+    chunk = []
+    async for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def stream_items(items, fmt):
+    # NDJSON — строка на запись; json — массив, отдаваемый по частям
+    dumps = orjson.dumps
+    if fmt == "ndjson":
+        async for chunk in chunks(items):
+            yield b"".join(dumps(item, option=orjson.OPT_APPEND_NEWLINE) for item in chunk)
+        return
+    yield b"["
+    first = True
+    async for chunk in chunks(items):
+        yield (b"" if first else b",") + b",".join(dumps(item) for item in chunk)
+        first = False
+    yield b"]"
@@ -0,0 +1,43 @@
+import threading
+import orjson
+from app.models import Instrument as InstrumentModel
+
+
+class InstrumentRegistry:
+    # Справочник инструментов в памяти процесса: проверка тикера без SQL и
+    # готовый JSON для GET /public/instrument. Загружается при старте, меняется
+    # только ручками admin_instrument (в процессе движка), воркерам новый
+    # список рассылается через app.services.cluster
+    def __init__(self):
+        self.names = {}
+        self.listing = b"[]"
+        self.lock = threading.RLock()
+
+    def exists(self, ticker):
+        return ticker in self.names
+
+    def items(self):
+        return list(self.names.items())
+
+    def replace(self, items):
+        # items — [(ticker, name)]; словарь и JSON подменяются целиком,
+        # читатели видят либо старый список, либо новый
+        names = dict(items)
+        listing = orjson.dumps([{"name": name, "ticker": ticker} for ticker, name in names.items()])
+        with self.lock:
+            self.names = names
+            self.listing = listing
+
+    def add(self, ticker, name):
+        with self.lock:
+            self.replace(self.items() + [(ticker, name)])
+
+    def remove(self, ticker):
+        with self.lock:
+            self.replace([(t, name) for t, name in self.items() if t != ticker])
+
+    def load(self, db):
+        self.replace([(row.ticker, row.name) for row in db.query(InstrumentModel.ticker, InstrumentModel.name)])
+
+
+instruments = InstrumentRegistry()
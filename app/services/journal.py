@@ -0,0 +1,501 @@
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from collections import namedtuple
+from concurrent.futures import Future
+from datetime import datetime, timezone, timedelta
+from fastapi import HTTPException
+from sqlalchemy import select, insert, update, bindparam
+from sqlalchemy.exc import OperationalError
+from app.database import SessionLocal
+from app.models import LimitOrder as LimitOrderModel, MarketOrder as MarketOrderModel, OrderStatus, Transaction as TransactionModel, JournalState
+from app.services.balances import ledger, trade_deltas, hold_delta, net_deltas, write_balance_deltas
+from app.services.metrics import journal_apply_seconds
+from app.services import logs
+
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "./exchange.journal")
+# Повторы пачки при временной ошибке SQL (database is locked, обрыв соединения):
+# пауза удваивается от JOURNAL_RETRY_DELAY_MS до JOURNAL_RETRY_MAX_DELAY_MS
+JOURNAL_APPLY_RETRIES = int(os.getenv("JOURNAL_APPLY_RETRIES", "10"))
+JOURNAL_RETRY_DELAY_MS = int(os.getenv("JOURNAL_RETRY_DELAY_MS", "50"))
+JOURNAL_RETRY_MAX_DELAY_MS = int(os.getenv("JOURNAL_RETRY_MAX_DELAY_MS", "2000"))
+
+# События журнала. Время — микросекунды от эпохи (UTC)
+OrderAccepted = namedtuple(
+    "OrderAccepted", "order_id user_id ticker direction is_limit qty price timestamp time_in_force post_only",
+    defaults=("GTC", False)
+)
+Fill = namedtuple("Fill", "trade_id ticker taker_id maker_id buyer_id seller_id qty price timestamp")
+OrderCancelled = namedtuple("OrderCancelled", "order_id ticker timestamp")
+# Зачисление (amount > 0) или списание администратором
+BalanceChanged = namedtuple("BalanceChanged", "user_id ticker amount timestamp")
+
+# Код типа записи -> (класс события, формат полей: s — строка, q — int64, ? — bool).
+# Код 1 — приём заявки без флагов исполнения, журнал прежней версии
+# читается с умолчаниями; пишется последний код класса
+EVENT_TYPES = {
+    1: (OrderAccepted, "ssss?qqq"),
+    2: (Fill, "ssssssqqq"),
+    3: (OrderCancelled, "ssq"),
+    4: (OrderAccepted, "ssss?qqqs?"),
+    5: (BalanceChanged, "ssqq"),
+}
+EVENT_CODES = {cls: code for code, (cls, _) in EVENT_TYPES.items()}
+
+# Заголовок записи: длина полезной нагрузки, crc32, seq, тип
+HEADER = struct.Struct("<IIQB")
+_INT = struct.Struct("<q")
+_LEN = struct.Struct("<H")
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+STORED_EPOCH = datetime(1970, 1, 1)
+
+
+def as_stored(ts):
+    # В таблицах время хранится в UTC без зоны; datetime с зоной приводится к этому виду
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def to_micros(ts):
+    # С зоной или без (время из таблиц)
+    return (as_stored(ts) - STORED_EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(value):
+    return EPOCH + timedelta(microseconds=value)
+
+
+def pack_fields(fmt, values):
+    parts = []
+    for kind, value in zip(fmt, values):
+        if kind == "s":
+            raw = value.encode()
+            parts.append(_LEN.pack(len(raw)))
+            parts.append(raw)
+        elif kind == "?":
+            parts.append(b"\x01" if value else b"\x00")
+        else:
+            parts.append(_INT.pack(value))
+    return b"".join(parts)
+
+
+def unpack_fields(fmt, payload, pos=0):
+    # Возвращает значения полей и смещение за последним из них
+    values = []
+    for kind in fmt:
+        if kind == "s":
+            (size,) = _LEN.unpack_from(payload, pos)
+            pos += _LEN.size
+            values.append(payload[pos:pos + size].decode())
+            pos += size
+        elif kind == "?":
+            values.append(payload[pos] == 1)
+            pos += 1
+        else:
+            values.append(_INT.unpack_from(payload, pos)[0])
+            pos += _INT.size
+    return values, pos
+
+
+def encode_event(seq, event):
+    code = EVENT_CODES[type(event)]
+    payload = pack_fields(EVENT_TYPES[code][1], event)
+    crc = zlib.crc32(payload, zlib.crc32(struct.pack("<QB", seq, code)))
+    return HEADER.pack(len(payload), crc, seq, code) + payload
+
+
+def decode_event(code, payload):
+    cls, fmt = EVENT_TYPES[code]
+    values, _ = unpack_fields(fmt, payload)
+    return cls(*values)
+
+
+def read_journal(path):
+    # Возвращает [(seq, событие)] и смещение конца последней целой записи;
+    # оборванный хвост (падение посреди записи) отбрасывается
+    records = []
+    if not os.path.exists(path):
+        return records, 0
+    with open(path, "rb") as f:
+        data = f.read()
+    pos = 0
+    while pos + HEADER.size <= len(data):
+        size, crc, seq, code = HEADER.unpack_from(data, pos)
+        end = pos + HEADER.size + size
+        payload = data[pos + HEADER.size:end]
+        if end > len(data) or code not in EVENT_TYPES or zlib.crc32(payload, zlib.crc32(struct.pack("<QB", seq, code))) != crc:
+            break
+        records.append((seq, decode_event(code, payload)))
+        pos = end
+    return records, pos
+
+
+def offset_after(data, upto):
+    # Смещение первой записи с seq > upto; записи в файле идут по возрастанию seq
+    pos = 0
+    while pos + HEADER.size <= len(data):
+        size, _, seq, _ = HEADER.unpack_from(data, pos)
+        if seq > upto:
+            break
+        pos += HEADER.size + size
+    return min(pos, len(data))
+
+
+def _order_status(filled, qty):
+    if filled == qty:
+        return OrderStatus.EXECUTED
+    if filled > 0:
+        return OrderStatus.PARTIALLY_EXECUTED
+    return OrderStatus.NEW
+
+
+def apply_events(db, records):
+    # Перенос событий журнала в SQL-таблицы без ORM-объектов: изменения всей
+    # пачки собираются в памяти и пишутся постоянным числом выражений
+    # (INSERT заявок и сделок, UPDATE заявок и балансов executemany).
+    # Возвращает неттированные изменения балансов и резервов, чтобы снять их
+    # из pending после коммита
+    new_orders = {}
+    trades = []
+    deltas = []
+    holds = []
+
+    # Заявки из прошлых пачек (мейкеры и отменяемые) — одной выборкой
+    known = set()
+    referenced = set()
+    for seq, event in records:
+        if isinstance(event, OrderAccepted):
+            known.add(event.order_id)
+        elif isinstance(event, Fill):
+            referenced.update((event.maker_id, event.taker_id))
+        elif isinstance(event, OrderCancelled):
+            referenced.add(event.order_id)
+    referenced -= known
+    stored = {}
+    if referenced:
+        table = LimitOrderModel.__table__
+        for row in db.connection().execute(select(
+            table.c.id, table.c.user_id, table.c.ticker, table.c.direction, table.c.price, table.c.qty, table.c.filled, table.c.status
+        ).where(table.c.id.in_(referenced))):
+            stored[row.id] = dict(row._mapping)
+    changed = set()
+
+    def get_order(order_id):
+        order = new_orders.get(order_id)
+        if order is not None:
+            return order
+        order = stored.get(order_id)
+        if order is not None:
+            changed.add(order_id)
+        return order
+
+    for seq, event in records:
+        if isinstance(event, OrderAccepted):
+            order = dict(
+                id=event.order_id,
+                user_id=event.user_id,
+                timestamp=from_micros(event.timestamp),
+                direction=event.direction,
+                ticker=event.ticker,
+                qty=event.qty,
+                is_limit=event.is_limit
+            )
+            if event.is_limit:
+                order.update(
+                    status=OrderStatus.NEW, price=event.price, filled=0,
+                    time_in_force=event.time_in_force, post_only=event.post_only
+                )
+                holds.append(hold_delta(event.user_id, event.ticker, event.direction, event.price, event.qty))
+            else:
+                # Рыночная заявка принимается только при полном исполнении
+                order.update(status=OrderStatus.EXECUTED)
+            new_orders[event.order_id] = order
+        elif isinstance(event, Fill):
+            trades.append(dict(
+                id=event.trade_id,
+                ticker=event.ticker,
+                amount=event.qty,
+                price=event.price,
+                timestamp=from_micros(event.timestamp),
+                buyer_id=event.buyer_id,
+                seller_id=event.seller_id
+            ))
+            deltas.extend(trade_deltas(event.ticker, event.buyer_id, event.seller_id, event.qty, event.price))
+            for order_id in (event.maker_id, event.taker_id):
+                order = get_order(order_id)
+                if order is not None and order.get("is_limit", True):
+                    order["filled"] += event.qty
+                    order["status"] = _order_status(order["filled"], order["qty"])
+                    holds.append(hold_delta(order["user_id"], order["ticker"], order["direction"], order["price"], -event.qty))
+        elif isinstance(event, OrderCancelled):
+            order = get_order(event.order_id)
+            # Повторная отмена не снимает резерв второй раз
+            if order is not None and order["status"] != OrderStatus.CANCELLED:
+                order["status"] = OrderStatus.CANCELLED
+                if order.get("is_limit", True):
+                    holds.append(hold_delta(order["user_id"], order["ticker"], order["direction"], order["price"], order["filled"] - order["qty"]))
+        elif isinstance(event, BalanceChanged):
+            deltas.append(((event.user_id, event.ticker), event.amount))
+
+    conn = db.connection()
+    limit_rows = [order for order in new_orders.values() if order["is_limit"]]
+    market_rows = [order for order in new_orders.values() if not order["is_limit"]]
+    for model, rows in ((LimitOrderModel, limit_rows), (MarketOrderModel, market_rows)):
+        if rows:
+            conn.execute(insert(model.__table__), [{k: v for k, v in row.items() if k != "is_limit"} for row in rows])
+    if changed:
+        table = LimitOrderModel.__table__
+        conn.execute(
+            update(table).where(table.c.id == bindparam("b_id")).values(filled=bindparam("b_filled"), status=bindparam("b_status")),
+            [{"b_id": order_id, "b_filled": stored[order_id]["filled"], "b_status": stored[order_id]["status"]} for order_id in changed]
+        )
+    if trades:
+        conn.execute(insert(TransactionModel.__table__), trades)
+    netted = net_deltas(deltas)
+    netted_holds = net_deltas(holds)
+    write_balance_deltas(db, netted, netted_holds)
+    state = db.get(JournalState, 1)
+    if state is None:
+        state = JournalState(id=1, applied_seq=0)
+        db.add(state)
+    state.applied_seq = records[-1][0]
+    return netted, netted_holds
+
+
+class Journal:
+    # Журнал событий с групповым коммитом: записи всех команд, накопившихся
+    # за время предыдущего fsync, пишутся одним write + fsync. Отдельный поток
+    # переносит подтверждённые пачки в SQL одной транзакцией на пачку
+    def __init__(self, path=JOURNAL_PATH, session_factory=SessionLocal):
+        self.path = path
+        self.session_factory = session_factory
+        self.seq = 0
+        # Последний seq, применённый к SQL
+        self.applied = 0
+        self.failed = None
+        self.file = None
+        self.file_lock = threading.Lock()
+        self.cond = threading.Condition()
+        # Оповещение о каждой пачке, доведённой применителем до SQL (см. drain)
+        self.done = threading.Condition()
+        self.pending = []
+        self.durable = queue.Queue()
+        self.closing = False
+        self.threads = []
+
+    def open(self):
+        # Доигрываем хвост журнала, не попавший в SQL до остановки, и дописываем
+        # журнал дальше. Записи остаются в файле до compact(): по ним книги
+        # восстанавливаются от последнего снимка. Возвращает [(seq, событие)] файла
+        records, end = read_journal(self.path)
+        db = self.session_factory()
+        try:
+            state = db.get(JournalState, 1)
+            applied = state.applied_seq if state else 0
+            tail = [(seq, event) for seq, event in records if seq > applied]
+            if tail:
+                apply_events(db, tail)
+                db.commit()
+            self.seq = max([applied] + [seq for seq, _ in records])
+            self.applied = self.seq
+        finally:
+            db.close()
+        if os.path.exists(self.path):
+            os.truncate(self.path, end)
+        self.file = open(self.path, "ab")
+        self.closing = False
+        self.failed = None
+        self.threads = [
+            threading.Thread(target=self._write_loop, name="journal-writer", daemon=True),
+            threading.Thread(target=self._apply_loop, name="journal-applier", daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+        return records
+
+    def check(self):
+        # Вызывается до исполнения команды: после отказа применителя книги и
+        # балансы не должны меняться под ответ с ошибкой
+        if self.failed is not None:
+            raise HTTPException(503, "Journal unavailable")
+
+    def drain(self):
+        # Ждёт, пока события, принятые до вызова, применены к SQL и свечам
+        with self.cond:
+            target = self.seq
+        with self.done:
+            while self.applied < target:
+                if self.failed is not None:
+                    raise HTTPException(503, "Journal unavailable")
+                self.done.wait()
+
+    def idle(self):
+        with self.cond:
+            return self.applied == self.seq
+
+    def append(self, events, result=None):
+        # Future завершается, когда события записаны на диск и применены к SQL;
+        # после отказа применителя — когда записаны на диск
+        future = Future()
+        with self.cond:
+            if self.failed is not None:
+                raise HTTPException(503, "Journal unavailable")
+            records = []
+            for event in events:
+                self.seq += 1
+                records.append((self.seq, event))
+            self.pending.append((records, future, result))
+            self.cond.notify()
+        return future
+
+    def _write_loop(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closing:
+                    self.cond.wait()
+                if not self.pending:
+                    break
+                batch, self.pending = self.pending, []
+            try:
+                self._write(batch)
+            except Exception as e:
+                # Пачка и всё, что ждёт записи, на диск не попали: их команды
+                # получают ошибку, новые — 503 (см. append, check). Уже записанные
+                # пачки применитель доводит до SQL и завершается
+                with self.cond:
+                    lost, self.pending = batch + self.pending, []
+                    if self.failed is None:
+                        self.failed = e
+                logs.error("journal_write_failed", events=sum(len(records) for records, _, _ in lost))
+                for _, future, _ in lost:
+                    future.set_exception(e)
+                break
+            self.durable.put(batch)
+        self.durable.put(None)
+
+    def _write(self, batch):
+        with self.file_lock:
+            start = self.file.tell()
+            try:
+                self.file.write(b"".join(encode_event(seq, event) for records, _, _ in batch for seq, event in records))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except Exception:
+                # Недописанная пачка не должна доиграться при следующем старте
+                try:
+                    self.file.truncate(start)
+                except OSError:
+                    pass
+                raise
+
+    def _apply_loop(self):
+        # Модуль свечей сам берёт отсюда перевод времени
+        from app.services.candles import candles
+        stop = False
+        stopped = False
+        while not stop:
+            batch = self.durable.get()
+            if batch is None:
+                break
+            # Всё, что успело стать durable, применяем одной транзакцией
+            while True:
+                try:
+                    more = self.durable.get_nowait()
+                except queue.Empty:
+                    break
+                if more is None:
+                    stop = True
+                    break
+                batch.extend(more)
+            records = [record for records, _, _ in batch for record in records]
+            # После ошибки применение останавливается: applied_seq не должен
+            # перескочить через непримененную пачку, её доиграет следующий старт
+            if records and not stopped:
+                with self.done:
+                    try:
+                        self._apply(records)
+                        candles.add_fills(event for _, event in records if isinstance(event, Fill))
+                    except Exception as e:
+                        stopped = True
+                        with self.cond:
+                            if self.failed is None:
+                                self.failed = e
+                        logs.error("journal_apply_failed", seq=records[-1][0])
+                    self.done.notify_all()
+            # Пачка уже на диске: команда состоялась, заявки живут в книге и
+            # попадут в SQL при следующем старте, поэтому ответ — успех
+            for _, future, result in batch:
+                future.set_result(result)
+        with self.done:
+            self.done.notify_all()
+
+    def _apply(self, records):
+        # Пачка — одна транзакция; временную ошибку SQL повторяем с паузой,
+        # прочие ошибки и исчерпанные повторы останавливают применение
+        delay = JOURNAL_RETRY_DELAY_MS / 1000
+        for attempt in range(JOURNAL_APPLY_RETRIES + 1):
+            db = self.session_factory()
+            try:
+                started = time.perf_counter()
+                netted, netted_holds = apply_events(db, records)
+                db.flush()
+                with ledger.lock:
+                    db.commit()
+                    ledger.release(netted, netted_holds)
+                self.applied = records[-1][0]
+                journal_apply_seconds.observe(time.perf_counter() - started)
+                return
+            except OperationalError:
+                db.rollback()
+                if attempt == JOURNAL_APPLY_RETRIES:
+                    raise
+                logs.info("journal_apply_retry", seq=records[-1][0], attempt=attempt + 1)
+                time.sleep(delay)
+                delay = min(delay * 2, JOURNAL_RETRY_MAX_DELAY_MS / 1000)
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+
+    def compact(self, upto):
+        # Убирает из файла записи с seq <= upto. Звать только с upto не больше
+        # applied и seq последнего снимка книг: такие записи уже не нужны ни SQL,
+        # ни восстановлению. Основная часть файла читается без блокировки (писатель
+        # только дописывает), под file_lock — лишь дописанное за это время и rename
+        with open(self.path, "rb") as f:
+            data = f.read()
+        kept = data[offset_after(data, upto):]
+        tmp = self.path + ".tmp"
+        with self.file_lock:
+            with open(self.path, "rb") as f:
+                f.seek(len(data))
+                kept += f.read()
+            with open(tmp, "wb") as f:
+                f.write(kept)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            if self.file is not None:
+                self.file.close()
+                self.file = open(self.path, "ab")
+        return len(data) - len(kept)
+
+    def close(self):
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+journal = Journal()
@@ -0,0 +1,104 @@
+import itertools
+import json
+import logging
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# Структурированный лог: одна JSON-строка на событие в stderr. Запись идёт
+# в отдельном потоке (QueueListener), вызывающий только кладёт запись в
+# ограниченную очередь; при переполнении запись отбрасывается и считается.
+# Частые события (отказы заявок и т.п.) пишутся с sampled=True: из каждых
+# LOG_SAMPLE_EVERY одноимённых событий в лог попадает одно, с полем sample
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", "100"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        item = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        item.update(getattr(record, "fields", None) or {})
+        if getattr(record, "sample", None):
+            item["sample"] = record.sample
+        if record.exc_text:
+            item["exc"] = record.exc_text
+        return json.dumps(item, separators=(",", ":"), default=str)
+
+
+class SampledQueueHandler(QueueHandler):
+    def __init__(self, queue, every=LOG_SAMPLE_EVERY):
+        super().__init__(queue)
+        self.every = every
+        self.counters = {}
+        self.dropped = 0
+
+    def filter(self, record):
+        if getattr(record, "sampled", False) and self.every > 1:
+            counter = self.counters.get(record.msg)
+            if counter is None:
+                counter = self.counters.setdefault(record.msg, itertools.count())
+            if next(counter) % self.every:
+                return False
+            record.sample = self.every
+        return super().filter(record)
+
+    def prepare(self, record):
+        # Трассировка форматируется здесь: exc_info не переживает очередь
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class Logs:
+    def __init__(self):
+        self.queue = queue.Queue(LOG_QUEUE_SIZE)
+        self.handler = SampledQueueHandler(self.queue)
+        self.logger = logging.getLogger("exchange")
+        self.logger.setLevel(LOG_LEVEL)
+        self.logger.addHandler(self.handler)
+        self.logger.propagate = False
+        self.listener = None
+
+    def start(self):
+        if self.listener is None:
+            output = logging.StreamHandler(sys.stderr)
+            output.setFormatter(JsonFormatter())
+            self.listener = QueueListener(self.queue, output)
+            self.listener.start()
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def event(self, level, name, sampled=False, exc_info=None, **fields):
+        self.logger.log(level, name, exc_info=exc_info, extra={"fields": fields, "sampled": sampled})
+
+
+logs = Logs()
+
+
+def info(name, sampled=False, **fields):
+    logs.event(logging.INFO, name, sampled, **fields)
+
+
+def error(name, sampled=False, **fields):
+    # Вызывается из except: трассировка текущего исключения попадает в поле exc
+    logs.event(logging.ERROR, name, sampled, exc_info=True, **fields)
@@ -0,0 +1,152 @@
+import asyncio
+import orjson
+from collections import defaultdict
+from fastapi.concurrency import run_in_threadpool
+from app.services.order_book import books
+from app.services.journal import from_micros
+
+# Ограничения очереди подписчика: при переполнении копить дельты дальше
+# бессмысленно, вместо них подписчик получит свежий снимок книги
+MAX_PENDING_LEVELS = 500
+MAX_PENDING_TRADES = 1000
+
+
+class Subscriber:
+    def __init__(self, ticker):
+        self.ticker = ticker
+        self.seq = 0
+        # Конфляция: по каждому уровню хранится только последний объём
+        self.levels = {}
+        self.trades = []
+        self.resync = True
+        self.wakeup = asyncio.Event()
+        self.wakeup.set()
+
+    def push(self, seq, bids, asks, trades):
+        if seq <= self.seq:
+            return
+        self.seq = seq
+        if self.resync:
+            return
+        for level in bids:
+            self.levels[("BUY", level["price"])] = level["qty"]
+        for level in asks:
+            self.levels[("SELL", level["price"])] = level["qty"]
+        self.trades.extend(trades)
+        if len(self.levels) > MAX_PENDING_LEVELS or len(self.trades) > MAX_PENDING_TRADES:
+            self.resync = True
+            self.levels = {}
+            self.trades = []
+        self.wakeup.set()
+
+    def take(self, snapshot=None):
+        # Следующие сообщения для отправки: снимок (seq, bids, asks) при
+        # пересинхронизации либо накопленные сделки и дельта
+        self.wakeup.clear()
+        if self.resync:
+            seq, bids, asks = snapshot
+            if seq < self.seq:
+                # Снимок движка старше уже пришедших дельт: запросить заново
+                self.wakeup.set()
+                return []
+            self.resync = False
+            self.levels = {}
+            self.trades = []
+            self.seq = seq
+            return [{
+                "type": "snapshot",
+                "ticker": self.ticker,
+                "seq": seq,
+                "bid_levels": bids,
+                "ask_levels": asks,
+            }]
+        messages = [dict(type="trade", ticker=self.ticker, **trade) for trade in self.trades]
+        if self.levels:
+            bids = [{"price": price, "qty": qty} for (direction, price), qty in self.levels.items() if direction == "BUY"]
+            asks = [{"price": price, "qty": qty} for (direction, price), qty in self.levels.items() if direction == "SELL"]
+            messages.append({"type": "l2", "ticker": self.ticker, "seq": self.seq, "bids": bids, "asks": asks})
+        self.levels = {}
+        self.trades = []
+        return messages
+
+    async def run(self, websocket, snapshot):
+        # snapshot(ticker) — корутина, возвращающая снимок книги (см. book_depth)
+        while True:
+            await self.wakeup.wait()
+            for message in self.take(await snapshot(self.ticker) if self.resync else None):
+                await websocket.send_text(orjson.dumps(message).decode())
+
+
+def locked_depth(book):
+    with book.lock:
+        return book.seq, book.depth(book.bids), book.depth(book.asks)
+
+
+async def book_depth(ticker):
+    # Книга не создаётся: у инструмента без заявок или удалённого — пустой снимок.
+    # book.lock держит исполнитель тикера, поэтому ждём его в пуле потоков
+    book = books.books.get(ticker)
+    if book is None:
+        return 0, [], []
+    return await run_in_threadpool(locked_depth, book)
+
+
+class MarketDataHub:
+    # Раздача изменений книги и сделок подписчикам. Публикация идёт из потоков
+    # исполнителей/журнала, подписчики живут в event loop
+    def __init__(self):
+        self.subscribers = defaultdict(set)
+        self.loop = None
+
+    def subscribe(self, ticker):
+        return self.add(Subscriber(ticker))
+
+    def add(self, subscriber):
+        # Любой объект с ticker и push(seq, bids, asks, trades)
+        self.loop = asyncio.get_running_loop()
+        self.subscribers[subscriber.ticker].add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        subscribers = self.subscribers.get(subscriber.ticker)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self.subscribers[subscriber.ticker]
+
+    def capture(self, book, fills):
+        # Вызывается под book.lock сразу после изменения книги
+        seq, bids, asks = book.take_changes()
+        trades = [{
+            "seq": seq,
+            "price": fill.price,
+            "amount": fill.qty,
+            "timestamp": from_micros(fill.timestamp).isoformat(),
+        } for fill in fills]
+        return book.ticker, seq, bids, asks, trades
+
+    def publish_when_done(self, future, update):
+        # Наружу уходит только то, что уже записано в журнал
+        if not self.subscribers.get(update[0]):
+            return
+
+        def done(f):
+            if f.exception() is None:
+                self.publish(*update)
+        future.add_done_callback(done)
+
+    def publish(self, ticker, seq, bids, asks, trades):
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            loop.call_soon_threadsafe(self._fanout, ticker, seq, bids, asks, trades)
+        except RuntimeError:
+            pass
+
+    def _fanout(self, ticker, seq, bids, asks, trades):
+        for subscriber in self.subscribers.get(ticker, ()):
+            subscriber.push(seq, bids, asks, trades)
+
+
+hub = MarketDataHub()
@@ -0,0 +1,233 @@
+import bisect
+import contextvars
+import threading
+from collections import defaultdict
+from time import perf_counter
+from app.services.order_book import books
+
+# Метрики в текстовом формате Prometheus (GET /metrics). Гистограммы времени —
+# в секундах. Этапы запроса (auth, validation, matching, settlement, commit)
+# копятся в списке текущего запроса и пишутся в гистограмму одной суммой на
+# этап, когда запрос завершён (MetricsMiddleware)
+
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+
+# Список (этап, секунды) текущего HTTP-запроса; копия контекста видна в потоках
+# пула и исполнителей тикеров, поэтому этапы из них попадают в тот же запрос
+stage_timings = contextvars.ContextVar("stage_timings", default=None)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{format_labels(self.labels, labels)} {format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [счётчики по корзинам (последняя — +Inf), сумма]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self.values.items())
+        names = self.labels + ("le",)
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = bound if bound == "+Inf" else format_value(float(bound))
+                lines.append(f"{self.name}_bucket{format_labels(names, labels + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    # Значения снимаются при чтении /metrics: collect() -> [(labels, value)]
+    def __init__(self, name, help, labels, collect):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for labels, value in sorted(self.collect()):
+            lines.append(f"{self.name}{format_labels(self.labels, labels)} {format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self, only=None, exclude=()):
+        lines = []
+        for metric in self.metrics:
+            if (only is None or metric.name in only) and metric.name not in exclude:
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class Stage:
+    # with Stage("matching"): ... — время блока в этапы текущего запроса.
+    # Вне HTTP-запроса (офлайн-прогон, применитель журнала) ничего не пишет
+    __slots__ = ("name", "started")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        timings = stage_timings.get()
+        if timings is not None:
+            timings.append((self.name, perf_counter() - self.started))
+
+
+def book_depth():
+    result = []
+    for ticker, book in list(books.books.items()):
+        for side_name, side in (("bid", book.bids), ("ask", book.asks)):
+            levels = list(side.levels.values())
+            result.append(((ticker, side_name, "levels"), len(levels)))
+            result.append(((ticker, side_name, "qty"), sum(level.total for level in levels)))
+            result.append(((ticker, side_name, "orders"), sum(len(level.orders) for level in levels)))
+    return result
+
+
+def reject_reason(detail):
+    # Причина отказа без номера заявки в пачке и текста ошибки разбора,
+    # чтобы число значений метки было ограничено
+    detail = str(detail)
+    if detail.startswith("Order ") and ": " in detail:
+        prefix, rest = detail.split(": ", 1)
+        if prefix[6:].isdigit():
+            detail = rest
+    if detail.startswith("Invalid order"):
+        return "Invalid order"
+    if detail.startswith("Batch must contain"):
+        return "Invalid batch size"
+    return detail
+
+
+metrics = MetricsRegistry()
+request_seconds = metrics.register(Histogram(
+    "exchange_request_seconds", "HTTP request time by endpoint and status", ("endpoint", "status")
+))
+stage_seconds = metrics.register(Histogram(
+    "exchange_stage_seconds", "Time spent per request stage by endpoint", ("endpoint", "stage")
+))
+journal_apply_seconds = metrics.register(Histogram(
+    "exchange_journal_apply_seconds", "Time to apply one journal batch to SQL"
+))
+orders_total = metrics.register(Counter(
+    "exchange_orders_total", "Accepted orders by type", ("type",)
+))
+fills_total = metrics.register(Counter(
+    "exchange_fills_total", "Trades by ticker", ("ticker",)
+))
+rejects_total = metrics.register(Counter(
+    "exchange_rejects_total", "Rejected orders by reason", ("reason",)
+))
+book_gauge = metrics.register(Gauge(
+    "exchange_book_depth", "Order book depth: price levels, resting qty and orders per side",
+    ("ticker", "side", "measure"), book_depth
+))
+
+
+# Метрики, которые пишет процесс движка (в многопроцессном режиме /metrics
+# воркера берёт их у движка)
+ENGINE_METRICS = ("exchange_fills_total", "exchange_journal_apply_seconds", "exchange_book_depth")
+
+
+class MetricsMiddleware:
+    # ASGI-обёртка: время запроса по шаблону пути и статусу, суммы этапов
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings = []
+        token = stage_timings.set(timings)
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            elapsed = perf_counter() - started
+            stage_timings.reset(token)
+            route = scope.get("route")
+            endpoint = f"{scope['method']} {route.path}" if route is not None else "unmatched"
+            request_seconds.observe(elapsed, endpoint, str(status))
+            totals = defaultdict(float)
+            for stage, seconds in timings:
+                totals[stage] += seconds
+            for stage, seconds in totals.items():
+                stage_seconds.observe(seconds, endpoint, stage)
@@ -0,0 +1,321 @@
+import heapq
+import orjson
+import threading
+from collections import OrderedDict
+from sqlalchemy import text
+from app.models import LimitOrder as LimitOrderModel, ACTIVE_ORDER_SQL
+L2_DEPTH = 25
+EMPTY_L2 = b'{"bid_levels":[],"ask_levels":[]}'
+
+
+class BookOrder:
+    __slots__ = ("id", "user_id", "direction", "price", "qty", "filled", "timestamp", "post_only")
+
+    def __init__(self, id, user_id, direction, price, qty, filled=0, timestamp=None, post_only=False):
+        self.id = id
+        self.user_id = user_id
+        self.direction = direction
+        self.price = price
+        self.qty = qty
+        self.filled = filled
+        self.timestamp = timestamp
+        self.post_only = post_only
+
+    @property
+    def remaining(self):
+        return self.qty - self.filled
+
+
+class PriceLevel:
+    __slots__ = ("price", "orders", "total")
+
+    def __init__(self, price):
+        self.price = price
+        # FIFO очередь заявок уровня: вставка в конец, удаление по id за O(1)
+        self.orders = OrderedDict()
+        self.total = 0
+
+
+class BookSide:
+    # Уровни хранятся в dict, порядок цен — в куче с ленивым удалением:
+    # лучшая цена за O(1), вставка и удаление уровня за O(log n)
+    def __init__(self, is_bid):
+        self.is_bid = is_bid
+        self.levels = {}
+        self._heap = []
+
+    def _key(self, price):
+        return -price if self.is_bid else price
+
+    def add(self, order):
+        level = self.levels.get(order.price)
+        if level is None:
+            level = self.levels[order.price] = PriceLevel(order.price)
+            heapq.heappush(self._heap, self._key(order.price))
+        level.orders[order.id] = order
+        level.total += order.remaining
+
+    def remove(self, order):
+        level = self.levels[order.price]
+        del level.orders[order.id]
+        level.total -= order.remaining
+        if not level.orders:
+            del self.levels[order.price]
+            if len(self._heap) > 2 * len(self.levels) + 16:
+                self._heap = [self._key(price) for price in self.levels]
+                heapq.heapify(self._heap)
+
+    def best(self):
+        heap = self._heap
+        while heap:
+            level = self.levels.get(self._key(heap[0]))
+            if level is not None:
+                return level
+            heapq.heappop(heap)
+        return None
+
+    def __iter__(self):
+        # Обход уровней в порядке приоритета без изменения кучи
+        heap = self._heap
+        if not heap:
+            return
+        todo = [(heap[0], 0)]
+        seen = set()
+        while todo:
+            key, i = heapq.heappop(todo)
+            if key not in seen:
+                seen.add(key)
+                level = self.levels.get(self._key(key))
+                if level is not None:
+                    yield level
+            for j in (2 * i + 1, 2 * i + 2):
+                if j < len(heap):
+                    heapq.heappush(todo, (heap[j], j))
+
+
+class OrderBook:
+    def __init__(self, ticker, index=None):
+        self.ticker = ticker
+        self.bids = BookSide(is_bid=True)
+        self.asks = BookSide(is_bid=False)
+        self.orders = {}
+        # Общий для всех книг индекс order_id -> книга
+        self.index = index if index is not None else {}
+        self.lock = threading.RLock()
+        # Готовые JSON-снимки L2 по значению limit; сбрасываются при любом изменении книги
+        self.snapshots = {}
+        # Изменённые с прошлой публикации уровни (direction, price) и номер изменения книги
+        self.touched = set()
+        self.seq = 0
+
+    def side(self, direction):
+        return self.bids if direction == "BUY" else self.asks
+
+    def best_bid(self):
+        return self.bids.best()
+
+    def best_ask(self):
+        return self.asks.best()
+
+    def add(self, order):
+        self.orders[order.id] = order
+        self.index[order.id] = self
+        self.side(order.direction).add(order)
+        self.snapshots = {}
+        self.touched.add((order.direction, order.price))
+
+    def cancel(self, order_id):
+        order = self.orders.pop(order_id, None)
+        if order is not None:
+            self.index.pop(order_id, None)
+            self.side(order.direction).remove(order)
+            self.snapshots = {}
+            self.touched.add((order.direction, order.price))
+        return order
+
+    def crosses(self, direction, price):
+        # Заявка по цене price исполнилась бы сразу (проверка post-only)
+        best = self.best_ask() if direction == "BUY" else self.best_bid()
+        if best is None:
+            return False
+        return best.price <= price if direction == "BUY" else best.price >= price
+
+    def available(self, direction, qty, price=None):
+        # Сколько из qty можно исполнить сразу (не больше qty): по суммарным
+        # объёмам уровней, без обхода заявок — O(число уровней)
+        counter = self.asks if direction == "BUY" else self.bids
+        total = 0
+        for level in counter:
+            if price is not None:
+                if direction == "BUY" and level.price > price:
+                    break
+                if direction == "SELL" and level.price < price:
+                    break
+            total += level.total
+            if total >= qty:
+                return qty
+        return total
+
+    def match(self, direction, qty, price=None):
+        # Подбор встречных заявок по приоритету цена-время. Книгу не меняет:
+        # возвращает список (заявка, объём), применяется через fill()
+        counter = self.asks if direction == "BUY" else self.bids
+        fills = []
+        for level in counter:
+            if price is not None:
+                if direction == "BUY" and level.price > price:
+                    break
+                if direction == "SELL" and level.price < price:
+                    break
+            for order in level.orders.values():
+                trade_qty = min(qty, order.remaining)
+                fills.append((order, trade_qty))
+                qty -= trade_qty
+                if qty == 0:
+                    return fills
+        return fills
+
+    def depth(self, side, limit=L2_DEPTH):
+        levels = []
+        for level in side:
+            if len(levels) == limit:
+                break
+            levels.append({"price": level.price, "qty": level.total})
+        return levels
+
+    def snapshot(self, limit):
+        snapshot = self.snapshots.get(limit)
+        if snapshot is not None:
+            return snapshot
+        with self.lock:
+            snapshots = self.snapshots
+            full = snapshots.get("full")
+            if full is None:
+                full = snapshots["full"] = (self.depth(self.bids), self.depth(self.asks))
+            bids, asks = full
+            snapshot = orjson.dumps({"bid_levels": bids[:limit], "ask_levels": asks[:limit]})
+            snapshots[limit] = snapshot
+        return snapshot
+
+    def take_changes(self):
+        # L2-дельта с прошлого вызова: новый объём уровня, 0 — уровень исчез
+        self.seq += 1
+        bids, asks = [], []
+        for direction, price in self.touched:
+            level = self.side(direction).levels.get(price)
+            (bids if direction == "BUY" else asks).append({"price": price, "qty": level.total if level else 0})
+        self.touched = set()
+        return self.seq, bids, asks
+
+    def fill(self, fills):
+        if fills:
+            self.snapshots = {}
+        for order, trade_qty in fills:
+            self.touched.add((order.direction, order.price))
+            side = self.side(order.direction)
+            level = side.levels[order.price]
+            order.filled += trade_qty
+            level.total -= trade_qty
+            if order.remaining == 0:
+                del self.orders[order.id]
+                self.index.pop(order.id, None)
+                side.remove(order)
+
+    def unfill(self, fills):
+        # Откат fill() при отказе атомарной пачки: полностью исполненные заявки
+        # возвращаются в голову своих уровней в прежнем порядке
+        if fills:
+            self.snapshots = {}
+        for order, trade_qty in reversed(fills):
+            self.touched.add((order.direction, order.price))
+            side = self.side(order.direction)
+            order.filled -= trade_qty
+            if order.id in self.orders:
+                side.levels[order.price].total += trade_qty
+            else:
+                self.orders[order.id] = order
+                self.index[order.id] = self
+                side.add(order)
+                side.levels[order.price].orders.move_to_end(order.id, last=False)
+
+
+class BookRegistry:
+    def __init__(self):
+        self.books = {}
+        self.index = {}
+        self.lock = threading.Lock()
+
+    def get(self, ticker):
+        book = self.books.get(ticker)
+        if book is None:
+            with self.lock:
+                book = self.books.get(ticker)
+                if book is None:
+                    book = self.books[ticker] = OrderBook(ticker, self.index)
+        return book
+
+    def snapshot(self, ticker, limit):
+        book = self.books.get(ticker)
+        if book is None:
+            return EMPTY_L2
+        return book.snapshot(limit)
+
+    def cached(self, ticker, limit):
+        # Готовый снимок без блокировок; None — его нужно собрать (snapshot)
+        book = self.books.get(ticker)
+        if book is None:
+            return EMPTY_L2
+        return book.snapshots.get(limit)
+
+    def drop(self, ticker):
+        # Книга удалённого инструмента; её заявки уже сняты (см. close_book)
+        with self.lock:
+            return self.books.pop(ticker, None)
+
+    def find(self, order_id):
+        book = self.index.get(order_id)
+        if book is None:
+            return None, None
+        return book, book.orders.get(order_id)
+
+    def clear(self):
+        with self.lock:
+            self.books = {}
+            self.index = {}
+
+    def reset(self):
+        # Очистка книг на месте, под books.lock и блокировками всех книг: команда,
+        # уже взявшая книгу и ждущая её блокировки, исполнится в пустой книге
+        # реестра. seq книг растёт дальше, снятые уровни уйдут подписчикам нулями
+        self.index.clear()
+        for book in self.books.values():
+            book.touched.update(("BUY", price) for price in book.bids.levels)
+            book.touched.update(("SELL", price) for price in book.asks.levels)
+            book.bids = BookSide(is_bid=True)
+            book.asks = BookSide(is_bid=False)
+            book.orders = {}
+            book.snapshots = {}
+
+    def load(self, db):
+        # Восстановление книг из limit_orders при старте. Порядок времени важен
+        # только внутри уровня, поэтому сортировка совпадает с частичным индексом
+        self.clear()
+        active = db.query(LimitOrderModel).filter(text(ACTIVE_ORDER_SQL)).order_by(
+            LimitOrderModel.ticker, LimitOrderModel.direction, LimitOrderModel.price, LimitOrderModel.timestamp
+        ).all()
+        for lo in active:
+            if lo.qty - lo.filled <= 0:
+                continue
+            self.get(lo.ticker).add(BookOrder(
+                id=lo.id,
+                user_id=lo.user_id,
+                direction=lo.direction,
+                price=lo.price,
+                qty=lo.qty,
+                filled=lo.filled,
+                timestamp=lo.timestamp,
+                post_only=lo.post_only
+            ))
+
+
+books = BookRegistry()
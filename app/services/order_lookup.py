@@ -0,0 +1,96 @@
+import uuid
+from collections import namedtuple
+from sqlalchemy import select, union_all, literal, literal_column, null, Integer, String, Boolean
+from app.models import LimitOrder as LimitOrderModel, MarketOrder as MarketOrderModel, OrderStatus
+from app.services.order_book import books
+
+# Заявка любого типа одной строкой: kind — LIMIT или MARKET,
+# у рыночной заявки price, filled, time_in_force и post_only равны None
+OrderRow = namedtuple("OrderRow", "kind id status user_id timestamp direction ticker qty price filled time_in_force post_only")
+
+
+def order_select(model, where):
+    # Заявки одной таблицы в колонках OrderRow
+    if model is LimitOrderModel:
+        return select(
+            literal("LIMIT").label("kind"), LimitOrderModel.id, LimitOrderModel.status, LimitOrderModel.user_id,
+            LimitOrderModel.timestamp, LimitOrderModel.direction, LimitOrderModel.ticker, LimitOrderModel.qty,
+            LimitOrderModel.price, LimitOrderModel.filled, LimitOrderModel.time_in_force, LimitOrderModel.post_only
+        ).where(*where)
+    return select(
+        literal("MARKET").label("kind"), MarketOrderModel.id, MarketOrderModel.status, MarketOrderModel.user_id,
+        MarketOrderModel.timestamp, MarketOrderModel.direction, MarketOrderModel.ticker, MarketOrderModel.qty,
+        null().cast(Integer).label("price"), null().cast(Integer).label("filled"),
+        null().cast(String).label("time_in_force"), null().cast(Boolean).label("post_only")
+    ).where(*where)
+
+
+def order_union(where):
+    # Обе таблицы заявок одним запросом UNION ALL; where(model) — условия для каждой.
+    # При ORDER BY timestamp SQLite сливает оба индекса по (user_id, timestamp) без сортировки
+    return union_all(*(order_select(model, where(model)) for model in (LimitOrderModel, MarketOrderModel)))
+
+
+def id_kind(order_id):
+    # Тип заявки по id (см. order_services.new_order_id) или None, если id не uuid
+    try:
+        value = uuid.UUID(order_id).int
+    except ValueError:
+        return None
+    return "MARKET" if value & 1 else "LIMIT"
+
+
+def order_queries(order_id):
+    # Поиск по первичному ключу сначала в таблице типа из id; вторая таблица
+    # нужна, только если там заявки нет (id, выданные до записи типа в id)
+    first, second = LimitOrderModel, MarketOrderModel
+    if id_kind(order_id) == "MARKET":
+        first, second = second, first
+    return [order_select(model, [model.id == order_id]) for model in (first, second)]
+
+
+def live_order(order_id):
+    # Заявка из книги в памяти: она новее SQL, который применяется из журнала
+    book, order = books.find(order_id)
+    if order is None:
+        return None
+    return OrderRow(
+        kind="LIMIT",
+        id=order.id,
+        status=OrderStatus.PARTIALLY_EXECUTED if order.filled > 0 else OrderStatus.NEW,
+        user_id=order.user_id,
+        timestamp=order.timestamp,
+        direction=order.direction,
+        ticker=book.ticker,
+        qty=order.qty,
+        price=order.price,
+        filled=order.filled,
+        time_in_force="GTC",
+        post_only=order.post_only
+    )
+
+
+def find_order(db, order_id):
+    # Живая заявка — из книги без SQL, остальные — по первичному ключу таблицы своего типа
+    row = live_order(order_id)
+    if row is not None:
+        return row
+    for query in order_queries(order_id):
+        row = db.execute(query).first()
+        if row is not None:
+            return OrderRow(*row)
+    return None
+
+
+async def stored_order(db, order_id):
+    # Заявка только из SQL (AsyncSession маршрутов чтения): книги живут в движке
+    for query in order_queries(order_id):
+        row = (await db.execute(query)).first()
+        if row is not None:
+            return OrderRow(*row)
+    return None
+
+
+async def user_orders(db, user_id):
+    query = order_union(lambda model: [model.user_id == user_id]).order_by(literal_column("timestamp"))
+    return [OrderRow(*row) for row in await db.execute(query)]
@@ -0,0 +1,328 @@
+from fastapi import HTTPException
+from app.models import OrderStatus
+from app.schemas import TimeInForce
+from app.services.order_book import books, BookOrder
+from app.services.instruments import instruments
+from app.services.balances import ledger, trade_deltas, hold_delta
+from app.services.market_data import hub
+from app.services.order_lookup import find_order
+from app.services.metrics import Stage, fills_total
+from app.services import logs
+from app.services.journal import journal, OrderAccepted, Fill, OrderCancelled, to_micros, from_micros
+import uuid
+from contextlib import nullcontext
+from datetime import datetime, timezone
+
+# Вспомогательная функция для проверки баланса (с учётом ещё не записанных в SQL сделок)
+def get_balance(db, user_id, ticker):
+    return ledger.get(user_id, ticker)
+
+def make_fills(order_id, user_id, ticker, direction, fills, timestamp, price=None):
+    # События сделок по встречным заявкам из книги; price=None — по цене встречной заявки
+    events = []
+    for counter, trade_qty in fills:
+        trade_price = counter.price if price is None else price
+        if direction == "BUY":
+            buyer_id, seller_id = user_id, counter.user_id
+        else:
+            buyer_id, seller_id = counter.user_id, user_id
+        events.append(Fill(
+            trade_id=str(uuid.uuid4()),
+            ticker=ticker,
+            taker_id=order_id,
+            maker_id=counter.id,
+            buyer_id=buyer_id,
+            seller_id=seller_id,
+            qty=trade_qty,
+            price=trade_price,
+            timestamp=timestamp
+        ))
+    return events
+
+def new_order_id(is_limit=True):
+    # Тип заявки записан в id: младший бит uuid4 — 0 у лимитной, 1 у рыночной,
+    # поиск по id идёт сразу в нужную таблицу (см. order_lookup.id_kind)
+    return str(uuid.UUID(int=uuid.uuid4().int & ~1 | (0 if is_limit else 1)))
+
+def settle_fills(db, ticker, fills, events, holds, ledger=ledger):
+    # Проводит изменения балансов по всем сделкам заявки и снимает резервы
+    # исполненных встречных заявок; при нехватке средств заявка отклоняется целиком
+    deltas = []
+    holds = list(holds)
+    for (counter, trade_qty), fill in zip(fills, events):
+        deltas.extend(trade_deltas(ticker, fill.buyer_id, fill.seller_id, fill.qty, fill.price))
+        holds.append(hold_delta(counter.user_id, ticker, counter.direction, counter.price, -trade_qty))
+    ledger.apply(deltas, holds)
+
+def check_order(body, is_limit):
+    # Проверка на корректность qty и price
+    if (is_limit and (body.qty <= 0 or body.price <= 0)) or (not is_limit and body.qty <= 0):
+        raise HTTPException(400, "Invalid qty or price")
+    if is_limit and body.post_only and body.time_in_force != TimeInForce.GTC:
+        raise HTTPException(400, "Post-only order must be GTC")
+
+def check_orders(bodies):
+    # Проверка всей пачки до исполнения по справочнику инструментов в памяти
+    for i, (body, is_limit) in enumerate(bodies):
+        try:
+            if not instruments.exists(body.ticker):
+                raise HTTPException(400, "Instrument not found")
+            check_order(body, is_limit)
+        except HTTPException as e:
+            raise HTTPException(e.status_code, f"Order {i}: {e.detail}")
+
+def execute_order(db, book, order_id, user_id, body, is_limit, timestamp, ledger=ledger):
+    # Сопоставление и проводка одной заявки; вызывается под book.lock.
+    # При отказе книга и балансы не меняются. Возвращает события для журнала
+    # (приём, сделки, снятие остатка IOC), события сделок, применённые сделки
+    # и поставленную в книгу заявку.
+    # ledger подменяется в офлайн-прогоне (bench.replay), там db=None
+    accepted = OrderAccepted(
+        order_id=order_id,
+        user_id=user_id,
+        ticker=body.ticker,
+        direction=body.direction.value,
+        is_limit=is_limit,
+        qty=body.qty,
+        price=body.price if is_limit else 0,
+        timestamp=timestamp,
+        time_in_force=body.time_in_force.value if is_limit else "GTC",
+        post_only=body.post_only if is_limit else False
+    )
+    # Приём заявки — одна проверка доступного остатка (amount - reserved)
+    if is_limit:
+        key, need = hold_delta(user_id, body.ticker, body.direction, body.price, body.qty)
+        if ledger.available(*key) < need:
+            raise HTTPException(400, f"Insufficient balance for {body.direction.value.lower()}")
+        # Остаток IOC и FOK в книгу не встаёт: резерв под него не ставится,
+        # а в журнал сразу за сделками идёт его снятие
+        rests = body.time_in_force == TimeInForce.GTC
+        with Stage("matching"):
+            if body.post_only and book.crosses(body.direction, body.price):
+                raise HTTPException(400, "Post-only order would match immediately")
+            if body.time_in_force == TimeInForce.FOK and book.available(body.direction, body.qty, body.price) < body.qty:
+                raise HTTPException(400, "Fill-or-kill order cannot be fully executed")
+            fills = book.match(body.direction, body.qty, body.price)
+            # BUY исполняется по цене встречной заявки, SELL — по своей цене
+            events = make_fills(order_id, user_id, body.ticker, body.direction, fills, timestamp,
+                                None if body.direction == "BUY" else body.price)
+        filled = sum(fill.qty for fill in events)
+        # Резерв ставится только на неисполненный остаток
+        with Stage("settlement"):
+            settle_fills(db, body.ticker, fills, events,
+                         [hold_delta(user_id, body.ticker, body.direction, body.price, body.qty - filled if rests else 0)], ledger)
+        with Stage("matching"):
+            book.fill(fills)
+        recorded = [accepted] + events
+        resting = None
+        if filled < body.qty:
+            if rests:
+                resting = BookOrder(
+                    id=order_id,
+                    user_id=user_id,
+                    direction=body.direction,
+                    price=body.price,
+                    qty=body.qty,
+                    filled=filled,
+                    timestamp=from_micros(timestamp),
+                    post_only=body.post_only
+                )
+                book.add(resting)
+            else:
+                recorded.append(OrderCancelled(order_id=order_id, ticker=body.ticker, timestamp=timestamp))
+        return recorded, events, fills, resting
+    # Рыночная заявка — только полное исполнение: проверка по объёмам уровней
+    # до подбора встречных заявок
+    with Stage("matching"):
+        available = book.available(body.direction, body.qty)
+        if not available:
+            raise HTTPException(400, "No counter orders for market order")
+        if available < body.qty:
+            raise HTTPException(400, "Market order not fully executed")
+        fills = book.match(body.direction, body.qty)
+    # Стоимость известна из того же прохода по книге, повторный обход не нужен
+    if body.direction == "BUY":
+        total_rub_needed = sum(trade_qty * counter.price for counter, trade_qty in fills)
+        if ledger.available(user_id, "RUB") < total_rub_needed:
+            raise HTTPException(400, "Insufficient balance for buy")
+    else:
+        if ledger.available(user_id, body.ticker) < body.qty:
+            raise HTTPException(400, "Insufficient balance for sell")
+    with Stage("matching"):
+        events = make_fills(order_id, user_id, body.ticker, body.direction, fills, timestamp)
+    with Stage("settlement"):
+        settle_fills(db, body.ticker, fills, events, [], ledger)
+    with Stage("matching"):
+        book.fill(fills)
+    return [accepted] + events, events, fills, None
+
+# Выполняется в потоке исполнителя тикера (см. app.services.sequencer),
+# поэтому для одного тикера команды никогда не пересекаются. SQL здесь
+# только читается: принятые события уходят в журнал, а вызывающий ждёт
+# возвращённый Future (запись на диск и применение к SQL). В журнал события
+# отдаются, не отпуская book.lock: снимок книг (app.services.snapshots) берётся
+# под блокировками всех книг, и seq журнала в нём согласован с их состоянием
+def place_order(db, user_id, body, is_limit):
+    journal.check()
+    order_id = new_order_id(is_limit)
+    with Stage("validation"):
+        # Проверка существования инструмента
+        if not instruments.exists(body.ticker):
+            raise HTTPException(400, "Instrument not found")
+        check_order(body, is_limit)
+    book = books.get(body.ticker)
+    timestamp = to_micros(datetime.now(timezone.utc))
+    with book.lock:
+        recorded, events, _, _ = execute_order(db, book, order_id, user_id, body, is_limit, timestamp)
+        update = hub.capture(book, events)
+        future = journal.append(recorded, result=order_id)
+    if events:
+        fills_total.inc(body.ticker, amount=len(events))
+    if not is_limit:
+        logs.info("market_order", sampled=True, user_id=user_id, order_id=order_id, ticker=body.ticker, fills=len(events))
+    hub.publish_when_done(future, update)
+    return future
+
+def execute_orders(db, book, user_id, items, atomic, timestamp, ledger=ledger, new_id=new_order_id):
+    # Исполнение пачки заявок одного тикера под book.lock (и ledger.lock в
+    # атомарном режиме). Возвращает результаты по заявкам, события для
+    # журнала и события сделок
+    results = []
+    journal_events = []
+    trades = []
+    applied = []
+    checkpoint = ledger.checkpoint() if atomic else None
+    for i, body, is_limit in items:
+        order_id = new_id(is_limit)
+        try:
+            recorded, events, fills, resting = execute_order(db, book, order_id, user_id, body, is_limit, timestamp, ledger)
+        except HTTPException as e:
+            if not atomic:
+                results.append((i, {"success": False, "error": e.detail}))
+                continue
+            for fills, resting in reversed(applied):
+                if resting is not None:
+                    book.cancel(resting.id)
+                book.unfill(fills)
+            ledger.rollback(checkpoint)
+            raise HTTPException(e.status_code, f"Order {i}: {e.detail}")
+        applied.append((fills, resting))
+        journal_events.extend(recorded)
+        trades.extend(events)
+        results.append((i, {"success": True, "order_id": order_id}))
+    return results, journal_events, trades
+
+def place_orders(db, user_id, ticker, items, atomic):
+    # Пачка заявок одного тикера [(номер в пачке, тело, is_limit)]: один проход
+    # исполнителя и одна запись в журнал. atomic — первая же отклонённая заявка
+    # откатывает всю пачку, иначе отказ возвращается по каждой заявке отдельно
+    journal.check()
+    if not instruments.exists(ticker):
+        # Инструмент удалён после проверки пачки в HTTP-воркере
+        if atomic:
+            raise HTTPException(400, f"Order {items[0][0]}: Instrument not found")
+        return [(i, {"success": False, "error": "Instrument not found"}) for i, _, _ in items]
+    book = books.get(ticker)
+    timestamp = to_micros(datetime.now(timezone.utc))
+    with book.lock, ledger.lock if atomic else nullcontext():
+        results, journal_events, trades = execute_orders(db, book, user_id, items, atomic, timestamp)
+        if not journal_events:
+            return results
+        update = hub.capture(book, trades)
+        future = journal.append(journal_events, result=results)
+    if trades:
+        fills_total.inc(ticker, amount=len(trades))
+    hub.publish_when_done(future, update)
+    return future
+
+def check_cancel(db, book, order_id, user_id=None):
+    # Живая заявка, которую можно отменить, либо None, если она уже отменена.
+    # Чужая заявка (user_id не None и не владелец) не видна: "Order not found"
+    order = book.orders.get(order_id) if book is not None else None
+    if order is not None:
+        if user_id is not None and order.user_id != user_id:
+            raise HTTPException(404, "Order not found")
+        # Нельзя отменить частично исполненный ордер
+        if order.filled > 0:
+            raise HTTPException(400, "Order already executed or cancelled")
+        return order
+    # Заявки нет в книге: она уже исполнена или отменена
+    row = find_order(db, order_id)
+    if row is None or user_id is not None and row.user_id != user_id:
+        raise HTTPException(404, "Order not found")
+    if row.status != OrderStatus.CANCELLED:
+        raise HTTPException(400, "Order already executed or cancelled")
+    return None
+
+def cancel_live(db, book, order, timestamp, ledger=ledger):
+    # Вызывается под book.lock; None — заявка уже снята из книги
+    if book.cancel(order.id) is None:
+        return None
+    # Резерв освобождается сразу в pending, в balances его снимет применитель журнала
+    ledger.apply([], [hold_delta(order.user_id, book.ticker, order.direction, order.price, -order.remaining)])
+    return OrderCancelled(order_id=order.id, ticker=book.ticker, timestamp=timestamp)
+
+def cancel_order(db, order_id, user_id=None):
+    journal.check()
+    book, _ = books.find(order_id)
+    if book is None:
+        check_cancel(db, None, order_id, user_id)
+        return None
+    with book.lock:
+        order = check_cancel(db, book, order_id, user_id)
+        if order is None:
+            return None
+        event = cancel_live(db, book, order, to_micros(datetime.now(timezone.utc)))
+        update = hub.capture(book, [])
+        future = journal.append([event])
+    hub.publish_when_done(future, update)
+    return future
+
+def cancel_orders(db, ticker, items, atomic, user_id=None):
+    # Отмена пачки [(номер в пачке, order_id)] живых заявок одного тикера
+    # (ticker=None — заявок, которых уже нет в книгах). В атомарном режиме
+    # сначала проверяется вся пачка, отмена после проверки отказать не может.
+    # user_id — владелец заявок (None — без проверки, для администратора)
+    journal.check()
+    book = books.get(ticker) if ticker is not None else None
+    timestamp = to_micros(datetime.now(timezone.utc))
+    results = []
+    todo = []
+    with book.lock if book is not None else nullcontext():
+        for i, order_id in items:
+            try:
+                order = check_cancel(db, book, order_id, user_id)
+            except HTTPException as e:
+                if atomic:
+                    raise HTTPException(e.status_code, f"Order {i}: {e.detail}")
+                results.append((i, {"success": False, "error": e.detail}))
+                continue
+            if order is not None:
+                todo.append(order)
+            results.append((i, {"success": True}))
+        events = [event for event in (cancel_live(db, book, order, timestamp) for order in todo) if event is not None]
+        if not events:
+            return results
+        update = hub.capture(book, [])
+        future = journal.append(events, result=results)
+    hub.publish_when_done(future, update)
+    return future
+
+def close_book(db, ticker):
+    # Снятие всех заявок книги удаляемого инструмента и удаление самой книги;
+    # вызывается в исполнителе тикера после удаления тикера из справочника.
+    # Частично исполненные заявки снимаются тоже, резервы освобождаются
+    book = books.books.get(ticker)
+    if book is None:
+        return None
+    timestamp = to_micros(datetime.now(timezone.utc))
+    with book.lock:
+        events = [cancel_live(db, book, order, timestamp) for order in list(book.orders.values())]
+        update = hub.capture(book, [])
+        future = journal.append(events) if events else None
+    # Вне book.lock: снимок книг держит books.lock и ждёт блокировки книг
+    books.drop(ticker)
+    if future is None:
+        return None
+    hub.publish_when_done(future, update)
+    return future
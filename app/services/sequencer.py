@@ -0,0 +1,63 @@
+import asyncio
+import contextvars
+from concurrent.futures import Future
+from app.database import SessionLocal
+from app.services.metrics import Stage
+
+
+def run_in_session(fn, *args):
+    db = SessionLocal()
+    try:
+        return fn(db, *args)
+    finally:
+        db.close()
+
+
+class Sequencer:
+    # Один исполнитель на тикер: команды тикера выполняются строго по очереди,
+    # разные тикеры — параллельно в пуле потоков, не блокируя event loop
+    def __init__(self):
+        self.queues = {}
+        self.tasks = {}
+
+    async def submit(self, ticker, fn, *args):
+        future = asyncio.get_running_loop().create_future()
+        queue = self.queues.get(ticker)
+        if queue is None:
+            queue = self.queues[ticker] = asyncio.Queue()
+            self.tasks[ticker] = asyncio.create_task(self._worker(ticker, queue))
+        # Команда выполняется в контексте вызывающего, а не исполнителя
+        # (метрики этапов запроса)
+        queue.put_nowait((fn, args, future, contextvars.copy_context()))
+        result = await future
+        # Команда может вернуть Future журнала: исполнитель уже перешёл к
+        # следующей команде, а вызывающий ждёт записи на диск
+        if isinstance(result, Future):
+            with Stage("commit"):
+                result = await asyncio.wrap_future(result)
+        return result
+
+    async def _worker(self, ticker, queue):
+        # Исполнитель живёт, пока у тикера есть команды
+        try:
+            while not queue.empty():
+                fn, args, future, context = queue.get_nowait()
+                try:
+                    result = await asyncio.to_thread(context.run, run_in_session, fn, *args)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            del self.queues[ticker]
+            del self.tasks[ticker]
+
+    async def join(self):
+        # Дожидаемся уже принятых команд (при остановке приложения)
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks.values()), return_exceptions=True)
+
+
+sequencer = Sequencer()
@@ -0,0 +1,161 @@
+import os
+import struct
+import threading
+import time
+import zlib
+from contextlib import ExitStack
+from app.services.order_book import books, BookOrder
+from app.services.journal import journal, pack_fields, unpack_fields, to_micros, from_micros, OrderAccepted, Fill, OrderCancelled
+from app.services import logs
+
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "./exchange.snapshot")
+SNAPSHOT_INTERVAL_SECONDS = int(os.getenv("SNAPSHOT_INTERVAL_SECONDS", "60"))
+
+# Файл снимка: MAGIC, заголовок (seq журнала, число заявок, crc32 тела) и тело —
+# стоящие заявки всех книг, внутри уровня в порядке очереди. Поля заявки:
+# ticker, id, user_id, BUY?, price, qty, filled, timestamp (мкс), post_only
+MAGIC = b"EXSNAP01"
+HEADER = struct.Struct("<QQI")
+ORDER_FIELDS = "sss?qqqq?"
+
+
+def replay(records):
+    # Изменения книг по событиям журнала: как их делал исполнитель, но без проверок
+    for _, event in records:
+        if isinstance(event, OrderAccepted):
+            if event.is_limit:
+                books.get(event.ticker).add(BookOrder(
+                    event.order_id, event.user_id, event.direction, event.price, event.qty,
+                    timestamp=from_micros(event.timestamp), post_only=event.post_only
+                ))
+        elif isinstance(event, Fill):
+            for order_id in (event.maker_id, event.taker_id):
+                book, order = books.find(order_id)
+                if order is not None:
+                    book.fill([(order, event.qty)])
+        elif isinstance(event, OrderCancelled):
+            book, _ = books.find(event.order_id)
+            if book is not None:
+                book.cancel(event.order_id)
+
+
+class BookSnapshots:
+    # Периодические снимки книг заявок. Старт движка — снимок плюс события
+    # журнала после него, время не зависит от объёма limit_orders. После записи
+    # снимка журнал сжимается до событий, ещё нужных SQL или следующему старту
+    def __init__(self, path=SNAPSHOT_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def capture(self):
+        # Согласованный срез: books.lock не даёт появиться новой книге, под
+        # блокировками всех книг ни одна команда не меняет книгу и не пишет в журнал
+        with books.lock, ExitStack() as stack:
+            book_list = sorted(books.books.items())
+            for _, book in book_list:
+                stack.enter_context(book.lock)
+            with journal.cond:
+                seq = journal.seq
+            orders = [
+                (ticker, order.id, order.user_id, order.direction == "BUY", order.price, order.qty, order.filled, order.timestamp, order.post_only)
+                for ticker, book in book_list
+                for side in (book.bids, book.asks)
+                for level in side.levels.values()
+                for order in level.orders.values()
+            ]
+        return seq, orders
+
+    def save(self):
+        if journal.failed is not None:
+            # В книгах могут быть заявки, не попавшие в журнал
+            return None
+        started = time.perf_counter()
+        with self.lock:
+            seq, orders = self.capture()
+            body = b"".join(pack_fields(ORDER_FIELDS, order[:7] + (to_micros(order[7]), order[8])) for order in orders)
+            tmp = self.path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(MAGIC + HEADER.pack(seq, len(orders), zlib.crc32(body)) + body)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        dropped = journal.compact(min(seq, journal.applied))
+        logs.info("snapshot_saved", seq=seq, orders=len(orders), journal_bytes_dropped=dropped, seconds=round(time.perf_counter() - started, 4))
+        return seq
+
+    def load(self):
+        # (seq, заявки) или None, если снимка нет или он повреждён
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        start = len(MAGIC) + HEADER.size
+        if not data.startswith(MAGIC) or len(data) < start:
+            return None
+        seq, count, crc = HEADER.unpack_from(data, len(MAGIC))
+        body = data[start:]
+        if zlib.crc32(body) != crc:
+            return None
+        orders = []
+        pos = 0
+        for _ in range(count):
+            values, pos = unpack_fields(ORDER_FIELDS, body, pos)
+            orders.append(values)
+        return seq, orders
+
+    def restore(self, db, records):
+        # Книги из снимка и записей журнала после него (records — из journal.open()).
+        # Если снимка нет, он повреждён или журнал не покрывает все события после
+        # него, книги строятся из limit_orders
+        started = time.perf_counter()
+        snapshot = self.load()
+        tail = None
+        if snapshot is not None:
+            seq, orders = snapshot
+            tail = [(s, event) for s, event in records if s > seq]
+            if seq > journal.seq or len(tail) != journal.seq - seq:
+                logs.info("snapshot_unusable", seq=seq, journal_seq=journal.seq)
+                tail = None
+        if tail is None:
+            books.load(db)
+        else:
+            books.clear()
+            for ticker, order_id, user_id, is_buy, price, qty, filled, timestamp, post_only in orders:
+                books.get(ticker).add(BookOrder(
+                    order_id, user_id, "BUY" if is_buy else "SELL", price, qty, filled, from_micros(timestamp), post_only
+                ))
+            replay(tail)
+        logs.info(
+            "books_restored", source="sql" if tail is None else "snapshot", journal_events=len(tail or ()),
+            orders=len(books.index), seconds=round(time.perf_counter() - started, 4)
+        )
+
+    def remove(self):
+        # Состояние движка сброшено мимо журнала (регистрация пользователя);
+        # вызывающий держит self.lock
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def start(self, interval=SNAPSHOT_INTERVAL_SECONDS):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._loop, args=(interval,), name="book-snapshots", daemon=True)
+        self.thread.start()
+
+    def _loop(self, interval):
+        while not self.stop_event.wait(interval):
+            try:
+                self.save()
+            except Exception:
+                logs.error("snapshot_failed")
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+snapshots = BookSnapshots()
@@ -0,0 +1,60 @@
+import argparse
+import json
+import sys
+
+# Сравнение двух результатов bench.run: латентность (p50/p99/p999) по ручкам,
+# пропускная способность и микробенчмарки. Код возврата 1, если что-то
+# ухудшилось больше порога
+#
+#   python -m bench.compare old.json new.json --threshold 10
+
+
+def metrics(result):
+    # {имя метрики: (значение, больше — лучше)}
+    found = {}
+    for target, load in result.get("load", {}).items():
+        found[f"{target} orders_per_sec"] = (load["orders_per_sec"], True)
+        found[f"{target} cpu_per_request_ms"] = (load.get("cpu_per_request_ms"), False)
+        found[f"{target} restart_s"] = (load.get("restart_s"), False)
+        burst = load.get("read_burst")
+        if burst:
+            found[f"{target} read_burst requests_per_sec"] = (burst["requests_per_sec"], True)
+            for route, endpoint in burst["endpoints"].items():
+                found[f"{target} read_burst {route} p99_ms"] = (endpoint["latency_ms"]["p99"], False)
+        for route, endpoint in load["endpoints"].items():
+            for key in ("p50", "p99", "p999"):
+                found[f"{target} {route} {key}_ms"] = (endpoint["latency_ms"][key], False)
+    for name, bench in result.get("matching", {}).items():
+        if "ops_per_sec" in bench:
+            found[f"matching {name} ops_per_sec"] = (bench["ops_per_sec"], True)
+            found[f"matching {name} p99_us"] = (bench["p99_us"], False)
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.compare", description="Compare two bench.run results")
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=10.0, help="допустимое ухудшение, %%")
+    args = parser.parse_args(argv)
+    with open(args.old) as f:
+        old = metrics(json.load(f))
+    with open(args.new) as f:
+        new = metrics(json.load(f))
+    regressions = 0
+    for name in sorted(set(old) & set(new)):
+        (before, higher_is_better), (after, _) = old[name], new[name]
+        if not before or after is None:
+            continue
+        change = (after - before) / before * 100
+        worse = -change if higher_is_better else change
+        mark = ""
+        if worse > args.threshold:
+            mark = "  REGRESSION"
+            regressions += 1
+        print(f"{name:70} {before:12.3f} -> {after:12.3f} {change:+7.1f}%{mark}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
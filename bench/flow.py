@@ -0,0 +1,105 @@
+import json
+import random
+
+# Поток запросов для нагрузочного прогона. Одна запись — один HTTP-запрос:
+#   {"user": 0, "route": "POST /api/v1/order", "json": {...}}
+#   {"user": 0, "route": "DELETE /api/v1/order/{order_id}", "ref": 12}
+# ref — номер записи того же пользователя, чей order_id подставляется в путь.
+# lane — поток прогона (по умолчанию по пользователю, чтобы ref были разрешены).
+# Пользователи и инструменты задаются числом и создаются при подготовке прогона
+
+ORDER_ROUTES = ("POST /api/v1/order", "POST /api/v1/order/batch")
+
+
+def tickers_for(count):
+    # Тикеры вида BENCHA, BENCHB, ... — проходят проверку ^[A-Z]{2,10}$
+    return ["BENCH" + "ABCDEFGHIJKLMNOPQRSTUVWXYZ"[i] for i in range(count)]
+
+
+def synthetic(count, users, tickers, seed=1, mid=1000, spread=20, batch_size=10):
+    # Смесь маркет-мейкинга и агрессивных заявок вокруг фиксированной середины
+    rnd = random.Random(seed)
+    flow = []
+    placed = {user: [] for user in range(users)}
+    weights = [
+        ("limit", 55), ("market", 8), ("cancel", 15), ("batch", 2),
+        ("orderbook", 12), ("balance", 5), ("get_order", 3),
+    ]
+    kinds = [kind for kind, _ in weights]
+    cum = [weight for _, weight in weights]
+
+    def limit_body(ticker):
+        direction = rnd.choice(("BUY", "SELL"))
+        offset = rnd.randint(-spread, spread)
+        price = mid + offset if direction == "BUY" else mid - offset
+        return {"direction": direction, "ticker": ticker, "qty": rnd.randint(1, 10), "price": price}
+
+    for n in range(count):
+        user = rnd.randrange(users)
+        ticker = rnd.choice(tickers)
+        kind = rnd.choices(kinds, cum)[0]
+        if kind in ("cancel", "get_order") and not placed[user]:
+            kind = "limit"
+        if kind == "limit":
+            record = {"user": user, "route": "POST /api/v1/order", "json": limit_body(ticker)}
+            placed[user].append(n)
+        elif kind == "market":
+            record = {"user": user, "route": "POST /api/v1/order", "json": {
+                "direction": rnd.choice(("BUY", "SELL")), "ticker": ticker, "qty": rnd.randint(1, 3)}}
+        elif kind == "batch":
+            record = {"user": user, "route": "POST /api/v1/order/batch", "json": {
+                "orders": [limit_body(ticker) for _ in range(batch_size)]}}
+        elif kind == "cancel":
+            record = {"user": user, "route": "DELETE /api/v1/order/{order_id}", "ref": placed[user].pop(rnd.randrange(len(placed[user])))}
+        elif kind == "get_order":
+            record = {"user": user, "route": "GET /api/v1/order/{order_id}", "ref": rnd.choice(placed[user])}
+        elif kind == "orderbook":
+            record = {"user": user, "route": "GET /api/v1/public/orderbook/{ticker}", "ticker": ticker}
+        else:
+            record = {"user": user, "route": "GET /api/v1/balance"}
+        flow.append(record)
+    return flow
+
+
+def read_burst(count, users, tickers, seed=1):
+    # Только чтение после основного прогона: стакан, лента сделок, балансы,
+    # список и история заявок. Записи распределяются по потокам по кругу,
+    # поэтому параллельность не ограничена числом пользователей
+    rnd = random.Random(seed)
+    routes = [
+        ("GET /api/v1/public/orderbook/{ticker}", 3), ("GET /api/v1/public/transactions/{ticker}", 3),
+        ("GET /api/v1/balance", 2), ("GET /api/v1/order", 1), ("GET /api/v1/order/history", 1),
+    ]
+    names = [route for route, _ in routes]
+    cum = [weight for _, weight in routes]
+    return [
+        {"user": rnd.randrange(users), "lane": n, "route": rnd.choices(names, cum)[0], "ticker": rnd.choice(tickers)}
+        for n in range(count)
+    ]
+
+
+def load(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save(path, flow):
+    with open(path, "w") as f:
+        for record in flow:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+
+def flow_users(flow):
+    return max(record["user"] for record in flow) + 1
+
+
+def flow_tickers(flow):
+    tickers = set()
+    for record in flow:
+        if "ticker" in record:
+            tickers.add(record["ticker"])
+        body = record.get("json") or {}
+        for order in body.get("orders", [body]):
+            if "ticker" in order:
+                tickers.add(order["ticker"])
+    return sorted(tickers)
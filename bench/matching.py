@@ -0,0 +1,90 @@
+import random
+import time
+from datetime import datetime, timezone
+from app.services.order_book import OrderBook, BookOrder
+from bench.stats import percentile
+
+# Микробенчмарки книги заявок без HTTP, SQL и журнала: сопоставление
+# (match — план, fill — применение), постановка и отмена заявок
+
+
+def make_book(levels, per_level, rnd, mid=1000):
+    book = OrderBook("BENCH")
+    now = datetime.now(timezone.utc)
+    n = 0
+    for i in range(1, levels + 1):
+        for _ in range(per_level):
+            for direction, price in (("BUY", mid - i), ("SELL", mid + i)):
+                n += 1
+                book.add(BookOrder(f"o{n}", "maker", direction, price, rnd.randint(1, 10), timestamp=now))
+    return book, n
+
+
+def timed(samples, fn, *args):
+    started = time.perf_counter_ns()
+    result = fn(*args)
+    samples.append(time.perf_counter_ns() - started)
+    return result
+
+
+def summarize_ns(samples):
+    samples = sorted(samples)
+    total = sum(samples)
+    return {
+        "ops": len(samples),
+        "ops_per_sec": len(samples) / (total / 1e9) if total else None,
+        "p50_us": percentile(samples, 50) / 1000,
+        "p99_us": percentile(samples, 99) / 1000,
+        "p999_us": percentile(samples, 99.9) / 1000,
+    }
+
+
+def run_matching(ops, seed=1, levels=200, per_level=5):
+    rnd = random.Random(seed)
+    book, n = make_book(levels, per_level, rnd)
+    now = datetime.now(timezone.utc)
+    results = {"book": {"levels_per_side": levels, "orders_per_level": per_level}}
+
+    # Агрессивная лимитная заявка, снимающая 1-3 уровня; снятая ликвидность
+    # возвращается вне замера, чтобы глубина книги не менялась
+    plan, fill = [], []
+    for _ in range(ops):
+        direction = rnd.choice(("BUY", "SELL"))
+        qty = rnd.randint(1, 3 * per_level * 5)
+        price = 1000 + 3 if direction == "BUY" else 1000 - 3
+        fills = timed(plan, book.match, direction, qty, price)
+        timed(fill, book.fill, fills)
+        for order, trade_qty in fills:
+            if order.remaining == 0:
+                order.filled = 0
+                book.add(order)
+            else:
+                order.filled -= trade_qty
+                book.side(order.direction).levels[order.price].total += trade_qty
+    results["match_limit_order"] = summarize_ns([a + b for a, b in zip(plan, fill)])
+    results["match_plan"] = summarize_ns(plan)
+    results["fill"] = summarize_ns(fill)
+
+    # Постановка пассивных заявок и их отмена
+    add, cancel = [], []
+    ids = []
+    for _ in range(ops):
+        n += 1
+        direction = rnd.choice(("BUY", "SELL"))
+        offset = rnd.randint(1, levels)
+        order = BookOrder(f"o{n}", "maker", direction, 1000 - offset if direction == "BUY" else 1000 + offset, 1, timestamp=now)
+        timed(add, book.add, order)
+        ids.append(order.id)
+    rnd.shuffle(ids)
+    for order_id in ids:
+        timed(cancel, book.cancel, order_id)
+    results["add"] = summarize_ns(add)
+    results["cancel"] = summarize_ns(cancel)
+
+    # L2-снимок без кэша (после каждого изменения книги кэш сбрасывается)
+    depth = []
+    for _ in range(min(ops, 2000)):
+        book.snapshots = {}
+        timed(depth, book.snapshot, 10)
+    results["l2_snapshot"] = summarize_ns(depth)
+    return results
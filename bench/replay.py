@@ -0,0 +1,282 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from fastapi import HTTPException
+from app.routes.order import parse_order, merge_results, MAX_BATCH_SIZE
+from app.services.balances import MemoryLedger
+from app.services.order_book import BookRegistry
+from app.services.order_services import check_order, check_cancel, execute_order, execute_orders, cancel_live
+from app.services.journal import to_micros
+from bench import flow as flows
+from bench.run import git_commit
+
+# Офлайн-прогон записанного потока запросов (формат bench.flow) через тот же
+# код сопоставления, что и POST /api/v1/order, без HTTP, SQL и журнала: книги —
+# свои BookRegistry, балансы — MemoryLedger. Время логическое (номер записи),
+# id заявок — порядковые, поэтому одинаковый поток даёт одинаковые сделки,
+# книги и балансы. Результат — сделки, итоговое состояние, дайджесты и скорость.
+#
+#   python -m bench.replay --flow flow.jsonl --out replay.json
+#   python -m bench.replay --flow flow.jsonl --expect replay.json
+
+# Начало логического времени: запись n исполняется в START + n микросекунд
+START = to_micros(datetime(2024, 1, 1, tzinfo=timezone.utc))
+
+
+class Replay:
+    def __init__(self, users, tickers, rub, lots):
+        self.user_ids = [f"user{n:04d}" for n in range(users)]
+        self.tickers = set(tickers)
+        balances = {}
+        for user_id in self.user_ids:
+            balances[(user_id, "RUB")] = rub
+            for ticker in tickers:
+                balances[(user_id, ticker)] = lots
+        self.ledger = MemoryLedger(balances)
+        self.books = BookRegistry()
+        self.orders = 0
+        # Номер записи -> order_id принятой заявки, для ссылок ref
+        self.order_ids = {}
+        self.trades = []
+        self.accepted = 0
+        self.cancelled = 0
+        self.rejected = defaultdict(int)
+        self.skipped = defaultdict(int)
+
+    def new_id(self, is_limit=True):
+        self.orders += 1
+        return f"o{self.orders:08d}"
+
+    def check(self, body, is_limit):
+        if body.ticker not in self.tickers:
+            raise HTTPException(400, "Instrument not found")
+        check_order(body, is_limit)
+
+    def place(self, n, user_id, body, is_limit):
+        self.check(body, is_limit)
+        book = self.books.get(body.ticker)
+        order_id = self.new_id()
+        _, events, _, _ = execute_order(None, book, order_id, user_id, body, is_limit, START + n, self.ledger)
+        self.trades.extend(events)
+        self.order_ids[n] = order_id
+        self.accepted += 1
+
+    def place_batch(self, n, user_id, orders, atomic):
+        # Разбор и разбиение по тикерам как в POST /api/v1/order/batch
+        if not orders or len(orders) > MAX_BATCH_SIZE:
+            raise HTTPException(400, f"Batch must contain 1..{MAX_BATCH_SIZE} orders")
+        by_ticker = defaultdict(list)
+        for i, item in enumerate(orders):
+            try:
+                body, is_limit = parse_order(item)
+            except Exception as e:
+                raise HTTPException(400, f"Invalid order {i}: {e}")
+            try:
+                self.check(body, is_limit)
+            except HTTPException as e:
+                raise HTTPException(e.status_code, f"Order {i}: {e.detail}")
+            by_ticker[body.ticker].append((i, body, is_limit))
+        if atomic and len(by_ticker) > 1:
+            raise HTTPException(400, "Atomic batch must target a single instrument")
+        groups = []
+        for ticker, items in by_ticker.items():
+            results, _, trades = execute_orders(
+                None, self.books.get(ticker), user_id, items, atomic, START + n, self.ledger, self.new_id
+            )
+            self.trades.extend(trades)
+            groups.append(results)
+        for result in merge_results(groups):
+            if result["success"]:
+                self.accepted += 1
+            else:
+                self.rejected[result["error"]] += 1
+
+    def cancel(self, n, user_id, order_id):
+        book, order = self.books.find(order_id)
+        if order is None:
+            # Все заявки прогона известны: не в книге — значит исполнена или отменена
+            raise HTTPException(400, "Order already executed or cancelled")
+        check_cancel(None, book, order_id, user_id)
+        cancel_live(None, book, order, START + n, self.ledger)
+        self.cancelled += 1
+
+    def run(self, records):
+        for n, record in records:
+            route = record["route"]
+            try:
+                if route == "POST /api/v1/order":
+                    if "error" in record:
+                        raise record["error"]
+                    body, is_limit = record["parsed"]
+                    self.place(n, self.user_ids[record["user"]], body, is_limit)
+                elif route == "POST /api/v1/order/batch":
+                    body = record["json"]
+                    self.place_batch(n, self.user_ids[record["user"]], body["orders"], bool(body.get("atomic", False)))
+                elif route == "DELETE /api/v1/order/{order_id}":
+                    order_id = self.order_ids.get(record["ref"])
+                    if order_id is None:
+                        self.skipped[route] += 1
+                        continue
+                    self.cancel(n, self.user_ids[record["user"]], order_id)
+                else:
+                    # Чтения не меняют состояние и в прогон не входят
+                    self.skipped[route] += 1
+            except HTTPException as e:
+                self.rejected[e.detail] += 1
+
+
+def prepare(flow):
+    # Разбор тел одиночных заявок вне замера: parsed — (тело, is_limit), error — отказ
+    records = []
+    for n, record in enumerate(flow):
+        if record["route"] == "POST /api/v1/order":
+            try:
+                record = dict(record, parsed=parse_order(record["json"]))
+            except Exception as e:
+                record = dict(record, error=HTTPException(400, f"Invalid order: {e}"))
+        records.append((n, record))
+    return records
+
+
+def trade_line(fill):
+    # trade_id не входит: он случайный (uuid4)
+    return f"{fill.ticker},{fill.taker_id},{fill.maker_id},{fill.buyer_id},{fill.seller_id},{fill.qty},{fill.price},{fill.timestamp}\n"
+
+
+def book_state(book):
+    return {
+        "bid_levels": book.depth(book.bids, limit=None),
+        "ask_levels": book.depth(book.asks, limit=None),
+        "orders": len(book.orders),
+    }
+
+
+def digest(lines):
+    h = hashlib.sha256()
+    for line in lines:
+        h.update(line.encode())
+    return h.hexdigest()
+
+
+def report(replay, flow, parse_s, execute_s):
+    trades = replay.trades
+    books = {ticker: book_state(replay.books.books[ticker]) for ticker in sorted(replay.books.books)}
+    balances = replay.ledger.balances()
+    balance_lines = [f"{user_id},{ticker},{amount},{reserved}\n" for (user_id, ticker), (amount, reserved) in sorted(balances.items())]
+    digests = {
+        "trades": digest(trade_line(fill) for fill in trades),
+        "books": digest([json.dumps(books, sort_keys=True)]),
+        "balances": digest(balance_lines),
+    }
+    digests["state"] = digest([digests["trades"], digests["books"], digests["balances"]])
+    orders = 0
+    for record in flow:
+        if record["route"] in flows.ORDER_ROUTES:
+            body = record["json"]
+            orders += len(body["orders"]) if "orders" in body else 1
+    mutations = sum(1 for record in flow if record["route"] in flows.ORDER_ROUTES or record["route"].startswith("DELETE "))
+    return {
+        "records": len(flow),
+        "orders_submitted": orders,
+        "orders_accepted": replay.accepted,
+        "orders_cancelled": replay.cancelled,
+        "rejected": dict(sorted(replay.rejected.items())),
+        "skipped": dict(sorted(replay.skipped.items())),
+        "trades": {
+            "count": len(trades),
+            "volume": sum(fill.qty for fill in trades),
+            "turnover": sum(fill.qty * fill.price for fill in trades),
+        },
+        "books": books,
+        "balances": {
+            "count": len(balances),
+            "totals": totals(balances),
+        },
+        "digests": digests,
+        "throughput": {
+            "parse_s": parse_s,
+            "execute_s": execute_s,
+            "commands_per_sec": mutations / execute_s if execute_s else None,
+            "orders_per_sec": orders / execute_s if execute_s else None,
+            "trades_per_sec": len(trades) / execute_s if execute_s else None,
+        },
+    }
+
+
+def totals(balances):
+    # Сумма по тикеру не меняется сделками: проверка сохранения средств
+    result = defaultdict(lambda: [0, 0])
+    for (_, ticker), (amount, reserved) in balances.items():
+        result[ticker][0] += amount
+        result[ticker][1] += reserved
+    return {ticker: {"amount": amount, "reserved": reserved} for ticker, (amount, reserved) in sorted(result.items())}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.replay", description="Offline deterministic replay of an order flow")
+    parser.add_argument("--flow", help="JSONL с записанным потоком запросов (по умолчанию синтетический)")
+    parser.add_argument("--requests", type=int, default=100000, help="размер синтетического потока")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--tickers", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--rub", type=int, default=10 ** 9, help="начальный рублёвый баланс пользователя")
+    parser.add_argument("--lots", type=int, default=10 ** 6, help="начальный баланс по каждому инструменту")
+    parser.add_argument("--trades", help="записать сделки в CSV")
+    parser.add_argument("--expect", help="отчёт прошлого прогона: сравнить дайджесты, при расхождении код выхода 1")
+    parser.add_argument("--out", help="файл результата (по умолчанию stdout)")
+    args = parser.parse_args(argv)
+
+    if args.flow:
+        flow = flows.load(args.flow)
+    else:
+        flow = flows.synthetic(args.requests, args.users, flows.tickers_for(args.tickers), seed=args.seed)
+
+    started = time.perf_counter()
+    records = prepare(flow)
+    parse_s = time.perf_counter() - started
+    replay = Replay(flows.flow_users(flow), flows.flow_tickers(flow), args.rub, args.lots)
+    started = time.perf_counter()
+    replay.run(records)
+    execute_s = time.perf_counter() - started
+
+    result = {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+        },
+        "replay": report(replay, flow, parse_s, execute_s),
+    }
+    if args.trades:
+        with open(args.trades, "w") as f:
+            f.write("ticker,taker_id,maker_id,buyer_id,seller_id,qty,price,timestamp\n")
+            f.writelines(trade_line(fill) for fill in replay.trades)
+
+    output = json.dumps(result, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.expect:
+        with open(args.expect) as f:
+            expected = json.load(f)["replay"]["digests"]
+        actual = result["replay"]["digests"]
+        mismatched = [name for name in actual if expected.get(name) != actual[name]]
+        if mismatched:
+            print(f"replay differs from {args.expect}: {', '.join(mismatched)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
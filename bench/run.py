@@ -0,0 +1,333 @@
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import nullcontext, contextmanager
+from datetime import datetime, timezone
+from bench import flow as flows
+from bench.matching import run_matching
+from bench.stats import percentile
+
+# Нагрузочный прогон API биржи: подготовка пользователей, инструментов и
+# балансов через публичные/админские ручки, воспроизведение потока заявок
+# (синтетического или записанного, см. bench.flow) в процессе через TestClient
+# и/или через uvicorn, микробенчмарки сопоставления. Результат — JSON.
+#
+#   python -m bench.run --target inprocess,uvicorn --requests 5000 --out bench.json
+#   python -m bench.compare old.json new.json
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADMIN = {"Authorization": "TOKEN admin_secret_key"}
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "mean": sum(latencies) / len(latencies) if latencies else None,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "p999": percentile(latencies, 99.9),
+        "max": latencies[-1] if latencies else None,
+    }
+
+
+def seed(client, users, tickers, rub, lots):
+    # Регистрация очищает все заявки, поэтому пользователи создаются первыми
+    keys = []
+    for n in range(users):
+        r = client.post("/api/v1/public/register", json={"name": f"bench{n:04d}"})
+        r.raise_for_status()
+        user = r.json()
+        keys.append((user["id"], user["api_key"]))
+    for ticker in tickers:
+        r = client.post("/api/v1/admin/instrument", json={"name": ticker, "ticker": ticker}, headers=ADMIN)
+        if r.status_code not in (200, 400):
+            r.raise_for_status()
+    for user_id, _ in keys:
+        deposits = [("RUB", rub)] + [(ticker, lots) for ticker in tickers]
+        for ticker, amount in deposits:
+            r = client.post("/api/v1/admin/balance/deposit",
+                            json={"user_id": user_id, "ticker": ticker, "amount": amount}, headers=ADMIN)
+            r.raise_for_status()
+    return [{"Authorization": "TOKEN " + api_key} for _, api_key in keys]
+
+
+def process_cpu(pid):
+    # Процессорное время процесса и всех его потомков (uvicorn, воркеры,
+    # движок), секунды; вне Linux — None
+    try:
+        ticks = os.sysconf("SC_CLK_TCK")
+        stats = {}
+        for name in os.listdir("/proc"):
+            if name.isdigit():
+                try:
+                    with open(f"/proc/{name}/stat") as f:
+                        fields = f.read().rsplit(")", 1)[1].split()
+                except OSError:
+                    continue
+                stats[int(name)] = (int(fields[1]), int(fields[11]) + int(fields[12]))
+    except (OSError, ValueError, AttributeError):
+        return None
+    tree = {pid}
+    total = 0
+    for _ in range(len(stats)):
+        added = {child for child, (parent, _) in stats.items() if parent in tree and child not in tree}
+        if not added:
+            break
+        tree |= added
+    for member in tree:
+        if member in stats:
+            total += stats[member][1]
+    return total / ticks
+
+
+def replay(make_client, flow, headers, concurrency, cpu=time.process_time):
+    # cpu() — процессорное время сервера: разность за прогон, делённая на
+    # число запросов, — CPU на запрос. Записи одного пользователя идут по порядку в одном потоке, чтобы ссылки
+    # ref на его заявки были уже разрешены; пользователи распределяются по потокам
+    lanes = defaultdict(list)
+    for n, record in enumerate(flow):
+        lanes[record.get("lane", record["user"]) % concurrency].append((n, record))
+    latencies = defaultdict(list)
+    statuses = defaultdict(lambda: defaultdict(int))
+    order_ids = {}
+    lock = threading.Lock()
+
+    def worker(lane):
+        local = defaultdict(list)
+        local_statuses = defaultdict(lambda: defaultdict(int))
+        with make_client() as client:
+            for n, record in lane:
+                route = record["route"]
+                method, template = route.split(" ", 1)
+                if "ref" in record:
+                    order_id = order_ids.get(record["ref"])
+                    if order_id is None:
+                        local_statuses[route]["skipped"] += 1
+                        continue
+                    path = template.format(order_id=order_id)
+                else:
+                    path = template.format(ticker=record.get("ticker"))
+                started = time.perf_counter()
+                r = client.request(method, path, json=record.get("json"), headers=headers[record["user"]])
+                local[route].append((time.perf_counter() - started) * 1000)
+                local_statuses[route][str(r.status_code)] += 1
+                if r.status_code == 200 and route == "POST /api/v1/order":
+                    order_ids[n] = r.json()["order_id"]
+        with lock:
+            for route, values in local.items():
+                latencies[route].extend(values)
+            for route, counts in local_statuses.items():
+                for status, count in counts.items():
+                    statuses[route][status] += count
+
+    threads = [threading.Thread(target=worker, args=(lane,)) for lane in lanes.values()]
+    cpu_started = cpu()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    cpu_s = cpu() - cpu_started if cpu_started is not None else None
+
+    orders = 0
+    for record in flow:
+        if record["route"] in flows.ORDER_ROUTES:
+            body = record["json"]
+            orders += len(body["orders"]) if "orders" in body else 1
+    endpoints = {}
+    for route in sorted(set(latencies) | set(statuses)):
+        endpoints[route] = {
+            "latency_ms": summarize(latencies.get(route, [])),
+            "status": dict(statuses[route]),
+        }
+    total = sum(len(values) for values in latencies.values())
+    return {
+        "duration_s": elapsed,
+        "requests": total,
+        "requests_per_sec": total / elapsed if elapsed else None,
+        "orders_submitted": orders,
+        "orders_per_sec": orders / elapsed if elapsed else None,
+        "concurrency": concurrency,
+        "cpu_s": cpu_s,
+        "cpu_per_request_ms": cpu_s / total * 1000 if cpu_s is not None and total else None,
+        "endpoints": endpoints,
+    }
+
+
+def read_burst(make_client, flow, headers, args, cpu=time.process_time):
+    # Всплеск чтения над данными прогона при --read-concurrency клиентов
+    if not args.read_requests:
+        return None
+    burst = flows.read_burst(args.read_requests, len(headers), flows.flow_tickers(flow), seed=args.seed)
+    return replay(make_client, burst, headers, args.read_concurrency, cpu=cpu)
+
+
+def restart_times(workdir, start):
+    # Время до готовности после штатной остановки над данными прогона: со снимком
+    # книг (старт — снимок и хвост журнала) и без него (книги из limit_orders)
+    times = {}
+    for key in ("restart_s", "restart_without_snapshot_s"):
+        if key == "restart_without_snapshot_s":
+            os.remove(os.path.join(workdir, os.getenv("SNAPSHOT_PATH", "exchange.snapshot")))
+        started = time.perf_counter()
+        with start():
+            times[key] = time.perf_counter() - started
+    return times
+
+
+def run_inprocess(flow, args, workdir):
+    # Приложение работает с ./test.db и журналом в текущем каталоге
+    os.chdir(workdir)
+    from fastapi.testclient import TestClient
+    from app.main import app
+    with TestClient(app) as client:
+        headers = seed(client, flows.flow_users(flow), flows.flow_tickers(flow), args.rub, args.lots)
+        # TestClient общий для всех потоков: запросы идут через один event loop
+        # приложения; CPU процесса включает и клиентскую сторону
+        result = replay(lambda: nullcontext(client), flow, headers, args.concurrency)
+        result["read_burst"] = read_burst(lambda: nullcontext(client), flow, headers, args)
+    result.update(restart_times(workdir, lambda: TestClient(app)))
+    return result
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_uvicorn(flow, args, workdir):
+    return run_server(flow, args, workdir, ["-m", "uvicorn", "app.main:app", "--log-level", "warning"])
+
+
+def run_cluster(flow, args, workdir):
+    # HTTP-воркеры и процесс движка (app.serve)
+    return run_server(flow, args, workdir, ["-m", "app.serve", "--workers", str(args.workers)])
+
+
+@contextmanager
+def serving(workdir, command):
+    # Сервер в workdir; вход — после первого успешного ответа, выход — SIGTERM
+    import httpx
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+    env.pop("EXCHANGE_ENGINE_SOCKET", None)
+    server = subprocess.Popen(
+        [sys.executable] + command + ["--host", "127.0.0.1", "--port", str(port)],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                httpx.get(base_url + "/api/v1/public/instrument", timeout=1).raise_for_status()
+                break
+            except (httpx.TransportError, httpx.HTTPStatusError):
+                if server.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"{command[1]} did not start")
+                time.sleep(0.02)
+        yield server, base_url
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def run_server(flow, args, workdir, command):
+    import httpx
+    with serving(workdir, command) as (server, base_url):
+        with httpx.Client(base_url=base_url, timeout=30) as client:
+            headers = seed(client, flows.flow_users(flow), flows.flow_tickers(flow), args.rub, args.lots)
+        result = replay(
+            lambda: httpx.Client(base_url=base_url, timeout=30), flow, headers, args.concurrency,
+            cpu=lambda: process_cpu(server.pid)
+        )
+        result["read_burst"] = read_burst(
+            lambda: httpx.Client(base_url=base_url, timeout=30), flow, headers, args, cpu=lambda: process_cpu(server.pid)
+        )
+    result.update(restart_times(workdir, lambda: serving(workdir, command)))
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.run", description="Order API load test and matching benchmarks")
+    parser.add_argument("--target", default="inprocess", help="inprocess, uvicorn, cluster, none или через запятую")
+    parser.add_argument("--flow", help="JSONL с записанным потоком запросов (по умолчанию синтетический)")
+    parser.add_argument("--record", help="сохранить использованный поток в JSONL")
+    parser.add_argument("--requests", type=int, default=2000, help="размер синтетического потока")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--tickers", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--read-requests", type=int, default=2000, help="запросов во всплеске чтения, 0 — пропустить")
+    parser.add_argument("--read-concurrency", type=int, default=64, help="клиентов во всплеске чтения")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="HTTP-воркеры цели cluster")
+    parser.add_argument("--rub", type=int, default=10 ** 9, help="начальный рублёвый баланс пользователя")
+    parser.add_argument("--lots", type=int, default=10 ** 6, help="начальный баланс по каждому инструменту")
+    parser.add_argument("--matching", type=int, default=20000, help="операций в микробенчмарках, 0 — пропустить")
+    parser.add_argument("--out", help="файл результата (по умолчанию stdout)")
+    args = parser.parse_args(argv)
+
+    if args.flow:
+        flow = flows.load(args.flow)
+    else:
+        flow = flows.synthetic(args.requests, args.users, flows.tickers_for(args.tickers), seed=args.seed)
+    if args.record:
+        flows.save(args.record, flow)
+
+    result = {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+        },
+        "load": {},
+    }
+    cwd = os.getcwd()
+    targets = [target for target in args.target.split(",") if target and target != "none"]
+    # Каждому прогону — своя пустая база и журнал. В процессе прогон один:
+    # книги и балансы приложения — синглтоны модуля
+    if targets.count("inprocess") > 1:
+        parser.error("inprocess can only run once per process")
+    for target in targets:
+        runner = {"inprocess": run_inprocess, "uvicorn": run_uvicorn, "cluster": run_cluster}.get(target)
+        if runner is None:
+            parser.error(f"unknown target {target}")
+        with tempfile.TemporaryDirectory(prefix=f"bench-{target}-") as workdir:
+            try:
+                result["load"][target] = runner(flow, args, workdir)
+            finally:
+                os.chdir(cwd)
+    if args.matching:
+        result["matching"] = run_matching(args.matching, seed=args.seed)
+
+    output = json.dumps(result, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
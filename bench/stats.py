@@ -0,0 +1,8 @@
+import math
+
+
+def percentile(values, p):
+    # Ближайший ранг по отсортированному списку
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
@@ -0,0 +1,49 @@
+ADMIN = {"Authorization": "TOKEN admin_secret_key"}
+
+
+def test_batch_cancel_with_duplicate_ids_releases_reserve_once(client):
+    user = client.post("/api/v1/public/register", json={"name": "dup_cancel"}).json()
+    headers = {"Authorization": "TOKEN " + user["api_key"]}
+    assert client.post("/api/v1/admin/instrument", json={"name": "Dup", "ticker": "DUPCXL"}, headers=ADMIN).status_code == 200
+    deposit = {"user_id": user["id"], "ticker": "RUB", "amount": 1000}
+    assert client.post("/api/v1/admin/balance/deposit", json=deposit, headers=ADMIN).status_code == 200
+    order = {"direction": "BUY", "ticker": "DUPCXL", "qty": 10, "price": 100}
+    order_id = client.post("/api/v1/order", json=order, headers=headers).json()["order_id"]
+
+    response = client.request("DELETE", "/api/v1/order/batch", json={"order_ids": [order_id] * 3}, headers=headers)
+    assert response.status_code == 400
+    assert client.get(f"/api/v1/order/{order_id}", headers=headers).json()["status"] == "NEW"
+
+    response = client.request("DELETE", "/api/v1/order/batch", json={"order_ids": [order_id]}, headers=headers)
+    assert response.status_code == 200
+    assert client.get(f"/api/v1/order/{order_id}", headers=headers).json()["status"] == "CANCELLED"
+
+    # Резерв снят ровно один раз: на всю 1000 можно купить снова, но не больше
+    assert client.post("/api/v1/order", json=order, headers=headers).status_code == 200
+    extra = {"direction": "BUY", "ticker": "DUPCXL", "qty": 1, "price": 100}
+    assert client.post("/api/v1/order", json=extra, headers=headers).status_code == 400
+    assert client.get("/api/v1/balance", headers=headers).json()["RUB"] == 1000
+
+
+def test_batch_cancel_rejects_other_users_orders(client):
+    owner = client.post("/api/v1/public/register", json={"name": "owner_cancel"}).json()
+    other = client.post("/api/v1/public/register", json={"name": "other_cancel"}).json()
+    owner_headers = {"Authorization": "TOKEN " + owner["api_key"]}
+    other_headers = {"Authorization": "TOKEN " + other["api_key"]}
+    assert client.post("/api/v1/admin/instrument", json={"name": "Own", "ticker": "OWNCXL"}, headers=ADMIN).status_code == 200
+    for user in (owner, other):
+        deposit = {"user_id": user["id"], "ticker": "RUB", "amount": 1000}
+        assert client.post("/api/v1/admin/balance/deposit", json=deposit, headers=ADMIN).status_code == 200
+    order = {"direction": "BUY", "ticker": "OWNCXL", "qty": 1, "price": 100}
+    order_id = client.post("/api/v1/order", json=order, headers=owner_headers).json()["order_id"]
+    own_id = client.post("/api/v1/order", json=order, headers=other_headers).json()["order_id"]
+
+    response = client.request("DELETE", "/api/v1/order/batch", json={"order_ids": [order_id, own_id]}, headers=other_headers)
+    assert response.status_code == 200
+    assert [(item["success"], item["error"]) for item in response.json()["results"]] == [(False, "Order not found"), (True, None)]
+    assert client.get(f"/api/v1/order/{order_id}", headers=owner_headers).json()["status"] == "NEW"
+
+    response = client.request("DELETE", "/api/v1/order/batch", json={"order_ids": [order_id], "atomic": True}, headers=other_headers)
+    assert response.status_code == 404
+    assert client.delete(f"/api/v1/order/{order_id}", headers=other_headers).status_code == 404
+    assert client.delete(f"/api/v1/order/{order_id}", headers=owner_headers).status_code == 200
@@ -0,0 +1,48 @@
+import pytest
+from fastapi import HTTPException
+from app.schemas import LimitOrderBody
+from app.services.balances import MemoryLedger
+from app.services.order_book import BookRegistry
+from app.services.order_services import execute_order, execute_orders
+
+T = 1_700_000_000_000_000
+
+
+def limit(direction, qty, price):
+    return LimitOrderBody(direction=direction, ticker="ATOM", qty=qty, price=price)
+
+
+def book_state(book):
+    return [
+        [(level.price, level.total, [(order.id, order.filled) for order in level.orders.values()]) for level in side]
+        for side in (book.bids, book.asks)
+    ], dict(book.orders)
+
+
+def test_atomic_batch_rollback_restores_book_and_balances():
+    ledger = MemoryLedger({("buyer", "RUB"): 1000, ("seller", "ATOM"): 10})
+    book = BookRegistry().get("ATOM")
+    for order_id, qty, price in (("s1", 2, 100), ("s2", 3, 100), ("s3", 5, 110)):
+        execute_order(None, book, order_id, "seller", limit("SELL", qty, price), True, T, ledger)
+    before = book_state(book), ledger.balances()
+    ids = iter(["b1", "b2", "b3"])
+    items = [
+        # Исполняет s1 целиком и s2 частично
+        (0, limit("BUY", 3, 100), True),
+        # Встаёт в книгу
+        (1, limit("BUY", 1, 90), True),
+        # Не хватает средств: откат всей пачки
+        (2, limit("BUY", 1000, 110), True),
+    ]
+    with pytest.raises(HTTPException) as e:
+        execute_orders(None, book, "buyer", items, True, T + 1, ledger, lambda is_limit: next(ids))
+    assert e.value.detail.startswith("Order 2: ")
+    assert (book_state(book), ledger.balances()) == before
+    assert [order.id for order in book.best_ask().orders.values()] == ["s1", "s2"]
+    assert set(book.index) == {"s1", "s2", "s3"}
+
+    # Без atomic исполняются все заявки, кроме отклонённой
+    ids = iter(["b1", "b2", "b3"])
+    results, _, trades = execute_orders(None, book, "buyer", items, False, T + 1, ledger, lambda is_limit: next(ids))
+    assert [result["success"] for _, result in results] == [True, True, False]
+    assert [(fill.maker_id, fill.qty) for fill in trades] == [("s1", 2), ("s2", 1)]
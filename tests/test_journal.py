@@ -0,0 +1,54 @@
+from sqlalchemy.orm import sessionmaker
+from app.database import sqlite_engine
+from app.models import Base, LimitOrder, Transaction, Balance, JournalState, OrderStatus
+from app.services.journal import Journal, OrderAccepted, Fill, OrderCancelled, encode_event, read_journal
+
+T = 1_700_000_000_000_000
+
+
+def test_restart_replays_unapplied_tail_and_drops_torn_record(tmp_path):
+    engine = sqlite_engine(f"sqlite:///{tmp_path}/exchange.db")
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(bind=engine)
+    path = str(tmp_path / "exchange.journal")
+    # Падение после fsync, до применения к SQL, и посреди записи следующей пачки
+    records = [
+        (1, OrderAccepted("sell", "jr_seller", "JRNL", "SELL", True, 5, 100, T)),
+        (2, OrderAccepted("buy", "jr_buyer", "JRNL", "BUY", True, 3, 100, T + 1)),
+        (3, Fill("trade", "JRNL", "buy", "sell", "jr_buyer", "jr_seller", 3, 100, T + 1)),
+    ]
+    torn = encode_event(4, OrderCancelled("sell", "JRNL", T + 2))
+    with open(path, "wb") as f:
+        f.write(b"".join(encode_event(seq, event) for seq, event in records) + torn[:-3])
+
+    journal = Journal(path, session_factory)
+    assert journal.open() == records
+    try:
+        assert journal.seq == journal.applied == 3
+        db = session_factory()
+        orders = {order.id: (order.status, order.filled) for order in db.query(LimitOrder)}
+        assert orders == {"sell": (OrderStatus.PARTIALLY_EXECUTED, 3), "buy": (OrderStatus.EXECUTED, 3)}
+        assert [trade.id for trade in db.query(Transaction)] == ["trade"]
+        balances = {(b.user_id, b.ticker): (b.amount, b.reserved) for b in db.query(Balance)}
+        assert balances == {
+            ("jr_buyer", "RUB"): (-300, 0), ("jr_buyer", "JRNL"): (3, 0),
+            ("jr_seller", "RUB"): (300, 0), ("jr_seller", "JRNL"): (-3, 2),
+        }
+        assert db.get(JournalState, 1).applied_seq == 3
+        db.close()
+        # Журнал дописывается после последней целой записи
+        journal.append([OrderCancelled("sell", "JRNL", T + 2)]).result(timeout=10)
+    finally:
+        journal.close()
+    assert [seq for seq, _ in read_journal(path)[0]] == [1, 2, 3, 4]
+
+    # Повторный старт ничего не применяет второй раз
+    journal = Journal(path, session_factory)
+    journal.open()
+    journal.close()
+    db = session_factory()
+    assert db.get(LimitOrder, "sell").status == OrderStatus.CANCELLED
+    assert db.get(Balance, ("jr_seller", "JRNL")).reserved == 0
+    assert db.query(Transaction).count() == 1
+    db.close()
+    engine.dispose()
@@ -0,0 +1,33 @@
+import random
+from app.services.order_book import BookSide, BookOrder
+
+
+def add(side, order_id, price):
+    order = BookOrder(order_id, "u", "BUY" if side.is_bid else "SELL", price, 1)
+    side.add(order)
+    return order
+
+
+def test_book_side_iterates_levels_in_price_priority():
+    rnd = random.Random(7)
+    for is_bid in (True, False):
+        side = BookSide(is_bid=is_bid)
+        orders = [add(side, f"o{n}", rnd.randrange(1, 50)) for n in range(300)]
+        # Удаление уровней оставляет в куче устаревшие цены
+        for order in rnd.sample(orders, 200):
+            side.remove(order)
+        prices = [level.price for level in side]
+        assert prices == sorted(side.levels, reverse=is_bid)
+        assert side.best().price == prices[0]
+
+
+def test_book_side_iteration_does_not_change_heap():
+    side = BookSide(is_bid=False)
+    orders = [add(side, f"o{price}", price) for price in (5, 3, 8, 1)]
+    side.remove(orders[3])
+    heap = list(side._heap)
+    assert [level.price for level in side] == [3, 5, 8]
+    assert side._heap == heap
+    # Цена, удалённая и добавленная снова, выдаётся один раз
+    add(side, "again", 1)
+    assert [level.price for level in side] == [1, 3, 5, 8]